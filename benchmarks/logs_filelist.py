@@ -0,0 +1,87 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Per-node preparation of the get_logs file list.
+
+Compares building the tar --files-from input as one string, the way
+get_logs used to, with streaming it from tools.NulList. Each way runs in
+a forked child, which reports its time and peak memory growth. Usage:
+
+    PYTHONPATH=. python benchmarks/logs_filelist.py [files ...]
+"""
+
+from timmy import tools
+import multiprocessing as mp
+import os
+import resource
+import sys
+import time
+
+
+def log_index(files):
+    index = tools.LogIndex()
+    numbers = [index.append('/var/log/remote/node-%d/service-%d/%d.log' %
+                            (n % 500, n % 7, n), 1024)
+               for n in range(files)]
+    index.select(0, numbers)
+    return index
+
+
+def concatenated(index, out):
+    input = ''
+    for fn in index:
+        input += '%s\0' % fn.lstrip(os.path.abspath(os.sep))
+    out.write(input)
+
+
+def streamed(index, out):
+    for chunk in tools.NulList(index, lstrip=os.path.abspath(os.sep)):
+        out.write(chunk)
+
+
+def child(way, index, conn):
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with open(os.devnull, 'w') as out:
+        start = time.time()
+        way(index, out)
+        elapsed = time.time() - start
+    grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    conn.send((elapsed, grown))
+
+
+def measure(way, index):
+    parent, conn = mp.Pipe()
+    # forked, so that each way starts with the same memory use
+    p = mp.Process(target=child, args=(way, index, conn))
+    p.start()
+    result = parent.recv()
+    p.join()
+    return result
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    for files in [int(a) for a in argv] or [10000, 100000, 1000000]:
+        index = log_index(files)
+        for way in [concatenated, streamed]:
+            elapsed, grown = measure(way, index)
+            print('%8d files, %-12s: %7.3fs, peak memory +%7.1fMB' %
+                  (files, way.__name__, elapsed, grown / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Slot-refill latency of tools.run_batch.
+
+Runs "rounds" items per slot, each sleeping for a while, and measures the
+gap between a worker finishing one item and starting its next one, i.e.
+how long a free slot stays idle. Usage:
+
+    PYTHONPATH=. python benchmarks/run_batch_refill.py [slots ...]
+"""
+
+from timmy import tools
+import os
+import random
+import sys
+import time
+
+
+def item(duration):
+    start = time.time()
+    time.sleep(duration)
+    return os.getpid(), start, time.time()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def measure(slots, rounds=3, duration=0.5):
+    items = [tools.RunItem(target=item,
+                           args={'duration': duration * random.uniform(1, 2)})
+             for i in range(slots * rounds)]
+    start = time.time()
+    results = tools.run_batch(items, slots)
+    wall = time.time() - start
+    by_pid = {}
+    for pid, begin, end in results:
+        by_pid.setdefault(pid, []).append((begin, end))
+    gaps = []
+    for runs in by_pid.values():
+        runs.sort()
+        for prev, cur in zip(runs, runs[1:]):
+            gaps.append((cur[0] - prev[1]) * 1000)
+    return wall, gaps
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    for slots in [int(a) for a in argv] or [100, 500, 1000]:
+        wall, gaps = measure(slots)
+        print('%5d slots: wall %6.2fs, refill ms: mean %7.2f, p50 %7.2f, '
+              'p95 %7.2f, max %7.2f' %
+              (slots, wall, sum(gaps) / len(gaps), percentile(gaps, 0.5),
+               percentile(gaps, 0.95), max(gaps)))
+
+
+if __name__ == '__main__':
+    main()
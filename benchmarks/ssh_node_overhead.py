@@ -0,0 +1,63 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Per-call overhead of tools.ssh_node stdin forwarding.
+
+Compares the current exec-based launch with the former xxd hex round-trip
+wrapper on a local node (no ssh involved), so only the local shell
+plumbing is measured. Usage:
+
+    PYTHONPATH=. python benchmarks/ssh_node_overhead.py [calls] [stdin KiB]
+"""
+
+from timmy import tools
+import sys
+import time
+
+
+def legacy(cmd):
+    if cmd.startswith('exec '):
+        cmd = cmd[len('exec '):]
+    return ("input=\"$(cat | xxd -p)\"; trap 'kill $pid' 15; " +
+            "trap 'kill $pid' 2; echo -n \"$input\" | xxd -r -p | " + cmd +
+            ' &:; pid=$!; wait $!')
+
+
+def measure(cmd, calls, input):
+    start = time.time()
+    for i in range(calls):
+        outs, errs, code = tools.launch_cmd(cmd, 60, input=input)
+        if code != 0 or int(outs) != len(input or ''):
+            sys.exit('unexpected result: %s %s %s' % (outs, errs, code))
+    return (time.time() - start) / calls * 1000
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    calls = int(argv[0]) if len(argv) > 0 else 50
+    size = int(argv[1]) if len(argv) > 1 else 0
+    input = 'x' * size * 1024 if size else None
+    launch = tools.ssh_node('127.0.0.1', command='wc -c', prefix='',
+                            defer=True)
+    print('%d calls, %d KiB stdin' % (calls, size))
+    for name, cmd in [('xxd wrapper', legacy(launch.cmd)),
+                      ('exec', launch.cmd)]:
+        print('%-12s %8.2f ms/call' % (name, measure(cmd, calls, input)))
+
+
+if __name__ == '__main__':
+    main()
@@ -44,7 +44,9 @@ setup(name=pname,
                 '%s_data' % pname],
       install_requires=['pyyaml'],
       include_package_data=True,
-      entry_points={'console_scripts': ['%s=%s.cli:main' % (pname, pname)]},
+      entry_points={'console_scripts': [
+          '%s=%s.cli:main' % (pname, pname),
+          '%s-logs-merge=%s.logs_merge:main' % (pname, pname)]},
       setup_requires=setup_requires,
       tests_require=['pytest']
       )
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Remote helper agent.
+
+This file is passed to python -c on a node (see tools.AgentSession) and
+runs there for the whole collection, serving requests read from stdin over
+a single ssh session. It must stay self-contained - only the standard
+library, and code which works with both python 2.6+ and python 3.
+
+Every message in both directions is a frame:
+
+    <meta size> <body size>\\n<json meta><raw body>
+
+A request is one frame, its meta has a "method" key:
+
+    run    - meta: cmd, timeout, errs_limit; body: stdin of the command.
+             Runs the command with bash, replies with "out" frames carrying
+             stdout as it is produced and one "end" frame with the exit code
+             in meta and stderr as body. Exit code is 124 on timeout, like
+             with coreutils timeout.
+    find   - meta: paths, newer, dates, programs. Lists regular files under
+             paths modified after "newer" (a date string, node local time)
+             as "<size>\\t<mtime>\\t<inode>\\t<path>\\0" records, the way
+             find -printf prints them, followed by
+             "#cutoff\\t<date>\\t<epoch>\\0" for each of dates and
+             "#program\\t<name>\\0" for each of programs found in PATH.
+    facts  - no meta. Replies with a json dict of facts of the node - os.
+    exit   - stops the agent, which also stops on EOF.
+
+Requests are not pipelined - the next one is sent after the "end" frame,
+so input arriving while a command runs means the session is closing; the
+command is killed then, as it is on SIGTERM and SIGHUP.
+
+Replies of find and facts use the same "out" and "end" frames as run.
+
+The agent sends a "hello" frame with its version when it starts.
+"""
+
+import errno
+import fcntl
+import json
+import os
+import select
+import signal
+import subprocess
+import sys
+import time
+
+VERSION = 3
+CHUNK = 65536
+
+
+def read_frame(inp):
+    header = inp.readline()
+    if not header:
+        return None, None
+    meta_len, body_len = [int(x) for x in header.split()]
+    meta = json.loads(inp.read(meta_len).decode('utf-8'))
+    return meta, inp.read(body_len)
+
+
+def write_frame(out, meta, body=b''):
+    meta = json.dumps(meta).encode('utf-8')
+    out.write(('%d %d\n' % (len(meta), len(body))).encode('ascii'))
+    out.write(meta)
+    out.write(body)
+    out.flush()
+
+
+def child_setup():
+    # python ignores SIGPIPE, commands expect the default
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    os.setsid()
+
+
+def kill(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except OSError:
+        pass
+
+
+def run(inp, out, meta, body):
+    timeout = meta.get('timeout') or None
+    errs_limit = meta.get('errs_limit')
+    proc = subprocess.Popen(['bash', '-c', meta['cmd']],
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            preexec_fn=child_setup)
+    deadline = time.time() + timeout if timeout else None
+    errs = []
+    errs_len = 0
+    dropped = 0
+    pending = body
+    streams = [proc.stdout, proc.stderr]
+    if not pending:
+        proc.stdin.close()
+    else:
+        # the command may wait for its output to be read before it reads
+        # more input, a write must not wait for it
+        fd = proc.stdin.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    killed = False
+    try:
+        while streams:
+            wlist = [proc.stdin] if pending else []
+            wait = None
+            if deadline:
+                wait = max(deadline - time.time(), 0)
+            try:
+                r, w, x = select.select(streams + [inp], wlist, [], wait)
+            except select.error:
+                continue
+            if inp in r:
+                raise SystemExit(1)
+            if not r and not w:
+                # timed out, kill the whole process group of the command
+                kill(proc)
+                killed = True
+                deadline = None
+                continue
+            if w:
+                try:
+                    n = os.write(proc.stdin.fileno(), pending[:CHUNK])
+                    pending = pending[n:]
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        pending = b''
+                if not pending:
+                    proc.stdin.close()
+            for stream in r:
+                data = os.read(stream.fileno(), CHUNK)
+                if not data:
+                    streams.remove(stream)
+                elif stream is proc.stdout:
+                    write_frame(out, {'type': 'out'}, data)
+                elif errs_limit is None or errs_len < errs_limit:
+                    errs.append(data)
+                    errs_len += len(data)
+                else:
+                    dropped += len(data)
+    except BaseException:
+        # session closed, SIGTERM or an agent error
+        kill(proc)
+        raise
+    code = proc.wait()
+    if killed:
+        code = 124
+    elif code < 0:
+        # killed by a signal, report it as a shell would
+        code = 128 - code
+    errs = b''.join(errs)
+    if errs_limit is not None and len(errs) > errs_limit:
+        dropped += len(errs) - errs_limit
+        errs = errs[:errs_limit]
+    write_frame(out, {'type': 'end', 'code': code, 'dropped': dropped}, errs)
+
+
+def parse_date(value):
+    for fmt in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d']:
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    return None
+
+
+def to_bytes(s):
+    if sys.version_info[0] > 2:
+        return s.encode('utf-8', 'surrogateescape')
+    return s
+
+
+def find(inp, out, meta, body):
+    newer = parse_date(meta['newer']) if meta.get('newer') else None
+    lines = []
+    errs = []
+
+    def onerror(e):
+        errs.append(to_bytes('find: %s\n' % e))
+
+    for top in meta['paths']:
+        if os.path.isfile(top):
+            walk = [(os.path.dirname(top), [], [os.path.basename(top)])]
+        else:
+            walk = os.walk(top, onerror=onerror)
+        for dirpath, dirnames, filenames in walk:
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.lstat(path)
+                except OSError as e:
+                    onerror(e)
+                    continue
+                if not (st.st_mode & 0o170000) == 0o100000:
+                    continue
+                if newer is not None and st.st_mtime <= newer:
+                    continue
+                lines.append(to_bytes('%d\t%.10f\t%d\t%s\0' %
+                                      (st.st_size, st.st_mtime, st.st_ino,
+                                       path)))
+    for value in meta.get('dates') or []:
+        epoch = parse_date(value)
+        lines.append(to_bytes('#cutoff\t%s\t%s\0' %
+                              (value, '' if epoch is None else int(epoch))))
+    for name in meta.get('programs') or []:
+        if which(name):
+            lines.append(to_bytes('#program\t%s\0' % name))
+    write_frame(out, {'type': 'out'}, b''.join(lines))
+    write_frame(out, {'type': 'end', 'code': 1 if errs else 0},
+                b''.join(errs))
+
+
+def which(name):
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(path, name), os.X_OK):
+            return True
+    return False
+
+
+def facts(inp, out, meta, body):
+    result = {'os': 'ubuntu' if which('lsb_release') else 'centos'}
+    write_frame(out, {'type': 'out'}, json.dumps(result).encode('utf-8'))
+    write_frame(out, {'type': 'end', 'code': 0})
+
+
+METHODS = {'run': run,
+           'find': find,
+           'facts': facts}
+
+
+def main():
+    inp = getattr(sys.stdin, 'buffer', sys.stdin)
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    for sig in [signal.SIGTERM, signal.SIGHUP]:
+        signal.signal(sig, lambda sig, frame: sys.exit(128 + sig))
+    write_frame(out, {'type': 'hello', 'version': VERSION,
+                      'pid': os.getpid()})
+    while True:
+        meta, body = read_frame(inp)
+        if meta is None or meta.get('method') == 'exit':
+            return 0
+        method = METHODS.get(meta.get('method'))
+        if method is None:
+            write_frame(out, {'type': 'end', 'code': 127},
+                        ('unknown method: %s' % meta.get('method')).encode())
+            continue
+        try:
+            method(inp, out, meta, body)
+        except Exception as e:
+            write_frame(out, {'type': 'end', 'code': 255},
+                        ('agent error: %s' % e).encode('utf-8', 'replace'))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -19,6 +19,7 @@ from timmy.analyze import analyze, analyze_print_results
 from timmy.env import project_name, version
 from timmy.nodes import Node
 from timmy.tools import signal_wrapper, print_and_exit
+from datetime import timedelta
 import argparse
 import logging
 import logging.handlers
@@ -123,20 +124,47 @@ def parser_init(add_help=False):
                               ' only use what has been provided either via -L'
                               ' or in rqfile(s). Implies "-l".'))
     parser.add_argument('--logs-speed', type=int, metavar='MBIT/S',
-                        help=('Limit log collection bandwidth to 90%% of the'
-                              ' specified speed in Mbit/s.'))
+                        help=('Limit the bandwidth of all transfers from and'
+                              ' to nodes together to 90%% of the specified'
+                              ' speed in Mbit/s.'))
     parser.add_argument('--logs-speed-auto', action='store_true',
-                        help=('Limit log collection bandwidth to 90%% of local'
-                              ' admin interface speed. If speed detection'
+                        help=('Limit the bandwidth of all transfers from and'
+                              ' to nodes together to 90%% of local admin'
+                              ' interface speed. If speed detection'
                               ' fails, a default value will be used. See'
                               ' "logs_speed_default" in conf.py.'))
     parser.add_argument('--logs-coeff', type=float, metavar='RATIO',
                         help=('Estimated logs compression ratio - this value'
-                              ' is used during free space check. Set to a'
+                              ' is used during free space check for nodes'
+                              ' whose logs could not be sampled. Set to a'
                               ' lower value (default - 1.05) to collect logs'
                               ' of a total size larger than locally available'
                               '. Values lower than 0.3 are not recommended'
                               ' and may result in filling up local disk.'))
+    parser.add_argument('--logs-sample', type=int, metavar='FILES',
+                        help=('How many files of logs to compress per node to'
+                              ' estimate the size of the archives, 0 - use'
+                              ' --logs-coeff instead, which is the'
+                              ' default.'))
+    parser.add_argument('--logs-compression',
+                        choices=['gzip', 'pigz', 'zstd', 'xz', 'none', 'auto',
+                                 'local'],
+                        help=('Compression of logs archives. "auto" picks'
+                              ' the best of zstd, pigz and gzip found on each'
+                              ' node, "local" compresses plain tar archives'
+                              ' sent by nodes locally. Compressors missing on'
+                              ' a node fall back down to gzip.'))
+    parser.add_argument('--logs-compression-threads', type=int,
+                        metavar='THREADS',
+                        help=('Threads of pigz, zstd and xz, 0 - all CPUs.'))
+    parser.add_argument('--logs-split-compressed', action='store_true',
+                        help=('Put logs which are compressed already into a'
+                              ' separate uncompressed archive instead of'
+                              ' compressing them again.'))
+    parser.add_argument('--logs-incremental', action='store_true',
+                        help=('Collect only what changed in the logs since'
+                              ' the previous run, into a delta archive. See'
+                              ' timmy-logs-merge.'))
     parser.add_argument('--only-logs',
                         action='store_true',
                         help=('Only collect logs, do not run commands or'
@@ -156,16 +184,55 @@ def parser_init(add_help=False):
                         help=('Do not clean previous results. Allows'
                               ' accumulating results across runs.'),
                         action='store_true')
+    parser.add_argument('--resume',
+                        help=('Continue an interrupted run - keep previous'
+                              ' results and only redo commands, scripts,'
+                              ' files and logs which did not complete'
+                              ' successfully.'),
+                        action='store_true')
     parser.add_argument('-q', '--quiet',
                         help=('Print only command execution results and log'
                               ' messages. Good for quick runs / "watch" wrap.'
                               ' This option disables any -v parameters.'),
                         action='store_true')
+    parser.add_argument('--ssh-multiplex', action='store_true',
+                        help=('Open one SSH master connection per node and'
+                              ' reuse it for all ssh, rsync and scp calls'
+                              ' during the run. Requires OpenSSH 5.6+.'))
     parser.add_argument('--maxthreads', type=int, metavar='NUMBER',
                         help=('Maximum simultaneous nodes for command'
                               'execution.'))
     parser.add_argument('--logs-maxthreads', type=int, metavar='NUMBER',
                         help='Maximum simultaneous nodes for log collection.')
+    parser.add_argument('--batch-exec', action='store_true',
+                        help=('Run all commands and scripts of a node in a'
+                              ' single SSH session.'))
+    parser.add_argument('--async-engine', action='store_true',
+                        help=('Drive remote operations from a single event'
+                              ' loop instead of a worker process per node.'
+                              ' Allows much higher --maxthreads values.'))
+    parser.add_argument('--adaptive', action='store_true',
+                        help=('Adjust the amount of simultaneous nodes on the'
+                              ' fly, using --maxthreads and'
+                              ' --logs-maxthreads as ceilings.'))
+    parser.add_argument('--pipeline', action='store_true',
+                        help=('Process every node through file upload,'
+                              ' commands, file and log collection on its'
+                              ' own, without waiting for other nodes'
+                              ' between these steps.'))
+    parser.add_argument('--files-incremental', action='store_true',
+                        help=('Only transfer files and filelists which'
+                              ' changed since the previous run, hardlink'
+                              ' the unchanged ones.'))
+    parser.add_argument('--agent', action='store_true',
+                        help=('Start a helper on each node and run'
+                              ' commands, scripts and log listing through'
+                              ' it over one SSH session per node.'))
+    parser.add_argument('--time-budget', type=int, metavar='SECONDS',
+                        help=('Fit the run into this many seconds by'
+                              ' skipping low-priority commands, scripts,'
+                              ' files and older logs as the time runs out.'
+                              ' Skipped items are listed at the end.'))
     parser.add_argument('-t', '--outputs-timestamp',
                         help=('Add timestamp to outputs - allows accumulating'
                               ' outputs of identical commands/scripts across'
@@ -236,10 +303,29 @@ def main(argv=None):
         conf['do_print_results'] = True
     if args.no_clean:
         conf['clean'] = False
+    if args.resume:
+        conf['resume'] = True
+        conf['clean'] = False
+    if args.ssh_multiplex:
+        conf['ssh_multiplex'] = True
     if args.maxthreads:
         conf['maxthreads'] = args.maxthreads
     if args.logs_maxthreads:
         conf['logs_maxthreads'] = args.logs_maxthreads
+    if args.async_engine:
+        conf['async_engine'] = True
+    if args.adaptive:
+        conf['adaptive_concurrency'] = True
+    if args.pipeline:
+        conf['pipeline'] = True
+    if args.files_incremental:
+        conf['files_incremental'] = True
+    if args.agent:
+        conf['agent'] = True
+    if args.time_budget:
+        conf['time_budget'] = args.time_budget
+    if args.batch_exec:
+        conf['batch_exec'] = True
     if args.rqfile:
         conf['rqfile'] = []
         for file in args.rqfile:
@@ -255,6 +341,16 @@ def main(argv=None):
         conf['logs_speed'] = abs(args.logs_speed)
     if args.logs_coeff:
         conf['logs_size_coefficient'] = args.logs_coeff
+    if args.logs_compression:
+        conf['logs_compression'] = args.logs_compression
+    if args.logs_sample is not None:
+        conf['logs_sample_files'] = args.logs_sample
+    if args.logs_compression_threads is not None:
+        conf['logs_compression_threads'] = args.logs_compression_threads
+    if args.logs_split_compressed:
+        conf['logs_split_compressed'] = True
+    if args.logs_incremental:
+        conf['logs_incremental'] = True
     if conf['shell_mode']:
         filter = conf['hard_filter']
         # config cleanup for shell mode
@@ -341,7 +437,21 @@ def main(argv=None):
                 logger.error('Not enough space for logs in "%s", exiting.' %
                              nm.conf['archive_dir'])
                 print_and_exit(100)
-    if not conf['offline'] and not args.only_logs:
+            print('Space needed for logs archives: %dMB.' %
+                  (nm.logs_archives_size/1048576))
+            if nm.logs_eta is not None:
+                print('Transfer time at the limited speed: %s.' %
+                      timedelta(seconds=int(nm.logs_eta)))
+    collect_logs = logs and has_logs and enough_space
+    pipeline = (conf['pipeline'] and not conf['offline'] and
+                not args.only_logs)
+    if pipeline:
+        pretty_run(args.quiet, 'Processing nodes', nm.run_pipeline,
+                   kwargs={'fake': args.fake,
+                           'logs': collect_logs,
+                           'logs_timeout': conf['compress_timeout'],
+                           'fake_logs': args.fake_logs})
+    elif not conf['offline'] and not args.only_logs:
         if nm.has(Node.pkey):
             pretty_run(args.quiet, 'Uploading files', nm.put_files)
         if nm.has(Node.ckey, Node.skey):
@@ -353,17 +463,31 @@ def main(argv=None):
         if nm.has('scripts_all_pairs'):
             pretty_run(args.quiet, 'Executing paired scripts',
                        nm.run_scripts_all_pairs)
-        if nm.has(Node.fkey, Node.flkey):
+        if not pipeline and nm.has(Node.fkey, Node.flkey):
             pretty_run(args.quiet, 'Collecting files and filelists',
                        nm.get_files)
         if not args.no_archive and nm.has(*Node.conf_archive_general):
             pretty_run(args.quiet, 'Creating outputs and files archive',
                        nm.create_archive_general, args=(60,))
-    if logs and has_logs and enough_space:
+    if collect_logs and not pipeline:
         msg = 'Collecting and packing logs'
         pretty_run(args.quiet, msg, nm.get_logs,
                    args=(conf['compress_timeout'],),
                    kwargs={'fake': args.fake_logs})
+    nm.close_ssh_masters()
+    rates = nm.report_transfer_rates()
+    if rates and not args.quiet:
+        print('Transfer rates:')
+        for host in sorted(rates):
+            print('  %s: %dMB at %.1f Mbit/s' % (host,
+                                                 rates[host][0]/1048576,
+                                                 rates[host][1]))
+    nm.report_deadlines()
+    skipped = nm.report_skipped()
+    if skipped and not args.quiet:
+        print('Skipped to fit into the time budget:')
+        for record in skipped:
+            print('  %s: %s' % (record['node'], record['unit']))
     logger.info("Nodes:\n%s" % nm)
     if not args.quiet:
         print('Run complete. Node information:')
@@ -31,8 +31,52 @@ def init_default_conf():
                         '-oUserKnownHostsFile=/dev/null', '-oLogLevel=error',
                         '-oBatchMode=yes', '-oUser=root']
     conf['rsync_opts'] = ['-avzP', '--delete-before']
+    '''Open one SSH master connection per node and reuse it for all ssh,
+    rsync and scp calls during the run (OpenSSH ControlMaster, requires
+    OpenSSH 6.7+ on the local system). Masters are closed at the end of
+    the run or after being idle for ssh_control_persist seconds.'''
+    conf['ssh_multiplex'] = False
+    conf['ssh_control_persist'] = 600
     conf['env_vars'] = ['OPENRC=/root/openrc', 'LC_ALL="C"', 'LANG="C"']
     conf['timeout'] = 30
+    '''Deadlines for whole phases, in seconds, e.g. {'get_logs': 3600}.
+    Phases: get_os, check_access, put_files, run_commands, get_files,
+    calculate_log_size, get_logs. Commands still running when the phase
+    deadline passes are killed.'''
+    conf['phase_timeouts'] = {}
+    '''Retries of commands which fail with a transient error, per phase (see
+    phase_timeouts) or 'default', e.g.
+    {'default': {'count': 2, 'backoff': 1, 'codes': [255]}} - up to 2
+    more attempts after 1 and 2 seconds if ssh exits with 255.'''
+    conf['retry_policy'] = {}
+    '''Launch a second copy of a read-only task (get_os, check_access,
+    calculate_log_size) on a node when it runs longer than 95% of its
+    finished peers, use whichever copy finishes first.'''
+    conf['hedge'] = False
+    '''Seconds the whole run should fit in, 0 = no limit. Once half of it is
+    used, items with priority below 0 are not started any more and only
+    the last time_budget_logs_days days of logs are collected; once it is
+    used up, only items with priority 1 and above are started. Log and
+    file transfers still running at the end of the budget are killed.
+    Priorities of cmds, scripts, files and filelists are set by name in
+    priorities, logs items take a "priority" key, default is 0.'''
+    conf['time_budget'] = 0
+    conf['time_budget_logs_days'] = 1
+    conf['priorities'] = {}
+    '''Run all cmds and scripts of a node in a single remote session instead
+    of one session per command or script. timeout still applies to each
+    command and script separately.'''
+    conf['batch_exec'] = False
+    '''Start a small python helper (timmy/agent.py) on each node and send
+    commands, scripts, log archiving, log file listing and the OS check
+    to it over one ssh session per node and worker process, instead of an
+    ssh call per operation. Needs python on the nodes, nodes without it
+    fall back to plain ssh. files, filelists, put and scripts_all_pairs
+    still use rsync/scp/ssh. async_engine does not apply.'''
+    conf['agent'] = False
+    '''Command and script outputs are written to disk as they arrive, only
+    stderr is kept in memory - up to this many bytes per command.'''
+    conf['stderr_limit'] = 1048576
     conf['prefix'] = 'nice -n 19 ionice -c 3'
     rqdir = 'rq'
     rqfile = 'default.yaml'
@@ -51,13 +95,57 @@ def init_default_conf():
     conf['scripts'] = []
     conf['files'] = []
     conf['filelists'] = []
+    '''Collect files and filelists with rsync against a hardlinked copy of
+    the previous run kept in files_cache_dir (one subdirectory per node),
+    so only changed files are transferred and unchanged ones are
+    hardlinked into outdir. rsync's quick check (size and mtime) tells
+    unchanged files. Requires rsync on both sides, and files_cache_dir on
+    the same filesystem as outdir. files then go through rsync with
+    rsync_opts instead of scp - symlinks are copied as symlinks.'''
+    conf['files_incremental'] = False
+    conf['files_cache_dir'] = os.path.join(gettempdir(), 'timmy',
+                                           'files_cache')
     conf['logs'] = []
     conf['logs_no_default'] = False  # skip logs defined in default.yaml
     conf['logs_days'] = 30
-    conf['logs_speed_limit'] = False  # enable speed limiting of log transfers
+    '''Limit the bandwidth of all ssh connections to nodes together - logs,
+    files, filelists, put and commands - to 90% of logs_speed or of the
+    admin interface speed, see timmy/throttle.py'''
+    conf['logs_speed_limit'] = False
     conf['logs_speed_default'] = 100  # Mbit/s, used when autodetect fails
     conf['logs_speed'] = 0  # To manually specify max bandwidth in Mbit/s
-    conf['logs_size_coefficient'] = 1.05  # estimated logs compression ratio
+    '''Estimated logs compression ratio, used by the free space check for
+    nodes whose logs could not be sampled, see logs_sample_files'''
+    conf['logs_size_coefficient'] = 1.05
+    '''Before the free space check, the largest file of each of this many
+    largest groups of log files (by directory and kind of file) of a node is
+    compressed there, the first logs_sample_size bytes of it, to estimate
+    the size of the archive. It costs a remote command per node, so it is
+    off by default - 0 - and logs_size_coefficient is used instead.'''
+    conf['logs_sample_files'] = 0
+    conf['logs_sample_size'] = 1048576
+    '''Compression of logs archives: gzip, pigz, zstd, xz, none (plain
+    tar), auto - the best of zstd, pigz and gzip found on each node, or
+    local - the node sends a plain tar which is compressed here with the
+    best of them found locally. A compressor missing on a node falls back
+    to the next one: xz to zstd, zstd to pigz, pigz to gzip.'''
+    conf['logs_compression'] = 'gzip'
+    '''Threads of pigz, zstd and xz, 0 - all CPUs'''
+    conf['logs_compression_threads'] = 0
+    '''Put logs which are compressed already (rotated .gz, .xz and the like)
+    into a separate plain tar, logs-<node>-compressed.tar, instead of
+    compressing them again'''
+    conf['logs_split_compressed'] = False
+    '''Collect only what changed in the logs since the previous run: the
+    files of each archive are remembered (inode, size, mtime) in
+    logs_state_dir, and the next run of a node produces a delta archive,
+    logs-<node>-delta-<timestamp>.tar.*, with the bytes appended to growing
+    files and the whole new, rotated or truncated ones. Full archives are
+    named logs-<node>-full-<timestamp>.tar.* then. timmy-logs-merge
+    applies the archives to a local mirror.'''
+    conf['logs_incremental'] = False
+    conf['logs_state_dir'] = os.path.join(gettempdir(), 'timmy',
+                                          'logs_state')
     '''Shell mode - only run what was specified via command line.
     Skip actionable conf fields (see timmy/nodes.py -> Node.conf_actionable);
     Skip rqfile import;
@@ -72,6 +160,10 @@ def init_default_conf():
     conf['do_print_results'] = False
     '''Clean - erase previous results in outdir and archive_dir dir, if any.'''
     conf['clean'] = True
+    '''Continue an interrupted run: keep outdir and skip commands, scripts,
+    files, log archives and paired scripts which the journal in outdir
+    records as successfully done. Implies clean = False.'''
+    conf['resume'] = False
     '''Analyze collected data and provide cluster health insight.'''
     conf['analyze'] = False
     '''Mark all nodes as inaccessible. Useful for offline analysis.'''
@@ -84,6 +176,30 @@ def init_default_conf():
     amount of nodes from which logs are simultaneously collected). Impacts
     only log collection routine. Mandatory.'''
     conf['logs_maxthreads'] = 10
+    '''Run remote operations as non-blocking subprocesses driven by a single
+    event loop in the main process instead of forking a worker process per
+    concurrent node. maxthreads and logs_maxthreads then limit the amount of
+    nodes served simultaneously by the loop, and can be set much higher.'''
+    conf['async_engine'] = False
+    '''Treat maxthreads and logs_maxthreads as ceilings and adjust the
+    amount of simultaneously processed nodes on the fly: grow it while
+    things go well, halve it on ssh connection failures (exit code 255),
+    growing per-node latency or local load average above adaptive_load per
+    CPU. The chosen concurrency over time is logged for each phase.'''
+    conf['adaptive_concurrency'] = False
+    conf['adaptive_load'] = 2.0
+    '''Move every node through file upload, commands and scripts, file
+    collection and log collection on its own instead of running each of
+    these phases for all nodes before starting the next one. Paired scripts
+    and the general archive still wait for all nodes. Always uses worker
+    processes, async_engine and adaptive_concurrency do not apply.'''
+    conf['pipeline'] = False
+    '''How long each phase took on each node is remembered in this file
+    between runs, and nodes expected to take longest are started first.
+    Nodes without history are started first, ordered by log size when
+    collecting logs. Entries are keyed by node ip, so use a file per
+    cluster. Empty string - the default - disables it.'''
+    conf['duration_history'] = ''
     '''For each pair of nodes A & B only run client script on node A.
     Decreases the amount of iterations in scripts_all_pairs twice.'''
     conf['scripts_all_pairs_one_way'] = False
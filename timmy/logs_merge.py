@@ -0,0 +1,197 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Merges logs archives into a local mirror of the logs of the nodes.
+
+    timmy-logs-merge MIRROR ARCHIVE [ARCHIVE ...]
+
+For each node, the latest full archive is applied first, then the delta
+archives of logs_incremental runs collected after it, in the order they
+were collected - the timestamps of logs-<node>-full-<timestamp> and
+logs-<node>-delta-<timestamp>. Older archives are skipped, a delta of an
+earlier full archive would overwrite newer bytes. A full archive without
+a timestamp, of a run without logs_incremental, is older than any with
+one.
+
+Files of a full archive replace those in the mirror. A delta archive
+starts with <node>.delta.json, a list of {path, offset, size, source} -
+its files hold size bytes to write at offset into the mirror copy of
+path, which is first copied from the mirror copy of source (the path
+before a rotation) if there is one.
+"""
+
+from timmy import tools
+from timmy.env import project_name
+import argparse
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+MANIFEST = '.delta.json'
+
+logger = logging.getLogger(project_name)
+
+
+def open_archive(filename):
+    '''Returns (tarfile read as a stream, decompressing process or None)'''
+    if filename.endswith('.gz'):
+        return tarfile.open(filename, 'r|gz'), None
+    for codec in tools.codecs.values():
+        if codec.extension and filename.endswith('.' + codec.extension):
+            proc = subprocess.Popen([codec.program, '-dc', filename],
+                                    stdout=subprocess.PIPE)
+            return tarfile.open(fileobj=proc.stdout, mode='r|'), proc
+    return tarfile.open(filename, 'r|'), None
+
+
+def snapshot(mirror, path):
+    '''Copy of path to rename into place later, None if there is no path'''
+    if not os.path.isfile(path):
+        return None
+    fd, copy = tempfile.mkstemp(dir=mirror, prefix='.timmy-merge-')
+    os.close(fd)
+    shutil.copyfile(path, copy)
+    return copy
+
+
+def merge(mirror, filename):
+    '''Applies an archive to mirror, returns the number of files which
+    could not be applied'''
+    tar, proc = open_archive(filename)
+    entries = {}
+    copies = {}
+    failed = 0
+    try:
+        for member in tar:
+            name = os.path.normpath(member.name)
+            if name.startswith((os.sep, os.pardir)):
+                logger.warning('%s: skipping %s' % (filename, member.name))
+                continue
+            if name.endswith(MANIFEST) and os.sep not in name:
+                node = name[:-len(MANIFEST)]
+                for entry in json.load(tar.extractfile(member)):
+                    key = os.path.join(node, entry['path'].lstrip(os.sep))
+                    entries[key] = entry
+                    if entry['source']:
+                        source = entry['source'].lstrip(os.sep)
+                        copies[key] = snapshot(mirror, os.path.join(
+                            mirror, node, source))
+                continue
+            if not member.isfile():
+                continue
+            if not apply(mirror, name, entries.get(name), copies,
+                         tar.extractfile(member)):
+                logger.error('%s: %s: earlier archives of the file are '
+                             'missing in %s' % (filename, name, mirror))
+                failed += 1
+    finally:
+        tar.close()
+        for copy in copies.values():
+            if copy:
+                os.remove(copy)
+        if proc:
+            proc.stdout.close()
+            if proc.wait():
+                logger.error('%s: could not decompress' % filename)
+                failed += 1
+    return failed
+
+
+def apply(mirror, name, entry, copies, data):
+    path = os.path.join(mirror, name)
+    tools.mdir(os.path.dirname(path))
+    offset = entry['offset'] if entry else 0
+    if entry and entry['source']:
+        copy = copies.pop(name)
+        if copy is None:
+            return False
+        os.rename(copy, path)
+    if not offset:
+        f = open(path, 'wb')
+    elif os.path.isfile(path) and os.path.getsize(path) >= offset:
+        f = open(path, 'r+b')
+        f.seek(offset)
+    else:
+        return False
+    with f:
+        shutil.copyfileobj(data, f)
+    return True
+
+
+def archive_info(filename):
+    '''Returns (node, timestamp, delta) of an archive, the timestamp is
+    '' for a full archive without one'''
+    name = os.path.basename(filename).split('.tar', 1)[0]
+    if name.endswith('-compressed'):
+        name = name[:-len('-compressed')]
+    if name.startswith('logs-'):
+        name = name[len('logs-'):]
+    match = re.match(r'(.+)-(full|delta)-(\d{8}-\d{6})$', name)
+    if not match:
+        return name, '', False
+    return match.group(1), match.group(3), match.group(2) == 'delta'
+
+
+def merge_order(filenames):
+    '''The archives to apply, in order, see the module docstring'''
+    infos = dict([(f, archive_info(f)) for f in filenames])
+    latest = {}
+    for node, stamp, delta in infos.values():
+        if not delta:
+            latest[node] = max(latest.get(node, ''), stamp)
+    ordered = []
+    for filename in filenames:
+        node, stamp, delta = infos[filename]
+        if stamp < latest.get(node, '') or (delta and
+                                            stamp == latest.get(node)):
+            logger.warning('%s: skipping, older than the full archive '
+                           'of %s' % (filename, latest[node]))
+            continue
+        ordered.append(filename)
+    return sorted(ordered, key=lambda f: (infos[f][1], infos[f][2], f))
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    parser = argparse.ArgumentParser(description=('Merge logs archives '
+                                                  'collected by timmy into a '
+                                                  'local mirror.'))
+    parser.add_argument('mirror', help='Directory of the mirror.')
+    parser.add_argument('archives', nargs='+', metavar='archive',
+                        help=('Logs archives, full and delta ones of any '
+                              'nodes, in any order.'))
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(level=logging.INFO,
+                        format='%(levelname)s: %(message)s')
+    tools.mdir(args.mirror)
+    failed = 0
+    for filename in merge_order(args.archives):
+        logger.info('merging %s' % filename)
+        failed += merge(args.mirror, filename)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
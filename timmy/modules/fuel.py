@@ -18,6 +18,7 @@
 
 import json
 import os
+import re
 import sys
 import urllib2
 from timmy import tools
@@ -119,11 +120,8 @@ class Node(BaseNode):
         else:
             cmd = ("awk -F ':' '/fuel_version/ {print $2}' "
                    "/etc/astute.yaml")
-        release, err, code = tools.ssh_node(ip=self.ip,
-                                            command=cmd,
-                                            ssh_opts=self.ssh_opts,
-                                            timeout=self.timeout,
-                                            prefix=self.prefix)
+        release, err, code = tools.retries.run(
+            self.remote(command=cmd, env_vars=[]))
         if code != 0:
             self.logger.warning('%s: could not determine'
                                 ' MOS release' % self.repr)
@@ -142,12 +140,7 @@ class Node(BaseNode):
 
         self.logger.debug('%s: roles not defined, trying hiera' % self.repr)
         cmd = 'hiera roles'
-        outs, errs, code = tools.ssh_node(ip=self.ip,
-                                          command=cmd,
-                                          ssh_opts=self.ssh_opts,
-                                          env_vars=self.env_vars,
-                                          timeout=self.timeout,
-                                          prefix=self.prefix)
+        outs, errs, code = tools.retries.run(self.remote(command=cmd))
         self.check_code(code, 'get_roles_hiera', cmd, errs, [0])
         if code == 0:
             try:
@@ -172,12 +165,7 @@ class Node(BaseNode):
         astute_file = '/etc/astute.yaml'
         cmd = ("python -c 'import yaml; a = yaml.load(open(\"%s\")"
                ".read()); print a[\"cluster\"][\"id\"]'" % astute_file)
-        outs, errs, code = tools.ssh_node(ip=self.ip,
-                                          command=cmd,
-                                          ssh_opts=self.ssh_opts,
-                                          env_vars=self.env_vars,
-                                          timeout=self.timeout,
-                                          prefix=self.prefix)
+        outs, errs, code = tools.retries.run(self.remote(command=cmd))
         return int(outs.rstrip('\n')) if code == 0 else None
 
     def log_item_manipulate(self, item):
@@ -186,7 +174,7 @@ class Node(BaseNode):
             if 'exclude' not in item:
                 item['exclude'] = []
             for remote_dir in self.fuel_logs_remote_dir:
-                item['exclude'].append(remote_dir)
+                item['exclude'].append(re.escape(remote_dir))
         if 'fuel' in self.roles:
             for n in self.logs_excluded_nodes:
                 self.logger.debug('removing remote logs for node:%s' % n)
@@ -194,7 +182,7 @@ class Node(BaseNode):
                     item['exclude'] = []
                 for remote_dir in self.fuel_logs_remote_dir:
                     ipd = os.path.join(remote_dir, n)
-                    item['exclude'].append(ipd)
+                    item['exclude'].append(re.escape(ipd))
 
 
 class NodeManager(BaseNodeManager):
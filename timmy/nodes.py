@@ -23,12 +23,16 @@ from copy import deepcopy
 from datetime import datetime, date, timedelta
 from timmy import conf
 from timmy.env import project_name, version
+from timmy import throttle
 from timmy import tools
 from tools import w_list, run_with_lock, print_and_exit
+import atexit
+import json
 import logging
 import os
 import re
 import shutil
+import tempfile
 
 
 class Node(object):
@@ -39,8 +43,9 @@ class Node(object):
     flkey = 'filelists'
     lkey = 'logs'
     pkey = 'put'
+    prkey = 'priorities'
     conf_actionable = [lkey, ckey, skey, fkey, flkey, pkey, sapkey]
-    conf_appendable = [lkey, ckey, skey, fkey, flkey, pkey]
+    conf_appendable = [lkey, ckey, skey, fkey, flkey, pkey, prkey]
     conf_archive_general = [ckey, skey, fkey, flkey, sapkey]
     conf_keep_default = [skey, ckey, fkey, flkey]
     conf_once_prefix = 'once_'
@@ -69,14 +74,27 @@ class Node(object):
         self.ip = ip
         self.network_data = network_data
         self.release = None
+        # tools.Journal shared by all nodes, set by NodeManager
+        self.journal = None
+        # (pid, tools.AgentSession or None), see agent_session
+        self.agent_state = None
         self.files = []
         self.filelists = []
         self.cmds = []
         self.scripts = []
         # put elements must be tuples - (src, dst)
         self.put = []
+        # dicts of {cmd, script, file or filelist name: priority}
+        self.priorities = []
         self.data = {}
         self.logsize = 0
+        # tools.LogIndex of the files logs items select
+        self.log_index = tools.LogIndex()
+        # tools.Codec of the logs archive, see choose_logs_codecs
+        self.logs_codec = tools.codecs['gzip']
+        self.logs_local_codec = None
+        # {tools.log_group: compression ratio}, see co_logs_sample
+        self.logs_samples = {}
         self.mapcmds = {}
         self.mapscr = {}
         self.name = name
@@ -164,33 +182,116 @@ class Node(object):
                 setattr(self, f, [])
         r_apply(conf, p, c_a, k_d, overridden, d, clean=clean)
 
+    # Methods prefixed with "co_" are coroutines - they yield deferred
+    # commands (tools.Launch) and raise tools.Return with their result.
+    # They are driven either synchronously by the plain method of the same
+    # name or by tools.AsyncEngine, see NodeManager.run_batch.
+
+    def agent_session(self):
+        '''Agent session of this node in the current process, started on
+        first use. None if agent is disabled or can not run on the node -
+        commands then go over plain ssh, also after a session broke.'''
+        if not self.agent:
+            return None
+        pid = os.getpid()
+        if self.agent_state and self.agent_state[0] == pid:
+            session = self.agent_state[1]
+            if session is None or session.alive:
+                return session
+            self.logger.warning('%s: agent session lost, using ssh' %
+                                self.repr)
+            self.agent_state = (pid, None)
+            return None
+        session = tools.AgentSession(self.ip, ssh_opts=self.ssh_opts,
+                                     timeout=self.timeout)
+        if not session.start():
+            self.logger.warning('%s: agent is not available, using ssh' %
+                                self.repr)
+            session = None
+        self.agent_state = (pid, session)
+        return session
+
+    def remote(self, command='', timeout=None, filename=None, env_vars=None,
+               input=None, outputfile=None, ok_codes=None, errs_limit=None,
+               sink=None):
+        '''Deferred command on the node - a request to the node agent if
+        there is one, an ssh call otherwise'''
+        if env_vars is None:
+            env_vars = self.env_vars
+        if timeout is None:
+            timeout = self.timeout
+        session = self.agent_session()
+        if session and filename is not None:
+            try:
+                with open(filename, 'r') as f:
+                    input = f.read()
+                command = 'bash -s'
+            except IOError:
+                # let ssh_node report it the usual way
+                session = None
+        if not session:
+            return tools.ssh_node(ip=self.ip,
+                                  command=command,
+                                  ssh_opts=self.ssh_opts,
+                                  env_vars=env_vars,
+                                  timeout=timeout,
+                                  filename=filename,
+                                  outputfile=outputfile,
+                                  ok_codes=ok_codes,
+                                  input=input,
+                                  errs_limit=errs_limit,
+                                  prefix=self.prefix,
+                                  sink=sink,
+                                  defer=True)
+        if type(env_vars) is list:
+            env_vars = ' '.join(env_vars)
+        cmd = '%s %s %s' % (env_vars, self.prefix, command)
+        label = '%s: %s' % (self.ip, command if filename is None else filename)
+        return tools.AgentCall(session, 'run', {'cmd': cmd}, timeout,
+                               input=input, outputfile=outputfile,
+                               errs_limit=errs_limit, label=label, sink=sink)
+
     def get_os(self):
+        return tools.run_sync(self.co_get_os())
+
+    def co_get_os(self):
         self.logger.debug('%s: os_platform not defined, trying to determine' %
                           self.repr)
+        session = self.agent_session()
+        if session:
+            outs, errs, code = yield tools.AgentCall(session, 'facts', {},
+                                                     self.timeout)
+            if code == 0:
+                raise tools.Return(json.loads(outs)['os'])
         cmd = 'which lsb_release'
-        outs, errs, code = tools.ssh_node(ip=self.ip,
-                                          command=cmd,
-                                          ssh_opts=self.ssh_opts,
-                                          env_vars=self.env_vars,
-                                          timeout=self.timeout,
-                                          prefix=self.prefix)
-        return 'centos' if code else 'ubuntu'
+        outs, errs, code = yield tools.ssh_node(ip=self.ip,
+                                                command=cmd,
+                                                ssh_opts=self.ssh_opts,
+                                                env_vars=self.env_vars,
+                                                timeout=self.timeout,
+                                                prefix=self.prefix,
+                                                defer=True)
+        raise tools.Return('centos' if code else 'ubuntu')
 
     def check_access(self):
+        return tools.run_sync(self.co_check_access())
+
+    def co_check_access(self):
         self.logger.debug('%s: verifyng node access' %
                           self.repr)
         cmd = 'true'
-        outs, errs, code = tools.ssh_node(ip=self.ip,
-                                          command=cmd,
-                                          ssh_opts=self.ssh_opts,
-                                          env_vars=self.env_vars,
-                                          timeout=self.timeout,
-                                          prefix=self.prefix)
+        outs, errs, code = yield tools.ssh_node(ip=self.ip,
+                                                command=cmd,
+                                                ssh_opts=self.ssh_opts,
+                                                env_vars=self.env_vars,
+                                                timeout=self.timeout,
+                                                prefix=self.prefix,
+                                                defer=True)
         if code == 0:
-            return True
+            raise tools.Return(True)
         else:
             self.logger.info('%s: not accessible' % self.repr)
-            return False
+            raise tools.Return(False)
 
     @property
     def scripts_ddir(self):
@@ -221,7 +322,33 @@ class Node(object):
                            'stderr_path': stderr_path}
         self.mapscr = mapscr
 
+    def priority(self, name):
+        '''Priority of a cmd, script, file or filelist, see time_budget'''
+        result = 0
+        for priorities in self.priorities:
+            if priorities and name in priorities:
+                result = priorities[name]
+        return int(result)
+
+    def budget_admits(self, phase, unit, priority):
+        '''False, and the unit recorded as skipped, if the time budget does
+        not admit work of this priority any more'''
+        if tools.budget.admits(priority):
+            return True
+        self.budget_skip(phase, unit, priority)
+        return False
+
+    def budget_skip(self, phase, unit, priority):
+        self.logger.warning('%s: time budget: skipping %s, priority %d' %
+                            (self.repr, unit, priority))
+        if self.journal:
+            self.journal.record(self.ip, phase, unit, False,
+                                skipped='time budget', priority=priority)
+
     def exec_cmd(self, fake=False, ok_codes=None):
+        return tools.run_sync(self.co_exec_cmd(fake=fake, ok_codes=ok_codes))
+
+    def co_exec_cmd(self, fake=False, ok_codes=None):
         cl = self.cluster_repr
         self.logger.debug('%s/%s/%s/%s' %
                           (self.outdir, Node.ckey, cl, self.repr))
@@ -230,6 +357,7 @@ class Node(object):
             tools.mdir(ddir)
             self.cmds = sorted(self.cmds)
         mapcmds = {}
+        jobs = []
         for c in self.cmds:
             for cmd in c:
                 dfile = os.path.join(ddir, cmd)
@@ -239,75 +367,301 @@ class Node(object):
                         dfile += self.outputs_timestamp_str
                 self.logger.info('outfile: %s' % dfile)
                 mapcmds[cmd] = dfile
-                if not fake:
-                    bash_cmd = "bash -c '%s'" % c[cmd]
-                    outs, errs, code = tools.ssh_node(ip=self.ip,
-                                                      command=bash_cmd,
-                                                      ssh_opts=self.ssh_opts,
-                                                      env_vars=self.env_vars,
-                                                      timeout=self.timeout,
-                                                      prefix=self.prefix)
-                    ec = self.check_code(code, 'exec_cmd',
-                                         c[cmd], errs, ok_codes)
-                    try:
-                        with open(dfile, 'w') as df:
-                            df.write(outs)
-                    except IOError:
-                        self.logger.error("can't write to file %s" %
-                                          dfile)
-                    if ec:
-                        try:
-                            with open(errf, 'w') as ef:
-                                ef.write('exitcode: %s\n' % code)
-                                ef.write(errs)
-                        except IOError:
-                            self.logger.error("can't write to file %s" %
-                                              errf)
+                jobs.append({'name': cmd,
+                             'cmd': c[cmd],
+                             'output_path': dfile,
+                             'stderr_path': errf})
         if self.scripts:
             self.generate_mapscr()
             tools.mdir(self.scripts_ddir)
-        for scr, param in self.mapscr.items():
-            if fake:
-                continue
-            outs, errs, code = tools.ssh_node(ip=self.ip,
-                                              filename=param['script_path'],
-                                              ssh_opts=self.ssh_opts,
-                                              env_vars=param['env_vars'],
-                                              timeout=self.timeout,
-                                              prefix=self.prefix)
+        jobs += self.mapscr.values()
+        jobs = [job for job in jobs if not self.job_done(job)]
+        if not fake and jobs:
+            if self.batch_exec and not self.agent_session():
+                # the rest is admitted by the batch as it goes, see
+                # co_exec_batch
+                jobs = [job for job in jobs if self.job_admitted(job)]
+                results = []
+                if jobs:
+                    results = yield self.co_exec_batch(jobs)
+            else:
+                # admitted one by one, the budget may run out meanwhile
+                results = []
+                for job in jobs:
+                    if not self.job_admitted(job):
+                        results.append(None)
+                        continue
+                    outs, errs, code = yield self.exec_job(job)
+                    results.append((None, errs, code))
+            for job, result in zip(jobs, results):
+                if result is None:
+                    continue
+                outs, errs, code = result
+                ok = self.write_job_result(job, outs, errs, code, ok_codes)
+                if self.journal:
+                    self.journal.record(self.ip, 'run_commands',
+                                        self.job_unit(job), ok, code=code)
+        raise tools.Return((mapcmds, self.mapscr))
+
+    def job_unit(self, job):
+        if 'script_path' in job:
+            return 'script %s' % job['script_path']
+        return 'cmd %s' % job['name']
+
+    def job_priority(self, job):
+        if 'script_path' in job:
+            return self.priority(os.path.basename(job['script_path']))
+        return self.priority(job['name'])
+
+    def job_admitted(self, job):
+        return self.budget_admits('run_commands', self.job_unit(job),
+                                  self.job_priority(job))
+
+    def job_done(self, job):
+        '''True if the job succeeded in a run being resumed'''
+        if not self.journal:
+            return False
+        if not self.journal.done(self.ip, 'run_commands', self.job_unit(job)):
+            return False
+        return os.path.exists(job['output_path'])
+
+    def exec_job(self, job):
+        '''Returns a deferred ssh call for a command or a script job, its
+        stdout goes straight to the job's output file'''
+        if 'script_path' in job:
+            return self.remote(filename=job['script_path'],
+                               env_vars=job['env_vars'],
+                               outputfile=job['output_path'],
+                               errs_limit=self.stderr_limit)
+        else:
+            return self.remote(command="bash -c '%s'" % job['cmd'],
+                               outputfile=job['output_path'],
+                               errs_limit=self.stderr_limit)
+
+    def co_exec_batch(self, jobs):
+        '''Runs all jobs in one remote bash session, each job still under
+        its own timeout, and demultiplexes the framed output. The batch
+        skips jobs once the time budget would not admit them any more.
+
+        Returns a result per job, None for a job skipped by the budget.'''
+        batch = tools.CmdBatch(self.timeout)
+        for job in jobs:
+            until = tools.budget.admitted_for(self.job_priority(job))
+            if 'script_path' in job:
+                try:
+                    with open(job['script_path'], 'r') as f:
+                        batch.add_script(f.read(), job['env_vars'],
+                                         until=until)
+                except IOError:
+                    self.logger.error('could not read file: %s' %
+                                      job['script_path'])
+                    batch.add_cmd('exit 127')
+            else:
+                batch.add_cmd(job['cmd'], until=until)
+        self.logger.info('%s: running %d commands and scripts in one batch' %
+                         (self.repr, len(jobs)))
+        sink = batch.sink([job['output_path'] for job in jobs],
+                          errs_limit=self.stderr_limit)
+        launch = tools.ssh_node(ip=self.ip,
+                                command='bash -s',
+                                ssh_opts=self.ssh_opts,
+                                env_vars=self.env_vars,
+                                timeout=batch.timeout,
+                                input=batch.script(),
+                                sink=sink,
+                                errs_limit=self.stderr_limit,
+                                prefix=self.prefix,
+                                defer=True)
+        outs, errs, code = yield launch
+        self.check_code(code, 'exec_batch', 'batch', errs)
+        if sink.broken:
+            self.logger.warning('%s: garbled batch output, running the '
+                                'commands and scripts the batch did not start '
+                                'one by one' % self.repr)
+        results = []
+        for index, job in enumerate(jobs):
+            if index in sink.skipped:
+                self.budget_skip('run_commands', self.job_unit(job),
+                                 self.job_priority(job))
+                results.append(None)
+            elif (sink.broken and index not in sink.results and
+                    index not in sink.launched):
+                if not self.job_admitted(job):
+                    results.append(None)
+                    continue
+                outs, errs, code = yield self.exec_job(job)
+                results.append((None, errs, code))
+            elif index in sink.results:
+                results.append(sink.results[index])
+                if sink.results[index][2] == 124:
+                    # killed by the remote timeout of this job
+                    name = job.get('script_path', job.get('cmd'))
+                    tools.deadlines.record('%s: %s' % (self.ip, name),
+                                           self.timeout)
+            else:
+                # batch was interrupted before this job reported back, or
+                # its output was garbled - it may have run, do not run it
+                # again; keep partial output if there is any
+                outs = None if index in sink.started else ''
+                results.append((outs, errs, code or 255))
+        raise tools.Return(results)
+
+    def write_job_result(self, job, outs, errs, code, ok_codes=None):
+        if 'script_path' in job:
             ec = self.check_code(code, 'exec_cmd',
-                                 ('script %s' % param['script_path']),
+                                 ('script %s' % job['script_path']),
                                  errs, ok_codes)
+            write_stderr = not ec
+        else:
+            ec = self.check_code(code, 'exec_cmd', job['cmd'], errs,
+                                 ok_codes)
+            write_stderr = ec
+        if outs is not None:
+            # output was not streamed to the file by the command itself
             try:
-                with open(param['output_path'], 'w') as df:
+                with open(job['output_path'], 'w') as df:
                     df.write(outs)
             except IOError:
                 self.logger.error("can't write to file %s" %
-                                  param['output_path'])
-            if not ec:
-                try:
-                    with open(param['stderr_path'], 'w') as ef:
-                        ef.write('exitcode: %s\n' % code)
-                        ef.write(errs)
-                except IOError:
-                    self.logger.error("can't write to file %s" %
-                                      param['stderr_path'])
-        return mapcmds, self.mapscr
+                                  job['output_path'])
+        if write_stderr:
+            try:
+                with open(job['stderr_path'], 'w') as ef:
+                    ef.write('exitcode: %s\n' % code)
+                    ef.write(errs)
+            except IOError:
+                self.logger.error("can't write to file %s" %
+                                  job['stderr_path'])
+        return ec
 
     def exec_simple_cmd(self, cmd, timeout=15, infile=None, outfile=None,
                         fake=False, ok_codes=None, input=None):
+        return tools.run_sync(self.co_exec_simple_cmd(cmd, timeout=timeout,
+                                                      infile=infile,
+                                                      outfile=outfile,
+                                                      fake=fake,
+                                                      ok_codes=ok_codes,
+                                                      input=input))
+
+    def co_exec_simple_cmd(self, cmd, timeout=15, infile=None, outfile=None,
+                           fake=False, ok_codes=None, input=None):
         self.logger.info('%s, exec: %s' % (self.repr, cmd))
         if not fake:
-            outs, errs, code = tools.ssh_node(ip=self.ip,
-                                              command=cmd,
-                                              ssh_opts=self.ssh_opts,
-                                              env_vars=self.env_vars,
-                                              timeout=timeout,
-                                              outputfile=outfile,
-                                              ok_codes=ok_codes,
-                                              input=input,
-                                              prefix=self.prefix)
+            outs, errs, code = yield self.remote(command=cmd,
+                                                 timeout=timeout,
+                                                 outputfile=outfile,
+                                                 ok_codes=ok_codes,
+                                                 input=input)
             self.check_code(code, 'exec_simple_cmd', cmd, errs, ok_codes)
+            raise tools.Return(code)
+
+    def archive_logs(self, cmd, timeout, outfile, input, compress=None,
+                     plain=None):
+        return tools.run_sync(self.co_archive_logs(cmd, timeout, outfile,
+                                                   input, compress, plain))
+
+    def co_archive_logs(self, cmd, timeout, outfile, input, compress=None,
+                        plain=None):
+        '''Writes the logs archive of the node to outfile. compress is a
+        local command compressing it afterwards, if the node sends it
+        uncompressed. plain is (cmd, outfile, input) of a second archive,
+        of the files which are compressed already - the main archive is
+        made even if that one fails, the logs are only recorded as
+        collected if both are.'''
+        ok_codes = [0, 1]
+        codes = []
+        if plain:
+            p_cmd, p_outfile, p_input = plain
+            codes.append((yield self.co_exec_simple_cmd(p_cmd,
+                                                        timeout=timeout,
+                                                        outfile=p_outfile,
+                                                        input=p_input,
+                                                        ok_codes=ok_codes)))
+        code = yield self.co_exec_simple_cmd(cmd, timeout=timeout,
+                                             outfile=outfile, input=input,
+                                             ok_codes=ok_codes)
+        if compress and code in ok_codes:
+            self.logger.info('%s: compressing logs: %s' % (self.repr,
+                                                           compress))
+            outs, errs, c_code = yield tools.Launch(compress, timeout)
+            if c_code:
+                self.logger.error('%s: could not compress logs: %s' %
+                                  (self.repr, errs))
+                code = c_code
+            outfile = self.logs_local_codec.filename(
+                os.path.splitext(outfile)[0])
+        codes.append(code)
+        failed = [c for c in codes if c not in ok_codes]
+        code = failed[0] if failed else max(codes)
+        state = self.logs_state()
+        if state and code in ok_codes:
+            state.save(tools.log_state(self.log_index))
+        if self.journal:
+            self.journal.record(self.ip, 'get_logs', 'logs',
+                                code in ok_codes, code=code, archive=outfile)
+
+    def logs_state(self):
+        '''tools.LogsState of the node, None unless logs_incremental'''
+        if not self.logs_incremental:
+            return None
+        return tools.LogsState(os.path.join(self.logs_state_dir,
+                                            '%s.json' % self.ip))
+
+    def logs_delta_codec(self):
+        '''tools.Codec of delta archives, which are compressed here'''
+        if self.logs_local_codec:
+            return self.logs_local_codec
+        available = tools.local_programs([c.program for c in
+                                          tools.codecs.values() if c.program])
+        return tools.choose_codec(self.logs_codec.name, available)
+
+    def archive_logs_delta(self, timeout, outfile, previous):
+        return tools.run_sync(self.co_archive_logs_delta(timeout, outfile,
+                                                         previous))
+
+    def co_archive_logs_delta(self, timeout, outfile, previous):
+        '''Writes to outfile an archive of what changed in the logs of the
+        node since the archive previous (a tools.LogsState) describes. The
+        ranges are fetched into a temporary tree next to outfile, which is
+        then archived along with <node>.delta.json, the list of the ranges
+        timmy/logs_merge.py applies to a mirror.'''
+        delta = tools.LogsDelta(self.log_index, previous)
+        self.logger.info('%s: logs delta: %d files, %d bytes, %d files '
+                         'unchanged' % (self.repr, len(delta.ranges),
+                                        delta.size, len(delta.unchanged)))
+        if not delta.ranges:
+            self.logs_state().save(delta.state({}))
+            if self.journal:
+                self.journal.record(self.ip, 'get_logs', 'logs', True,
+                                    code=0, archive=None)
+            raise tools.Return(None)
+        staging = tempfile.mkdtemp(prefix='.%s-' % self.repr,
+                                   dir=os.path.dirname(outfile))
+        try:
+            tools.mdir(os.path.join(staging, self.repr))
+            sink = delta.sink(os.path.join(staging, self.repr))
+            outs, errs, code = yield self.remote('bash -s', timeout=timeout,
+                                                 input=delta.script(),
+                                                 sink=sink)
+            if code == 0 and sink.broken:
+                code, errs = 1, 'unexpected data in logs ranges'
+            if self.check_code(code, 'co_archive_logs_delta', 'logs delta',
+                               errs):
+                manifest = '%s.delta.json' % self.repr
+                with open(os.path.join(staging, manifest), 'w') as f:
+                    json.dump(delta.manifest(sink.read), f)
+                option = self.logs_delta_codec().tar_option(
+                    self.logs_compression_threads)
+                cmd = ("tar --create --file '%s' %s -C '%s' '%s' '%s'" %
+                       (outfile, option, staging, manifest, self.repr))
+                outs, errs, code = yield tools.Launch(cmd, timeout)
+                if self.check_code(code, 'co_archive_logs_delta', cmd, errs):
+                    self.logs_state().save(delta.state(sink.read))
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        if self.journal:
+            self.journal.record(self.ip, 'get_logs', 'logs', code == 0,
+                                code=code, archive=outfile)
 
     def exec_pair(self, phase, server_node=None, fake=False):
         sn = server_node
@@ -357,13 +711,9 @@ class Node(object):
             tools.mdir(ddir)
             if type(phase_val) is dict:
                 env_vars = [phase_val.values()[0]]
-                phase_val = phase_val.keys()[0]
             else:
                 env_vars = self.env_vars
-            if os.path.sep in phase_val:
-                f = phase_val
-            else:
-                f = os.path.join(self.rqdir, Node.skey, phase_val)
+            f = self.pair_script(i, phase)
             dfile = os.path.join(ddir, os.path.basename(f))
             if phase.startswith('client'):
                 env_vars.append('SERVER_IP=%s' % server_ip)
@@ -373,26 +723,78 @@ class Node(object):
                 env_vars.append('SERVER_OUTPUT=%s' % i['server_output'])
             if fake:
                 return self.scripts_all_pairs
+            unit = '%s %s' % (phase, f)
+            if phase.startswith('client'):
+                unit += ' %s' % server_ip
+            record = None
+            if self.journal:
+                record = self.journal.get(self.ip, 'scripts_all_pairs', unit)
+            if phase == 'server_start':
+                # the server is only left alone if the whole pair is done,
+                # otherwise it is started again and its fresh output is used
+                i['resumed'] = bool(record and record['ok'] and
+                                    self.pair_done(i))
+            if record and record['ok'] and (phase.startswith('client') or
+                                            i.get('resumed')):
+                self.logger.info('%s: %s already done' % (self.repr, unit))
+                if 'server_output' in record:
+                    i['server_output'] = record['server_output']
+                continue
             outs, errs, code = tools.ssh_node(ip=self.ip,
                                               filename=f,
                                               ssh_opts=self.ssh_opts,
                                               env_vars=env_vars,
                                               timeout=self.timeout,
                                               prefix=self.prefix)
-            self.check_code(code, 'exec_pair, phase:%s' % phase, f, errs)
+            ok = self.check_code(code, 'exec_pair, phase:%s' % phase, f,
+                                 errs)
+            meta = {}
+            if phase.startswith('client'):
+                meta['server'] = sn.ip
             if phase == 'server_start' and code == 0:
                 i['server_output'] = outs.strip()
+                meta['server_output'] = i['server_output']
             open(dfile, 'a+').write(outs)
+            if self.journal:
+                self.journal.record(self.ip, 'scripts_all_pairs', unit, ok,
+                                    code=code, **meta)
         return self.scripts_all_pairs
 
+    def pair_script(self, pair, phase):
+        phase_val = pair[phase]
+        if type(phase_val) is dict:
+            phase_val = phase_val.keys()[0]
+        if os.path.sep in phase_val:
+            return phase_val
+        return os.path.join(self.rqdir, Node.skey, phase_val)
+
+    def pair_done(self, pair):
+        '''True if a run being resumed finished the pair this node is the
+        server of - server_stop succeeded and so did every client which ran
+        against the server'''
+        unit = 'server_stop %s' % self.pair_script(pair, 'server_stop')
+        if not self.journal.done(self.ip, 'scripts_all_pairs', unit):
+            return False
+        for record in self.journal.records.values():
+            if (record['phase'] == 'scripts_all_pairs' and
+                    record.get('server') == self.ip and not record['ok']):
+                return False
+        return True
+
     def get_files(self, timeout=15):
+        return tools.run_sync(self.co_get_files(timeout=timeout))
+
+    def co_get_files(self, timeout=15):
         self.logger.info('%s: getting files' % self.repr)
         cl = self.cluster_repr
         if self.files or self.filelists:
             ddir = os.path.join(self.outdir, Node.fkey, cl, self.repr)
             tools.mdir(ddir)
         data = ''
-        for f in self.filelists:
+        filelists = [f for f in self.filelists
+                     if self.budget_admits('get_files', 'filelist %s' % f,
+                                           self.priority(f))]
+        for f in filelists:
             if os.path.sep in f:
                 fname = f
             else:
@@ -405,112 +807,365 @@ class Node(object):
             except IOError:
                 self.logger.error('could not read file: %s' % fname)
         self.logger.debug('%s: data:\n%s' % (self.repr, data))
+        if self.journal and self.journal.done(self.ip, 'get_files', 'files'):
+            self.logger.info('%s: files already collected' % self.repr)
+            return
+        files = [f for f in self.files
+                 if self.budget_admits('get_files', 'file %s' % f,
+                                       self.priority(f))]
+        cache = None
+        if self.files_incremental:
+            # everything goes through rsync to be compared with the cache
+            cache = tools.FilesCache(os.path.join(self.files_cache_dir,
+                                                  self.ip))
+            if data and not data.endswith('\n'):
+                data += '\n'
+            for f in files:
+                data += tools.rsync_include_rules(f)
+            files = []
+        ok = True
         if data:
-            o, e, c = tools.get_files_rsync(ip=self.ip,
-                                            data=data,
-                                            ssh_opts=self.ssh_opts,
-                                            rsync_opts=self.rsync_opts,
-                                            dpath=ddir,
-                                            timeout=self.timeout)
-            self.check_code(c, 'get_files', 'tools.get_files_rsync', e)
-        for f in self.files:
-            outs, errs, code = tools.get_file_scp(ip=self.ip,
-                                                  file=f,
+            link_dest = cache.link_dest if cache else None
+            o, e, c = yield tools.get_files_rsync(ip=self.ip,
+                                                  data=data,
                                                   ssh_opts=self.ssh_opts,
-                                                  ddir=ddir,
-                                                  recursive=True)
-            self.check_code(code, 'get_files', 'tools.get_file_scp', errs)
+                                                  rsync_opts=self.rsync_opts,
+                                                  dpath=ddir,
+                                                  timeout=self.timeout,
+                                                  defer=True,
+                                                  link_dest=link_dest)
+            ok &= self.check_code(c, 'get_files', 'tools.get_files_rsync', e)
+            if cache and ok:
+                stats = cache.update(ddir)
+                self.logger.info('%s: files: %d of %d changed, %d of %d '
+                                 'bytes transferred' % ((self.repr,) + stats))
+        for f in files:
+            outs, errs, code = yield tools.get_file_scp(ip=self.ip,
+                                                        file=f,
+                                                        ssh_opts=self.ssh_opts,
+                                                        ddir=ddir,
+                                                        recursive=True,
+                                                        defer=True)
+            ok &= self.check_code(code, 'get_files', 'tools.get_file_scp',
+                                  errs)
+        if self.journal:
+            self.journal.record(self.ip, 'get_files', 'files', ok)
 
     def put_files(self):
+        return tools.run_sync(self.co_put_files())
+
+    def co_put_files(self):
         self.logger.info('%s: putting files' % self.repr)
         for f in self.put:
-            outs, errs, code = tools.put_file_scp(ip=self.ip,
-                                                  file=f[0],
-                                                  dest=f[1],
-                                                  ssh_opts=self.ssh_opts,
-                                                  recursive=True)
+            outs, errs, code = yield tools.put_file_scp(ip=self.ip,
+                                                        file=f[0],
+                                                        dest=f[1],
+                                                        ssh_opts=self.ssh_opts,
+                                                        recursive=True,
+                                                        defer=True)
             self.check_code(code, 'put_files', 'tools.put_file_scp', errs)
 
     def log_item_manipulate(self, item):
         pass
 
     def logs_populate(self, timeout=5):
+        return tools.run_sync(self.co_logs_populate(timeout=timeout))
+
+    def logs_start(self, item):
+        '''Returns the date string logs of an item are collected since,
+        or None to collect all of them'''
+        start_str = None
+        if 'start' in item or hasattr(self, 'logs_days'):
+            if hasattr(self, 'logs_days') and 'start' not in item:
+                start = self.logs_days
+            else:
+                start = item['start']
+            if any([type(start) is str and re.match(r'-?\d+$', start),
+                    type(start) is int]):
+                days = abs(int(str(start)))
+                start_str = str(date.today() - timedelta(days=days))
+            else:
+                for format in ['%Y-%m-%d', '%Y-%m-%d %H:%M:%S']:
+                    try:
+                        if datetime.strptime(start, format):
+                            start_str = start
+                            break
+                    except ValueError:
+                        pass
+                if not start_str:
+                    self.logger.warning(('incorrect value of "start"'
+                                         ' parameter in "logs": "%s" -'
+                                         ' ignoring...')
+                                        % start)
+        if tools.budget.tight():
+            cutoff = str(date.today() -
+                         timedelta(days=self.time_budget_logs_days))
+            if not start_str or start_str < cutoff:
+                start_str = cutoff
+        return start_str
 
-        def filter_by_re(item, string):
-            return (('include' not in item or not item['include'] or
-                     any([re.search(i, string) for i in item['include']])) and
-                    ('exclude' not in item or not item['exclude'] or not
-                     any([re.search(e, string) for e in item['exclude']])))
+    def co_logs_populate(self, timeout=5):
+        '''Lists files of all logs items in one traversal of the node.
 
+        Overlapping paths are walked once. The node prints size, mtime,
+        inode and path of every file, plus the epoch of each "start" of the
+        items, so that dates are interpreted in the node's local time.
+        Records end with NUL, paths may hold tabs and newlines. Files are
+        then assigned to items, and filtered by "start", include and
+        exclude, locally, see logs_assign. The same command looks for the
+        compressors logs_compression may need.
+
+        Returns (tools.LogIndex, compressors found or None).'''
+
+        def under(path, top):
+            top = top.rstrip('/')
+            return path == top or path.startswith(top + '/')
+
+        if not self.logs:
+            raise tools.Return((self.log_index, None))
+        starts = []
         for item in self.logs:
             self.log_item_manipulate(item)
-            start_str = None
-            if 'start' in item or hasattr(self, 'logs_days'):
-                if hasattr(self, 'logs_days') and 'start' not in item:
-                    start = self.logs_days
-                else:
-                    start = item['start']
-                if any([type(start) is str and re.match(r'-?\d+', start),
-                        type(start) is int]):
-                    days = abs(int(str(start)))
-                    start_str = str(date.today() - timedelta(days=days))
+            starts.append(self.logs_start(item))
+        tops = []
+        for path in sorted(set([item['path'] for item in self.logs])):
+            if not any([under(path, top) for top in tops]):
+                tops.append(path)
+        dates = sorted(set([s for s in starts if s]))
+        # prune by the oldest start if every item has one
+        newer = dates[0] if all(starts) else None
+        newer_param = ' -newermt "$(date -d \'%s\')"' % newer if newer else ''
+        programs = []
+        if self.logs_compression not in ['gzip', 'none', 'local']:
+            programs = [c.program for c in tools.codecs.values()
+                        if c.program and c.program != 'gzip']
+        cmd = ("find %s -type f%s -printf '%%s\\t%%T@\\t%%i\\t%%p\\0'; rc=$?; "
+               "for d in %s; do printf '#cutoff\\t%%s\\t%%s\\0' \"$d\" "
+               "\"$(date -d \"$d\" +%%s)\"; done; " %
+               (' '.join(["'%s'" % p for p in tops]), newer_param,
+                ' '.join(["'%s'" % d for d in dates])))
+        if programs:
+            cmd += ("for p in %s; do command -v $p >/dev/null && "
+                    "printf '#program\\t%%s\\0' $p; done; " %
+                    ' '.join(sorted(programs)))
+        cmd += 'exit $rc'
+        timeout = timeout * len(tops)
+        session = self.agent_session()
+        if session:
+            self.logger.info('%s: logs find: %s, newer: %s' %
+                             (self.repr, tops, newer))
+            launch = tools.AgentCall(session, 'find',
+                                     {'paths': tops, 'newer': newer,
+                                      'dates': dates, 'programs': programs},
+                                     timeout, label=cmd)
+        else:
+            self.logger.info('%s: logs du-cmd: %s' % (self.repr, cmd))
+            launch = tools.ssh_node(ip=self.ip,
+                                    command=cmd,
+                                    ssh_opts=self.ssh_opts,
+                                    env_vars=self.env_vars,
+                                    timeout=timeout,
+                                    prefix=self.prefix,
+                                    defer=True)
+        outs, errs, code = yield launch
+        if code == 124:
+            self.logger.error("%s: command: %s, "
+                              "timeout code: %s, error message: %s" %
+                              (self.repr, cmd, code, errs))
+            raise tools.Return((self.log_index, None))
+        if code not in [0, 1]:
+            # find exits 1 when some of the paths do not exist
+            self.check_code(code, 'co_logs_populate', cmd, errs)
+            raise tools.Return((self.log_index, None))
+        cutoffs = {}
+        found = []
+        index = tools.LogIndex()
+        for record in outs.split('\0'):
+            fields = record.split('\t', 3)
+            if fields[0] == '#program' and len(fields) == 2:
+                found.append(fields[1])
+            elif fields[0] == '#cutoff' and len(fields) == 3:
+                cutoffs[fields[1]] = float(fields[2] or 0)
+            elif len(fields) == 4:
+                index.append(fields[3], int(fields[0]), float(fields[1]),
+                             int(fields[2]))
+        self.logs_assign(index, starts, cutoffs)
+        self.log_index = index
+        self.logger.info('%s: total logs size: %dMB' %
+                         (self.repr, index.total/1024/1024))
+        raise tools.Return((self.log_index, found if programs else None))
+
+    def logs_assign(self, index, starts, cutoffs):
+        '''Selects the files of index each logs item collects - those under
+        its path, newer than the epoch cutoffs[starts[n]] of its "start",
+        and matching its include and exclude'''
+        by_path = {}
+        for n, item in enumerate(self.logs):
+            if not item.get('skipped'):
+                by_path.setdefault(item['path'].rstrip('/'), []).append(n)
+        under = dict([(n, []) for ns in by_path.values() for n in ns])
+        # a file is under the items of its path and of its parents
+        for number, path in enumerate(index.paths):
+            while True:
+                for n in by_path.get(path, []):
+                    under[n].append(number)
+                if '/' not in path:
+                    break
+                path = path.rsplit('/', 1)[0]
+        for n in sorted(under):
+            item = self.logs[n]
+            cutoff = cutoffs.get(starts[n]) if starts[n] else None
+            include = tools.PathMatcher(item.get('include'))
+            exclude = tools.PathMatcher(item.get('exclude'))
+            selected = []
+            for number in under[n]:
+                f = index.paths[number]
+                if cutoff is not None and index.mtimes[number] <= cutoff:
+                    continue
+                if ((not include.patterns or include.search(f)) and
+                        not exclude.search(f)):
+                    selected.append(number)
                 else:
-                    for format in ['%Y-%m-%d', '%Y-%m-%d %H:%M:%S']:
-                        try:
-                            if datetime.strptime(start, format):
-                                start_str = start
-                                break
-                        except ValueError:
-                            pass
-                    if not start_str:
-                        self.logger.warning(('incorrect value of "start"'
-                                             ' parameter in "logs": "%s" -'
-                                             ' ignoring...')
-                                            % start)
-            if start_str:
-                start_param = ' -newermt "$(date -d \'%s\')"' % start_str
-            else:
-                start_param = ''
-            cmd = ("find '%s' -type f%s -exec du -b {} +" % (item['path'],
-                                                             start_param))
-            self.logger.info('%s: logs du-cmd: %s' %
-                             (self.repr, cmd))
-            outs, errs, code = tools.ssh_node(ip=self.ip,
-                                              command=cmd,
-                                              ssh_opts=self.ssh_opts,
-                                              env_vars=self.env_vars,
-                                              timeout=timeout,
-                                              prefix=self.prefix)
-            if code == 124:
-                self.logger.error("%s: command: %s, "
-                                  "timeout code: %s, error message: %s" %
-                                  (self.repr, cmd, code, errs))
-                break
-            if len(outs):
-                item['files'] = {}
-                for line in outs.split('\n'):
-                    if '\t' in line:
-                        size, f = line.split('\t')
-                        if filter_by_re(item, f):
-                            item['files'][f] = int(size)
-                        else:
-                            self.logger.debug('log file "%s" excluded' % f)
-                self.logger.debug('logs: %s' % (item['files']))
-            self.logger.info('%s: total logs size: %dMB' %
-                             (self.repr,
-                              sum(self.logs_dict().values())/1024/1024))
-        return self.logs
-
-    def logs_dict(self):
-        result = {}
-        for item in self.logs:
-            if 'files' in item:
-                for f, s in item['files'].items():
-                    if f in result:
-                        result[f] = max(result[f], s)
-                    else:
-                        result[f] = s
-        return result
+                    self.logger.debug('log file "%s" excluded' % f)
+            index.select(n, selected)
+            self.logger.debug('logs: %s: %d files' %
+                              (item['path'], index.selected(n)))
+
+    def choose_logs_codecs(self, programs):
+        '''Sets the codec of the archive tar creates on the node and, for
+        logs_compression "local", the one compressing it here'''
+        name = self.logs_compression
+        self.logs_local_codec = None
+        if name == 'local':
+            self.logs_codec = tools.codecs['none']
+            available = tools.local_programs(tools.codecs_auto)
+            self.logs_local_codec = tools.choose_codec(name, available)
+            return
+        self.logs_codec = tools.choose_codec(name, programs or [])
+        if name != 'auto' and self.logs_codec.name != name:
+            self.logger.info('%s: %s not found, compressing logs with %s' %
+                             (self.repr, name, self.logs_codec.name))
+
+    def logs_split(self):
+        '''Whether compressed files go to a separate plain archive, see
+        logs_split_compressed'''
+        return bool(self.logs_split_compressed and
+                    (self.logs_codec.program or self.logs_local_codec))
+
+    def logs_sample(self, timeout=15):
+        return tools.run_sync(self.co_logs_sample(timeout=timeout))
+
+    def co_logs_sample(self, timeout=15):
+        '''Measures how logs compress. Files are grouped by tools.log_group,
+        the start of the largest file of each of the logs_sample_files
+        largest groups is compressed on the node with the codec of the
+        archive - with gzip for logs_compression "local", scaled by the
+        ratio of the local codec.
+
+        Returns {group: compressed size / size}, empty if nothing was
+        measured.'''
+        codec = self.logs_local_codec or self.logs_codec
+        if not codec.program or not self.logs_sample_files:
+            raise tools.Return({})
+        sampler = self.logs_codec
+        if not sampler.program:
+            # the local codec may be missing on the node, gzip is not
+            sampler = tools.codecs['gzip']
+        scale = codec.ratio / sampler.ratio
+        select = tools.is_compressible if self.logs_split() else None
+        groups = self.log_index.groups(tools.log_group, select)
+        samples = sorted(groups, key=lambda g: groups[g][0], reverse=True)
+        samples = samples[:self.logs_sample_files]
+        script = ''
+        for n, group in enumerate(samples):
+            path = self.log_index.paths[groups[group][1]]
+            script += ("printf '%d\\t'; %s\n" %
+                       (n, sampler.sample_cmd(path, self.logs_sample_size)))
+        self.logger.info('%s: sampling %d files of logs with %s' %
+                         (self.repr, len(samples), sampler.name))
+        outs, errs, code = yield self.remote('bash -s', input=script,
+                                             timeout=timeout + len(samples))
+        if code != 0:
+            self.logger.warning('%s: could not sample logs, code: %s, '
+                                'error message: %s' % (self.repr, code, errs))
+            raise tools.Return({})
+        ratios = {}
+        for line in outs.splitlines():
+            try:
+                n, size, compressed = [int(x) for x in line.split('\t')]
+            except ValueError:
+                continue
+            if size and n < len(samples):
+                ratios[samples[n]] = float(compressed) / size * scale
+        raise tools.Return(ratios)
+
+    def logs_sampled_ratio(self, select=None):
+        '''Compression ratio of the files selected by select estimated from
+        logs_samples, groups which were not sampled count at the average
+        ratio of those which were. None if there are no samples.'''
+        groups = self.log_index.groups(tools.log_group, select)
+        sampled = [(groups[g][0], r) for g, r in self.logs_samples.items()
+                   if g in groups]
+        size = sum([s for s, r in sampled])
+        total = sum([s for s, n in groups.values()])
+        if not size or not total:
+            return None
+        average = sum([s * r for s, r in sampled]) / size
+        return sum([s * self.logs_samples.get(g, average)
+                    for g, (s, n) in groups.items()]) / total
+
+    def logs_archives(self, coefficient):
+        '''Expected size of the logs archives of the node - (transferred,
+        local space taken)'''
+        state = self.logs_state()
+        previous = state.load() if state else None
+        if previous:
+            size = tools.LogsDelta(self.log_index, previous).size
+            sampled = self.logs_sampled_ratio()
+            transferred = tools.codecs['gzip'].space(size, coefficient,
+                                                     sampled)
+            # the ranges stay uncompressed until they are archived
+            return transferred, size + self.logs_delta_codec().space(
+                size, coefficient, sampled)
+        size = self.log_index.total
+        transferred = 0
+        select = None
+        if self.logs_split():
+            compressed = self.log_index.size(tools.is_compressed)
+            transferred = tools.codecs['none'].space(compressed, 1)
+            size -= compressed
+            select = tools.is_compressible
+        sampled = self.logs_sampled_ratio(select)
+        transferred += self.logs_codec.space(size, coefficient, sampled)
+        space = transferred
+        if self.logs_local_codec:
+            # the uncompressed archive stays until it is compressed
+            space += self.logs_local_codec.space(size, coefficient, sampled)
+        return transferred, space
+
+    def budget_skip_logs(self):
+        '''Marks logs items the time budget does not admit as skipped'''
+        for n, item in enumerate(self.logs):
+            if 'skipped' not in item:
+                priority = int(item.get('priority', 0))
+                unit = 'logs %s' % item['path']
+                item['skipped'] = not self.budget_admits('get_logs', unit,
+                                                         priority)
+                if item['skipped']:
+                    self.log_index.discard(n)
+
+    def logs_admitted(self, target, args):
+        return tools.run_sync(self.co_logs_admitted(target, args))
+
+    def co_logs_admitted(self, target, args):
+        '''Runs the coroutine co_<target> archiving logs once the time
+        budget admitted them, see NodeManager.logs_run_items'''
+        self.budget_skip_logs()
+        if not self.log_index.count:
+            self.logger.info('%s: no logs to collect' % self.repr)
+            raise tools.Return(None)
+        result = yield getattr(self, 'co_%s' % target)(**args)
+        raise tools.Return(result)
 
     def check_code(self, code, func_name, cmd, err, ok_codes=None):
         if code:
@@ -545,6 +1200,8 @@ class Node(object):
 
 class NodeManager(object):
     """Class NodeManager """
+    # phases whose deadline is capped by the time budget
+    budget_phases = ['calculate_log_size', 'get_files', 'get_logs']
 
     @staticmethod
     def load_conf(filename):
@@ -573,9 +1230,33 @@ class NodeManager(object):
             if conf['dir_timestamp']:
                 conf['outdir'] += timestamp_str
                 conf['archive_dir'] += timestamp_str
-        if conf['clean']:
+        if conf['clean'] and not conf['resume']:
             shutil.rmtree(conf['outdir'], ignore_errors=True)
+        self.ssh_control_dir = None
+        # the masters and the directory must not outlive a failed run
+        self.pid = os.getpid()
+        atexit.register(self.cleanup)
+        if conf['ssh_multiplex']:
+            self.ssh_control_dir = tools.ssh_control_dir()
+            conf['ssh_opts'] = (conf['ssh_opts'] +
+                                tools.ssh_multiplex_opts(
+                                    self.ssh_control_dir,
+                                    conf['ssh_control_persist']))
+        self.throttle = None
+        self.speed = None
+        if conf['logs_speed_limit']:
+            self.throttle = throttle.Throttle()
+            conf['ssh_opts'] = conf['ssh_opts'] + self.throttle.ssh_opts()
+        self.durations = tools.DurationHistory(conf['duration_history'])
+        tools.retries.configure(conf['retry_policy'])
+        tools.budget.start(conf['time_budget'])
         tools.mdir(conf['outdir'])
+        if conf['files_incremental']:
+            self.check_files_cache()
+        journal_filename = '%s_journal.jsonl' % project_name
+        self.journal = tools.Journal(os.path.join(conf['outdir'],
+                                                  journal_filename),
+                                     resume=conf['resume'])
         version_filename = '%s_version.txt' % project_name
         version_filepath = os.path.join(conf['outdir'], version_filename)
         with open(version_filepath, 'a') as f:
@@ -593,6 +1274,17 @@ class NodeManager(object):
                 self.import_rq()
         self.nodes = {}
 
+    def check_files_cache(self):
+        '''The copy in files_cache_dir is hardlinked from outdir and back,
+        across filesystems rsync would silently copy every file instead'''
+        cache_dir = self.conf['files_cache_dir']
+        tools.mdir(cache_dir)
+        if os.stat(cache_dir).st_dev != os.stat(self.conf['outdir']).st_dev:
+            self.logger.critical('files_cache_dir %s is not on the same '
+                                 'filesystem as outdir %s' %
+                                 (cache_dir, self.conf['outdir']))
+            print_and_exit(114)
+
     def apply_soft_filter(self):
         # apply soft-filter on all nodes
         for node in self.nodes.values():
@@ -600,9 +1292,60 @@ class NodeManager(object):
                 node.skipped = True
 
     def post_init(self):
+        for node in self.nodes.values():
+            node.journal = self.journal
         self.nodes_reapply_conf()
         self.apply_soft_filter()
         self.conf_assign_once()
+        self.throttle_start()
+
+    def throttle_start(self):
+        '''Sets the rate all transfers from and to nodes share - 90% of
+        logs_speed, or of the speed of the interface nodes are reached
+        through'''
+        if not self.throttle:
+            return
+        self.check_ssh_proxy()
+        speed = self.transfer_speed()
+        self.logger.info('limiting transfers to %d Mbit/s' % speed)
+        # Mbit/s to bytes/s
+        self.throttle.set_rate(speed * 125000)
+
+    def check_ssh_proxy(self):
+        '''The throttle is the ProxyCommand of ssh, which would replace the
+        proxy nodes are reached through, or be ignored after one in
+        ssh_opts'''
+        own = self.throttle.ssh_opts()
+        checked = set()
+        for node in self.selected_nodes.values():
+            if node.ip in ['localhost', '127.0.0.1'] or node.ip.startswith(
+                    '127.'):
+                continue
+            ssh_opts = [o for o in w_list(node.ssh_opts) if o not in own]
+            key = (node.ip, tuple(ssh_opts))
+            if key in checked:
+                continue
+            checked.add(key)
+            proxy = tools.ssh_proxy(node.ip, ssh_opts)
+            if proxy:
+                self.logger.critical('%s is reached through %s, which '
+                                     'logs_speed_limit can not be combined '
+                                     'with' % (node.repr, proxy))
+                print_and_exit(115)
+
+    def transfer_speed(self):
+        '''Mbit/s transfers from and to nodes are expected to reach - 90%
+        of logs_speed, or of the speed of the interface nodes are reached
+        through'''
+        if self.speed is None:
+            if self.conf['logs_speed'] > 0:
+                self.speed = self.conf['logs_speed']
+            else:
+                self.speed = self.find_adm_interface_speed()
+                # virtual interfaces report -1, or 0 when unknown
+                if not self.speed or self.speed <= 0:
+                    self.speed = self.conf['logs_speed_default']
+        return self.speed * 0.9
 
     def __str__(self):
         def ml_column(matrix, i):
@@ -738,12 +1481,134 @@ class NodeManager(object):
         for node in self.nodes.values():
             node.apply_conf(self.conf)
 
+    def run_batch(self, run_items, maxthreads, dict_result=False,
+                  phase=None):
+        '''Runs items with tools.run_batch, or with tools.run_batch_async
+        if async_engine is enabled and all items provide a coroutine.
+        Commands launched by the items share the phase deadline, if one is
+        configured in phase_timeouts.'''
+        if phase:
+            run_items = self.longest_first(run_items, phase)
+        phase_timeout = self.phase_timeouts().get(phase)
+        tools.deadlines.set_phase(phase, phase_timeout)
+        limiter = None
+        if self.conf['adaptive_concurrency'] and len(run_items) > 1:
+            limiter = tools.AdaptiveLimit(maxthreads,
+                                          max_load=self.conf['adaptive_load'])
+        try:
+            if (self.conf['async_engine'] and not self.conf['agent'] and
+                    all([i.coroutine for i in run_items])):
+                return tools.run_batch_async(run_items, maxthreads,
+                                             dict_result=dict_result,
+                                             limiter=limiter)
+            return tools.run_batch(run_items, maxthreads,
+                                   dict_result=dict_result, limiter=limiter,
+                                   hedge=self.conf['hedge'])
+        finally:
+            tools.deadlines.set_phase(None)
+            if limiter:
+                limiter.log_curve(phase)
+            if phase:
+                self.record_durations(run_items)
+
+    def phase_timeouts(self):
+        '''phase_timeouts, with phases which move files around limited by
+        what is left of the time budget. Commands and scripts are not
+        limited - the budget only stops starting low-priority ones, see
+        Node.budget_admits.'''
+        timeouts = dict(self.conf['phase_timeouts'])
+        left = tools.budget.left()
+        if left is not None and left > 0:
+            for phase in self.budget_phases:
+                timeouts[phase] = min(timeouts.get(phase) or left, left)
+        return timeouts
+
+    def expected_duration(self, item):
+        '''Sort key of an item - its duration in previous runs, or, for
+        items never seen before, the amount of work known upfront'''
+        duration = self.durations.expected(item.phase, item.key)
+        if duration is not None:
+            return (0, duration)
+        size = 0
+        node = self.nodes.get(item.key)
+        if node and item.phase == 'get_logs':
+            size = node.log_index.total
+        # unknown items go first, they may as well be the slowest
+        return (1, size)
+
+    def expected_chain_duration(self, chain):
+        keys = [self.expected_duration(item) for item in chain]
+        unknown = max([k[0] for k in keys] or [0])
+        return (unknown, sum([k[1] for k in keys if k[0] == unknown]))
+
+    def longest_first(self, run_items, phase):
+        '''Orders items longest-expected-first, which keeps slow nodes from
+        starting last and becoming the tail of the phase'''
+        for item in run_items:
+            item.phase = item.phase or phase
+        return sorted(run_items, key=self.expected_duration, reverse=True)
+
+    def record_durations(self, run_items):
+        for item in run_items:
+            if item.key is not None and item.duration is not None:
+                self.durations.record(item.phase, item.key, item.duration)
+        self.durations.save()
+
+    def report_deadlines(self):
+        '''Logs commands which were killed by a deadline or timed out'''
+        expired = tools.deadlines.pop_expired()
+        for e in expired:
+            deadline = 'timeout %ss' % e['timeout']
+            if e['by_phase']:
+                deadline = 'phase deadline'
+            self.logger.warning('deadline hit: %s, phase: %s, by %s, '
+                                'finished %.1fs after the deadline' %
+                                (e['label'], e['phase'], deadline,
+                                 e['late']))
+        if expired:
+            self.logger.warning('%d commands hit their deadline' %
+                                len(expired))
+        return expired
+
+    def report_transfer_rates(self):
+        '''Logs the effective transfer rate of each node when transfers
+        are limited, returns {ip: (bytes, Mbit/s)}'''
+        if not self.throttle:
+            return {}
+        rates = {}
+        for host, (size, seconds) in sorted(self.throttle.rates().items()):
+            rate = size * 8 / 1000000.0 / seconds if seconds > 0 else 0
+            rates[host] = (size, rate)
+            self.logger.info('%s: transferred %dMB at %.1f Mbit/s' %
+                             (host, size/1024/1024, rate))
+        self.close_throttle()
+        return rates
+
+    def close_throttle(self):
+        if self.throttle:
+            self.throttle.close()
+            self.throttle = None
+
+    def report_skipped(self):
+        '''Logs work which was skipped to stay within the time budget'''
+        skipped = self.journal.skipped()
+        for record in skipped:
+            self.logger.warning('skipped by %s: %s: %s, phase: %s' %
+                                (record['skipped'], record['node'],
+                                 record['unit'], record['phase']))
+        if skipped:
+            self.logger.warning('%d units of work skipped' % len(skipped))
+        return skipped
+
     def nodes_get_os(self):
         run_items = []
         for key, node in self.selected_nodes.items():
             if not node.os_platform:
-                run_items.append(tools.RunItem(target=node.get_os, key=key))
-        result = tools.run_batch(run_items, self.maxthreads, dict_result=True)
+                run_items.append(tools.RunItem(target=node.get_os,
+                                               coroutine=node.co_get_os,
+                                               key=key, idempotent=True))
+        result = self.run_batch(run_items, self.maxthreads, dict_result=True,
+                                phase='get_os')
         for key in result:
             if result[key]:
                 self.nodes[key].os_platform = result[key]
@@ -753,8 +1618,10 @@ class NodeManager(object):
         run_items = []
         for key, node in self.selected_nodes.items():
             run_items.append(tools.RunItem(target=node.check_access,
-                                           key=key))
-        result = tools.run_batch(run_items, self.maxthreads, dict_result=True)
+                                           coroutine=node.co_check_access,
+                                           key=key, idempotent=True))
+        result = self.run_batch(run_items, self.maxthreads, dict_result=True,
+                                phase='check_access')
         for key in result:
             self.nodes[key].accessible = result[key]
 
@@ -790,9 +1657,11 @@ class NodeManager(object):
         run_items = []
         for key, node in self.selected_nodes.items():
             run_items.append(tools.RunItem(target=node.exec_cmd,
+                                           coroutine=node.co_exec_cmd,
                                            args={'fake': fake},
                                            key=key))
-        result = tools.run_batch(run_items, self.maxthreads, dict_result=True)
+        result = self.run_batch(run_items, self.maxthreads, dict_result=True,
+                                phase='run_commands')
         for key in result:
             self.nodes[key].mapcmds = result[key][0]
             self.nodes[key].mapscr = result[key][1]
@@ -802,13 +1671,30 @@ class NodeManager(object):
         run_items = []
         for key, node in self.selected_nodes.items():
             run_items.append(tools.RunItem(target=node.logs_populate,
+                                           coroutine=node.co_logs_populate,
                                            args={'timeout': timeout},
-                                           key=key))
-        result = tools.run_batch(run_items, self.maxthreads, dict_result=True)
+                                           key=key, idempotent=True))
+        result = self.run_batch(run_items, self.maxthreads, dict_result=True,
+                                phase='calculate_log_size')
         for key in result:
-            self.nodes[key].logs = result[key]
+            if result[key] is not None:
+                index, programs = result[key]
+                self.nodes[key].log_index = index
+                self.nodes[key].choose_logs_codecs(programs)
+        run_items = []
+        for key, node in self.selected_nodes.items():
+            node.logs_samples = {}
+            if node.log_index.count and node.logs_sample_files:
+                run_items.append(tools.RunItem(target=node.logs_sample,
+                                               coroutine=node.co_logs_sample,
+                                               args={'timeout': timeout},
+                                               key=key, idempotent=True))
+        result = self.run_batch(run_items, self.maxthreads, dict_result=True,
+                                phase='calculate_log_size')
+        for key in result:
+            self.nodes[key].logs_samples = result[key] or {}
         for node in self.selected_nodes.values():
-            total_size += sum(node.logs_dict().values())
+            total_size += node.log_index.total
         self.logger.info('Full log size on nodes(with fuel): %d bytes' %
                          total_size)
         self.alogsize = total_size
@@ -828,16 +1714,34 @@ class NodeManager(object):
                               outs)
             return False
         coeff = self.conf['logs_size_coefficient']
-        self.logger.info('logsize: %dMB * %s, free space: %dMB' %
-                         (self.alogsize/1024/1024, coeff, fs/1024))
-        if (self.alogsize*coeff > fs*1024):
-            self.logger.error('Not enough space in "%s", logsize: %dMB * %s, '
-                              'available: %dMB. Decrease logs_size_coefficient'
-                              ' config parameter (--logs-coeff CLI parameter)'
-                              ' or free up space.' % (self.conf['archive_dir'],
-                                                      self.alogsize/1024/1024,
-                                                      coeff,
-                                                      fs/1024))
+        nodes = self.selected_nodes.values()
+        archives = [node.logs_archives(coeff) for node in nodes]
+        space = sum([a[1] for a in archives])
+        transferred = sum([a[0] for a in archives])
+        sampled = len([node for node in nodes if node.logs_samples])
+        self.logs_archives_size = space
+        self.logs_eta = None
+        eta = ''
+        # transfers only run at a known speed when they are limited
+        if self.throttle:
+            # Mbit/s to bytes/s
+            self.logs_eta = transferred / (self.transfer_speed() * 125000)
+            eta = ', transfer time: %ds' % self.logs_eta
+        self.logger.info('logsize: %dMB, archives: %dMB (compression sampled'
+                         ' on %d of %d nodes, logs_size_coefficient %s for '
+                         'the rest), free space: %dMB%s' %
+                         (self.alogsize/1024/1024, space/1024/1024, sampled,
+                          len(nodes), coeff, fs/1024, eta))
+        if (space > fs*1024):
+            self.logger.error('Not enough space in "%s", logsize: %dMB, '
+                              'archives: %dMB, available: %dMB. Choose a '
+                              'stronger logs_compression, free up space or, '
+                              'for nodes whose compression was not sampled, '
+                              'decrease logs_size_coefficient config '
+                              'parameter (--logs-coeff CLI parameter).' %
+                              (self.conf['archive_dir'],
+                               self.alogsize/1024/1024, space/1024/1024,
+                               fs/1024))
             return False
         else:
             return True
@@ -878,54 +1782,177 @@ class NodeManager(object):
         if fake:
             self.logger.info('fake = True, skipping')
             return
-        if self.conf['logs_speed_limit']:
-            if self.conf['logs_speed'] > 0:
-                speed = self.conf['logs_speed']
-            else:
-                speed = self.find_adm_interface_speed()
-            speed = int(speed * 0.9 / min(self.logs_maxthreads,
-                                          len(self.nodes)))
-            py_slowpipe = tools.slowpipe % speed
-            limitcmd = "| python -c '%s'; exit ${PIPESTATUS}" % py_slowpipe
-        run_items = []
+        if tools.budget.tight():
+            self.budget_truncate_logs()
+        run_items = self.logs_run_items(timeout).values()
+        self.run_batch(run_items, self.logs_maxthreads, phase='get_logs')
+
+    def budget_truncate_logs(self):
+        '''Lists logs again, only those of the last time_budget_logs_days
+        days, see Node.co_logs_populate'''
+        days = self.conf['time_budget_logs_days']
+        self.logger.warning('time budget: collecting only logs of the last '
+                            '%d days' % days)
+        self.calculate_log_size()
         for node in self.selected_nodes.values():
-            if not node.logs_dict():
+            self.journal.record(node.ip, 'get_logs',
+                                'logs older than %d days' % days, False,
+                                skipped='time budget')
+
+    def logs_run_items(self, timeout, admit_later=False):
+        '''Returns {node key: RunItem} archiving logs of each node which
+        has any - with logs_incremental, of what changed since the previous
+        run, for nodes collected before. With admit_later the time budget
+        is checked by each item as it starts, see Node.co_logs_admitted,
+        instead of now.'''
+        run_items = self.logs_items(timeout, admit_later)
+        if admit_later:
+            for key, item in run_items.items():
+                node = self.nodes[key]
+                name = item.target.__name__
+                item.args = {'target': name, 'args': item.args}
+                item.target = node.logs_admitted
+                item.coroutine = node.co_logs_admitted
+        return run_items
+
+    def logs_items(self, timeout, admit_later):
+        run_items = {}
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        for key, node in self.selected_nodes.items():
+            if not admit_later:
+                node.budget_skip_logs()
+            if not node.log_index:
                 self.logger.info(("%s: no logs to collect") % node.repr)
                 continue
-            node.archivelogsfile = os.path.join(self.conf['archive_dir'],
-                                                'logs-%s.tar.gz' % node.repr)
+            base = os.path.join(self.conf['archive_dir'],
+                                'logs-%s' % node.repr)
+            state = node.logs_state()
+            previous = state.load() if state else None
+            if previous:
+                tools.mdir(self.conf['archive_dir'])
+                node.archivelogsfile = node.logs_delta_codec().filename(
+                    '%s-delta-%s' % (base, stamp))
+                run_items[key] = tools.RunItem(
+                    target=node.archive_logs_delta,
+                    coroutine=node.co_archive_logs_delta,
+                    args={'timeout': timeout,
+                          'outfile': node.archivelogsfile,
+                          'previous': previous},
+                    key=key, phase='get_logs')
+                continue
+            if state:
+                # timmy-logs-merge tells which deltas came after it
+                base = '%s-full-%s' % (base, stamp)
+            codec = node.logs_local_codec or node.logs_codec
+            node.archivelogsfile = codec.filename(base)
+            if (self.journal.done(node.ip, 'get_logs', 'logs') and
+                    os.path.exists(node.archivelogsfile)):
+                self.logger.info('%s: logs already collected' % node.repr)
+                continue
             tools.mdir(self.conf['archive_dir'])
-            input = ''
-            for fn in node.logs_dict():
-                input += '%s\0' % fn.lstrip(os.path.abspath(os.sep))
-            cmd = ("tar --transform 's,^,%s/,' --gzip -C %s --create "
-                   "--warning=no-file-changed --file - --null --files-from -" %
-                   (node.repr, os.path.abspath(os.sep)))
-            if self.conf['logs_speed_limit']:
-                if not (node.ip == 'localhost' or node.ip.startswith('127.')):
-                    cmd = ' '.join([cmd, limitcmd])
-            args = {'cmd': cmd,
+            root = os.path.abspath(os.sep)
+            threads = self.conf['logs_compression_threads']
+
+            def tar_cmd(codec):
+                return ("tar --transform 's,^,%s/,' %s -C %s --create "
+                        "--warning=no-file-changed --file - --null "
+                        "--files-from -" %
+                        (node.repr, codec.tar_option(threads), root))
+
+            select = None
+            if node.logs_split():
+                select = tools.is_compressible
+                plain = tools.codecs['none']
+                p_input = tools.NulList(node.log_index, lstrip=root,
+                                        select=tools.is_compressed)
+                p_outfile = plain.filename('%s-compressed' % base)
+            input = tools.NulList(node.log_index, lstrip=root, select=select)
+            args = {'cmd': tar_cmd(node.logs_codec),
                     'timeout': timeout,
                     'outfile': node.archivelogsfile,
-                    'input': input,
-                    'ok_codes': [0, 1]}
-            run_items.append(tools.RunItem(target=node.exec_simple_cmd,
-                                           args=args))
-        tools.run_batch(run_items, self.logs_maxthreads)
+                    'input': input}
+            if node.logs_local_codec:
+                args['outfile'] = node.logs_codec.filename(base)
+                args['compress'] = node.logs_local_codec.compress_cmd(
+                    args['outfile'], threads)
+            if select:
+                args['plain'] = (tar_cmd(plain), p_outfile, p_input)
+            run_items[key] = tools.RunItem(target=node.archive_logs,
+                                           coroutine=node.co_archive_logs,
+                                           args=args, key=key,
+                                           phase='get_logs')
+        return run_items
 
     @run_with_lock
     def get_files(self, timeout=15):
         run_items = []
-        for node in self.selected_nodes.values():
-            run_items.append(tools.RunItem(target=node.get_files))
-        tools.run_batch(run_items, 10)
+        for key, node in self.selected_nodes.items():
+            run_items.append(tools.RunItem(target=node.get_files,
+                                           coroutine=node.co_get_files,
+                                           key=key))
+        self.run_batch(run_items, 10, phase='get_files')
 
     @run_with_lock
     def put_files(self):
         run_items = []
-        for node in self.selected_nodes.values():
-            run_items.append(tools.RunItem(target=node.put_files))
-        tools.run_batch(run_items, 10)
+        for key, node in self.selected_nodes.items():
+            run_items.append(tools.RunItem(target=node.put_files,
+                                           coroutine=node.co_put_files,
+                                           key=key))
+        self.run_batch(run_items, 10, phase='put_files')
+
+    @run_with_lock
+    def run_pipeline(self, fake=False, logs=False, logs_timeout=None,
+                     fake_logs=False):
+        '''Moves every node through put_files -> commands and scripts ->
+        files and filelists -> logs on its own, instead of waiting for all
+        nodes to finish a phase before any node starts the next one.
+        maxthreads limits the amount of nodes processed at once,
+        put_files and get_files still run on at most 10 nodes and logs
+        are collected from at most logs_maxthreads nodes at a time.'''
+        log_items = {}
+        if logs and not fake_logs:
+            # nodes get to logs at different times, the time budget is
+            # checked when they do
+            log_items = self.logs_run_items(logs_timeout, admit_later=True)
+        chains = []
+        keys = []
+        for key, node in self.selected_nodes.items():
+            chain = []
+            if self.has(Node.pkey):
+                chain.append(tools.RunItem(target=node.put_files, key=key,
+                                           phase='put_files'))
+            if self.has(Node.ckey, Node.skey):
+                chain.append(tools.RunItem(target=node.exec_cmd,
+                                           args={'fake': fake}, key=key,
+                                           phase='run_commands'))
+            if self.has(Node.fkey, Node.flkey):
+                chain.append(tools.RunItem(target=node.get_files, key=key,
+                                           phase='get_files'))
+            if key in log_items:
+                chain.append(log_items[key])
+            chains.append(chain)
+            keys.append(key)
+        # longest-expected node pipelines first
+        order = sorted(range(len(chains)), reverse=True,
+                       key=lambda c: self.expected_chain_duration(chains[c]))
+        chains = [chains[c] for c in order]
+        keys = [keys[c] for c in order]
+        phase_limits = {'put_files': 10,
+                        'get_files': 10,
+                        'get_logs': self.logs_maxthreads}
+        tools.deadlines.start_phases(self.phase_timeouts())
+        try:
+            results = tools.run_chains(chains, self.maxthreads,
+                                       phase_limits=phase_limits)
+        finally:
+            tools.deadlines.start_phases({})
+            self.record_durations(sum(chains, []))
+        for key, chain, result in zip(keys, chains, results):
+            for position, item in enumerate(chain):
+                if item.phase == 'run_commands' and position in result:
+                    self.nodes[key].mapcmds = result[position][0]
+                    self.nodes[key].mapscr = result[position][1]
 
     @run_with_lock
     def run_scripts_all_pairs(self, fake=False):
@@ -964,6 +1991,29 @@ class NodeManager(object):
             tools.run_batch(run_client_items, len(run_client_items))
         tools.run_batch(run_server_stop_items, self.maxthreads)
 
+    def cleanup(self):
+        '''Called at exit, releases what a run interrupted by an error or a
+        signal did not'''
+        if os.getpid() != self.pid:
+            return
+        self.close_ssh_masters()
+        # after the masters, whose ProxyCommand relays use the throttle
+        self.close_throttle()
+
+    def close_ssh_masters(self):
+        '''Tear down SSH master connections opened during the run'''
+        if not self.ssh_control_dir:
+            return
+        run_items = []
+        for socket_name in os.listdir(self.ssh_control_dir):
+            path = os.path.join(self.ssh_control_dir, socket_name)
+            self.logger.debug('closing ssh master connection %s' % path)
+            run_items.append(tools.RunItem(target=tools.ssh_master_exit,
+                                           args={'control_path': path}))
+        tools.run_batch(run_items, self.maxthreads)
+        shutil.rmtree(self.ssh_control_dir, ignore_errors=True)
+        self.ssh_control_dir = None
+
     def has(self, *keys):
         nodes = {}
         for k in keys:
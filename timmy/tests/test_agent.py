@@ -0,0 +1,75 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import json
+import os
+import signal
+import unittest
+from StringIO import StringIO
+from timmy import agent
+
+
+class Out(StringIO):
+    def frames(self):
+        inp = StringIO(self.getvalue())
+        while True:
+            meta, body = agent.read_frame(inp)
+            if meta is None:
+                return
+            yield meta, body
+
+
+class RunTest(unittest.TestCase):
+    def setUp(self):
+        signal.alarm(60)
+        # the session input, nothing arrives while a command runs
+        self.r, self.w = os.pipe()
+        self.inp = os.fdopen(self.r)
+
+    def tearDown(self):
+        signal.alarm(0)
+        self.inp.close()
+        os.close(self.w)
+
+    def test_script_output(self):
+        # bash reads the script as it runs it, while its output is waiting
+        # to be read
+        script = ''.join(['printf "%%01000d\\n" %d\n' % i
+                          for i in range(20000)])
+        out = Out()
+        agent.run(self.inp, out, {'cmd': 'bash -s', 'timeout': 30}, script)
+        frames = list(out.frames())
+        self.assertEqual(frames[-1][0]['type'], 'end')
+        self.assertEqual(frames[-1][0]['code'], 0)
+        self.assertEqual(sum([len(body) for meta, body in frames
+                              if meta['type'] == 'out']), 20000 * 1001)
+
+    def test_timeout(self):
+        out = Out()
+        agent.run(self.inp, out, {'cmd': 'sleep 30', 'timeout': 1}, '')
+        meta, body = list(out.frames())[-1]
+        self.assertEqual(meta['code'], 124)
+
+
+class FactsTest(unittest.TestCase):
+    def test_facts(self):
+        out = Out()
+        agent.facts(None, out, {}, '')
+        frames = list(out.frames())
+        self.assertEqual(json.loads(frames[0][1]).keys(), ['os'])
+        self.assertEqual(frames[-1][0], {'type': 'end', 'code': 0})
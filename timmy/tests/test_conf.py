@@ -28,7 +28,10 @@ class ConfTest(unittest.TestCase):
             'soft_filter': dict,
             'ssh_opts': list,
             'env_vars': list,
+            'ssh_multiplex': bool,
+            'ssh_control_persist': int,
             'timeout': int,
+            'phase_timeouts': dict,
             'prefix': str,
             'rqdir': str,
             'rqfile': list,
@@ -43,6 +46,8 @@ class ConfTest(unittest.TestCase):
             'scripts': list,
             'files': list,
             'filelists': list,
+            'files_incremental': bool,
+            'files_cache_dir': str,
             'logs': list,
             'logs_no_default': bool,
             'logs_days': int,
@@ -50,9 +55,30 @@ class ConfTest(unittest.TestCase):
             'logs_speed_default': int,
             'logs_speed': int,
             'logs_size_coefficient': float,
+            'logs_compression': str,
+            'logs_compression_threads': int,
+            'logs_sample_files': int,
+            'logs_sample_size': int,
+            'logs_split_compressed': bool,
+            'logs_incremental': bool,
+            'logs_state_dir': str,
             'shell_mode': bool,
             'do_print_results': bool,
-            'clean': bool
+            'clean': bool,
+            'resume': bool,
+            'async_engine': bool,
+            'adaptive_concurrency': bool,
+            'adaptive_load': float,
+            'pipeline': bool,
+            'duration_history': str,
+            'batch_exec': bool,
+            'retry_policy': dict,
+            'hedge': bool,
+            'time_budget': int,
+            'time_budget_logs_days': int,
+            'priorities': dict,
+            'agent': bool,
+            'stderr_limit': int
         }
         config = conf.init_default_conf()
         for key in param_types:
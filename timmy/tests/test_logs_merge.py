@@ -0,0 +1,177 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import json
+import logging
+import os
+import shutil
+import signal
+import tarfile
+import tempfile
+import unittest
+from timmy import logs_merge
+from timmy import tools
+
+NODE = 'node-1'
+
+
+def write(path, data, mode='w'):
+    with open(path, mode) as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+class MergeTest(unittest.TestCase):
+    def setUp(self):
+        signal.alarm(60)
+        logging.disable(logging.CRITICAL)
+        self.dir = tempfile.mkdtemp()
+        self.logs = os.path.join(self.dir, 'logs')
+        self.mirror = os.path.join(self.dir, 'mirror')
+        os.mkdir(self.logs)
+
+    def tearDown(self):
+        signal.alarm(0)
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.logs, name)
+
+    def index(self):
+        index = tools.LogIndex()
+        numbers = []
+        for name in sorted(os.listdir(self.logs)):
+            st = os.stat(self.path(name))
+            numbers.append(index.append(self.path(name), st.st_size,
+                                        st.st_mtime, st.st_ino))
+        index.select('logs', numbers)
+        return index
+
+    def full_archive(self, stamp=None):
+        '''Archive of the logs as co_archive_logs lays it out'''
+        name = NODE if stamp is None else '%s-full-%s' % (NODE, stamp)
+        filename = os.path.join(self.dir, 'logs-%s.tar.gz' % name)
+        with tarfile.open(filename, 'w:gz') as tar:
+            tar.add(self.logs, os.path.join(NODE, self.logs.lstrip(os.sep)))
+        return filename
+
+    def delta_archive(self, previous, stamp='20260101-000000'):
+        '''Archive of what changed as co_archive_logs_delta makes it'''
+        delta = tools.LogsDelta(self.index(), previous)
+        staging = tempfile.mkdtemp(dir=self.dir)
+        sink = delta.sink(os.path.join(staging, NODE))
+        outs, errs, code = tools.launch_cmd('bash -s', 30,
+                                            input=delta.script(), sink=sink)
+        self.assertEqual(code, 0)
+        manifest = '%s%s' % (NODE, logs_merge.MANIFEST)
+        write(os.path.join(staging, manifest),
+              json.dumps(delta.manifest(sink.read)))
+        filename = os.path.join(self.dir,
+                                'logs-%s-delta-%s.tar' % (NODE, stamp))
+        with tarfile.open(filename, 'w') as tar:
+            tar.add(os.path.join(staging, manifest), manifest)
+            tar.add(os.path.join(staging, NODE), NODE)
+        return filename, delta.state(sink.read)
+
+    def assertMirrored(self):
+        mirrored = os.path.join(self.mirror, NODE, self.logs.lstrip(os.sep))
+        self.assertEqual(sorted(os.listdir(mirrored)),
+                         sorted(os.listdir(self.logs)))
+        for name in os.listdir(self.logs):
+            self.assertEqual(read(os.path.join(mirrored, name)),
+                             read(self.path(name)), name)
+
+    def test_full_and_delta(self):
+        write(self.path('grown.log'), 'a' * 1000)
+        write(self.path('rotated.log'), 'b' * 1000)
+        write(self.path('truncated.log'), 'c' * 1000)
+        write(self.path('same.log'), 'd' * 1000)
+        full = self.full_archive()
+        state = tools.log_state(self.index())
+        write(self.path('grown.log'), 'A' * 100, 'a')
+        os.rename(self.path('rotated.log'), self.path('rotated.log.1'))
+        write(self.path('rotated.log.1'), 'B' * 100, 'a')
+        write(self.path('rotated.log'), 'new')
+        write(self.path('truncated.log'), 'C' * 10)
+        write(self.path('added.log'), 'E' * 10)
+        delta, state = self.delta_archive(state)
+        # archives are applied in the order they were collected, whatever
+        # the order of the arguments
+        code = logs_merge.main(['timmy-logs-merge', self.mirror, delta,
+                                full])
+        self.assertEqual(code, 0)
+        self.assertMirrored()
+        # another delta on top of the first one
+        write(self.path('rotated.log'), 'more', 'a')
+        write(self.path('grown.log'), 'F' * 10, 'a')
+        delta, state = self.delta_archive(state)
+        code = logs_merge.main(['timmy-logs-merge', self.mirror, delta])
+        self.assertEqual(code, 0)
+        self.assertMirrored()
+
+    def test_delta_without_full(self):
+        write(self.path('grown.log'), 'a' * 1000)
+        state = tools.log_state(self.index())
+        write(self.path('grown.log'), 'A' * 100, 'a')
+        delta, state = self.delta_archive(state)
+        code = logs_merge.main(['timmy-logs-merge', self.mirror, delta])
+        self.assertEqual(code, 1)
+
+    def test_state_lost(self):
+        write(self.path('grown.log'), 'a' * 1000)
+        write(self.path('gone.log'), 'g' * 10)
+        full = self.full_archive('20260101-000000')
+        state = tools.log_state(self.index())
+        write(self.path('grown.log'), 'A' * 100, 'a')
+        old_delta, state = self.delta_archive(state, '20260102-000000')
+        # the state is lost, the next run makes a full archive again
+        write(self.path('grown.log'), 'x' * 2000)
+        os.remove(self.path('gone.log'))
+        new_full = self.full_archive('20260103-000000')
+        state = tools.log_state(self.index())
+        write(self.path('grown.log'), 'y' * 10, 'a')
+        new_delta, state = self.delta_archive(state, '20260104-000000')
+        archives = [new_delta, old_delta, new_full, full]
+        self.assertEqual(logs_merge.merge_order(archives),
+                         [new_full, new_delta])
+        code = logs_merge.main(['timmy-logs-merge', self.mirror] + archives)
+        self.assertEqual(code, 0)
+        self.assertMirrored()
+
+    def test_order(self):
+        archives = ['logs-node-1-full-20260103-000000.tar.gz',
+                    'logs-node-1-full-20260103-000000-compressed.tar',
+                    'logs-node-1-delta-20260104-000000.tar.zst',
+                    'logs-node-1-delta-20260102-000000.tar.zst',
+                    'logs-node-1-20-full-20260101-000000.tar.gz',
+                    'logs-node-1-20-delta-20260102-000000.tar.zst',
+                    'logs-node-2.tar.gz',
+                    'logs-node-2-delta-20260101-000000.tar.gz']
+        self.assertEqual(logs_merge.merge_order(archives),
+                         ['logs-node-2.tar.gz',
+                          'logs-node-1-20-full-20260101-000000.tar.gz',
+                          'logs-node-2-delta-20260101-000000.tar.gz',
+                          'logs-node-1-20-delta-20260102-000000.tar.zst',
+                          'logs-node-1-full-20260103-000000-compressed.tar',
+                          'logs-node-1-full-20260103-000000.tar.gz',
+                          'logs-node-1-delta-20260104-000000.tar.zst'])
@@ -0,0 +1,545 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import logging
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import unittest
+from timmy import conf
+from timmy import nodes
+from timmy import tools
+
+
+def node(ip='10.0.0.1', **attrs):
+    n = nodes.Node(ip=ip, conf=conf.init_default_conf())
+    for k, v in attrs.items():
+        setattr(n, k, v)
+    return n
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def run(coroutine, results):
+    '''Drives a node coroutine with results instead of running what it
+    launches, returns (launches, result). A result may be a function of
+    the launch.'''
+    launches = []
+    value = None
+    try:
+        while True:
+            launches.append(coroutine.send(value))
+            value = results[len(launches) - 1]
+            if callable(value):
+                value = value(launches[-1])
+    except tools.Return as r:
+        return launches, r.value
+
+
+class LogsPopulateTest(unittest.TestCase):
+    find = ['250\t250\t1\t/var/log/syslog',
+            '10\t150\t2\t/var/log/old',
+            '10\t400\t3\t/var/log/a.gz',
+            '10\t350\t4\t/var/log/nova/api.log',
+            '10\t350\t5\t/var/log/nova/conductor.log',
+            '10\t250\t6\t/var/log/nova/api.log.1',
+            '10\t400\t7\t/var/log/novaX/api.log',
+            '10\t400\t8\t/var/log/tab\tand\nnewline.log',
+            '#cutoff\t2016-01-01\t100',
+            '#cutoff\t2016-01-02\t200',
+            '#cutoff\t2016-01-03\t300',
+            '#program\tzstd',
+            '']
+
+    def test_assign(self):
+        logs = [{'path': '/var/log', 'exclude': [r'\.gz$'],
+                 'start': '2016-01-02'},
+                {'path': '/var/log/nova/', 'include': ['api'],
+                 'start': '2016-01-03'},
+                {'path': '/var/log/nova/api.log', 'start': '2016-01-01'},
+                {'path': '/var/lib', 'skipped': True, 'start': '2016-01-01'}]
+        n = node(logs=logs, logs_compression='zstd')
+        launches, (index, programs) = run(
+            n.co_logs_populate(), [('\0'.join(self.find), '', 0)])
+        self.assertEqual(programs, ['zstd'])
+        cmd = launches[0].cmd
+        # nested paths are walked with their parent, by the oldest start
+        self.assertTrue("'/var/log'" in cmd and "'/var/lib'" in cmd)
+        self.assertFalse("'/var/log/nova" in cmd)
+        self.assertTrue('2016-01-01' in cmd)
+
+        def selected(item):
+            return [index.paths[i] for i in index.items[item]]
+
+        self.assertEqual(selected(0), ['/var/log/syslog',
+                                       '/var/log/nova/api.log',
+                                       '/var/log/nova/conductor.log',
+                                       '/var/log/nova/api.log.1',
+                                       '/var/log/novaX/api.log',
+                                       '/var/log/tab\tand\nnewline.log'])
+        self.assertEqual(selected(1), ['/var/log/nova/api.log'])
+        self.assertEqual(selected(2), ['/var/log/nova/api.log'])
+        self.assertFalse(3 in index.items)
+        # overlapping items count a file once
+        self.assertEqual(index.count, 6)
+        self.assertEqual(index.total, 300)
+        self.assertEqual(index.inodes[7], 8)
+
+    def test_failed(self):
+        n = node(logs=[{'path': '/var/log'}])
+        launches, (index, programs) = run(n.co_logs_populate(),
+                                          [('', 'timeout', 124)])
+        self.assertEqual(index.count, 0)
+        self.assertEqual(programs, None)
+
+
+class LocalLogsPopulateTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.names = ['a.log', 'sub/b.log', 'odd\tname\nx.log']
+        os.mkdir(os.path.join(self.dir, 'sub'))
+        for name in self.names:
+            with open(os.path.join(self.dir, name), 'w') as f:
+                f.write(name)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def populate(self, agent):
+        n = node(ip='127.0.0.1', agent=agent,
+                 logs=[{'path': self.dir},
+                       {'path': os.path.join(self.dir, 'sub'),
+                        'start': '2000-01-01'},
+                       {'path': os.path.join(self.dir, 'missing')}])
+        index, programs = n.logs_populate()
+        paths = sorted([index.paths[i] for i in index.items[0]])
+        self.assertEqual(paths, sorted([os.path.join(self.dir, name)
+                                        for name in self.names]))
+        self.assertEqual([index.paths[i] for i in index.items[1]],
+                         [os.path.join(self.dir, 'sub', 'b.log')])
+        self.assertEqual(index.total, sum([len(x) for x in self.names]))
+
+    def test_find(self):
+        self.populate(agent=False)
+
+    def test_agent(self):
+        self.populate(agent=True)
+
+
+class LogsSampleTest(unittest.TestCase):
+    def setUp(self):
+        self.node = node(logs_sample_files=2, logs_sample_size=1000,
+                         logs_codec=tools.codecs['zstd'])
+        index = tools.LogIndex()
+        for path, size in [('/var/log/a/x.log', 5000),
+                           ('/var/log/a/x.log.1', 3000),
+                           ('/var/log/b/y.log', 4000),
+                           ('/var/log/c/z.txt', 1000)]:
+            index.append(path, size)
+        index.select(0, range(4))
+        self.node.log_index = index
+
+    def test_sample(self):
+        outs = '0\t1000\t100\n1\t1000\t250\nzstd: broken pipe\n7\t1\t1\n'
+        launches, ratios = run(self.node.co_logs_sample(),
+                               [(outs, '', 0)])
+        script = launches[0].input
+        # the largest file of each of the largest groups
+        self.assertTrue("head -c 1000 '/var/log/a/x.log'" in script)
+        self.assertTrue("head -c 1000 '/var/log/b/y.log'" in script)
+        self.assertFalse('z.txt' in script)
+        self.assertEqual(ratios, {('/var/log/a', 'log'): 0.1,
+                                  ('/var/log/b', 'log'): 0.25})
+
+    def test_local(self):
+        # compressed here with zstd, sampled on the node with gzip
+        self.node.logs_codec = tools.codecs['none']
+        self.node.logs_local_codec = tools.codecs['zstd']
+        launches, ratios = run(self.node.co_logs_sample(),
+                               [('0\t1000\t100\n', '', 0)])
+        self.assertTrue('gzip -c' in launches[0].input)
+        self.assertAlmostEqual(ratios[('/var/log/a', 'log')], 0.09)
+
+    def test_failed(self):
+        launches, ratios = run(self.node.co_logs_sample(),
+                               [('', 'bash: not found', 127)])
+        self.assertEqual(ratios, {})
+        self.node.logs_sample_files = 0
+        self.assertEqual(run(self.node.co_logs_sample(), []), ([], {}))
+
+    def test_archives(self):
+        self.node.logs_codec = tools.codecs['gzip']
+        # nothing sampled, logs_size_coefficient applies
+        self.assertEqual(self.node.logs_sampled_ratio(), None)
+        self.assertEqual(self.node.logs_archives(0.5), (6500, 6500))
+        self.node.logs_samples = {('/var/log/a', 'log'): 0.1,
+                                  ('/var/log/b', 'log'): 0.4}
+        # the unsampled group counts at the size-weighted average, 0.2
+        ratio = (8000 * 0.1 + 4000 * 0.4 + 1000 * 0.2) / 13000
+        self.assertAlmostEqual(self.node.logs_sampled_ratio(), ratio)
+        transferred, space = self.node.logs_archives(0.5)
+        self.assertAlmostEqual(transferred, 13000 * ratio * 1.1)
+        self.assertEqual(transferred, space)
+
+
+class ExecBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.node = node(batch_exec=True)
+        self.jobs = []
+        for name in ['one', 'two', 'three']:
+            path = os.path.join(self.dir, name)
+            self.jobs.append({'name': name, 'cmd': 'echo %s' % name,
+                              'output_path': path,
+                              'stderr_path': path + '.stderr'})
+
+    def tearDown(self):
+        tools.budget.start(None)
+        shutil.rmtree(self.dir)
+
+    def batch(self, data, code=0):
+        def result(launch):
+            launch.sink.write(data.replace('M', launch.sink.marker))
+            return '', '', code
+        return result
+
+    def test_broken(self):
+        data = ('M 0 start\nM 0 0 4 0\none\nM 1 start\ngarbage\n'
+                'M 2 start\n')
+        launches, results = run(self.node.co_exec_batch(self.jobs[:3]),
+                                [self.batch(data), ('', '', 0)])
+        # started jobs are failed, not run again
+        self.assertEqual(len(launches), 1)
+        self.assertEqual(results, [(None, '', 0), ('', '', 255),
+                                   ('', '', 255)])
+        data = 'M 0 start\nM 0 0 4 0\none\ngarbage\n'
+        launches, results = run(self.node.co_exec_batch(self.jobs[:3]),
+                                [self.batch(data), ('', '', 0),
+                                 ('', '', 0)])
+        # jobs the batch never started run one by one
+        self.assertEqual(len(launches), 3)
+        self.assertTrue('echo two' in launches[1].cmd)
+        self.assertTrue('echo three' in launches[2].cmd)
+
+    def test_budget(self):
+        # more than half of the budget is gone, priority -1 is out
+        tools.budget.start(100)
+        tools.budget.end = time.time() + 40
+        self.node.priorities = [{'three': -1}]
+        launches, results = run(self.node.co_exec_batch(self.jobs[:2]),
+                                [self.batch('M 0 skip\nM 1 start\n'
+                                            'M 1 0 0 0\n')])
+        self.assertTrue("if [ $SECONDS -lt 40 ]" in launches[0].input or
+                        "if [ $SECONDS -lt 39 ]" in launches[0].input)
+        self.assertEqual(results, [None, (None, '', 0)])
+        # the budget is asked again before each job run one by one
+        launches, results = run(self.node.co_exec_batch(self.jobs),
+                                [self.batch('garbage\n'), ('', '', 0),
+                                 ('', '', 0)])
+        self.assertEqual(len(launches), 3)
+        self.assertEqual(results[2], None)
+
+
+class FakeNode(object):
+    '''Stands for a Node in NodeManager.run_pipeline, records the phases
+    it went through in a file shared with the workers'''
+    def __init__(self, ip, log, lost=None):
+        self.ip = ip
+        self.log = log
+        self.lost = lost
+        self.skipped = False
+        self.put = self.cmds = self.files = ['x']
+        self.log_index = tools.LogIndex()
+
+    def step(self, phase):
+        fd = os.open(self.log, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        os.write(fd, '%s %s\n' % (self.ip, phase))
+        os.close(fd)
+        if phase == self.lost:
+            # the worker dies, the phase has no result
+            os._exit(1)
+
+    def put_files(self):
+        self.step('put')
+
+    def exec_cmd(self, fake=False):
+        self.step('cmds')
+        return {'cmd': self.ip}, {}
+
+    def get_files(self):
+        self.step('files')
+
+    def get_logs(self):
+        self.step('logs')
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        signal.alarm(60)
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, 'log')
+        self.manager = nodes.NodeManager.__new__(nodes.NodeManager)
+        self.manager.conf = {'phase_timeouts': {}}
+        self.manager.maxthreads = 4
+        self.manager.logs_maxthreads = 2
+        self.manager.durations = tools.DurationHistory('')
+        self.manager.nodes = {}
+        self.admit_later = []
+
+        def logs_run_items(timeout, admit_later=False):
+            self.admit_later.append(admit_later)
+            return dict([(key, tools.RunItem(target=n.get_logs, key=key,
+                                             phase='get_logs'))
+                         for key, n in self.manager.nodes.items()])
+        self.manager.logs_run_items = logs_run_items
+
+    def tearDown(self):
+        signal.alarm(0)
+        tools.budget.start(None)
+        shutil.rmtree(self.dir)
+
+    def phases(self):
+        phases = {}
+        for line in read(self.log).splitlines():
+            ip, phase = line.split()
+            phases.setdefault(ip, []).append(phase)
+        return phases
+
+    def test_order(self):
+        for n in range(6):
+            ip = '10.0.0.%d' % n
+            self.manager.nodes[ip] = FakeNode(ip, self.log)
+        self.manager.run_pipeline(logs=True)
+        self.assertEqual(self.admit_later, [True])
+        phases = self.phases()
+        self.assertEqual(sorted(phases), sorted(self.manager.nodes))
+        for ip, node in self.manager.nodes.items():
+            self.assertEqual(phases[ip], ['put', 'cmds', 'files', 'logs'])
+            self.assertEqual(node.mapcmds, {'cmd': ip})
+
+    def test_lost(self):
+        self.manager.nodes['10.0.0.1'] = FakeNode('10.0.0.1', self.log,
+                                                  lost='cmds')
+        self.manager.nodes['10.0.0.2'] = FakeNode('10.0.0.2', self.log)
+        self.manager.run_pipeline(logs=True)
+        phases = self.phases()
+        # a node whose phase failed goes on with the next phases, without
+        # the results of the failed one, the other nodes are not affected
+        self.assertEqual(phases['10.0.0.1'], ['put', 'cmds', 'files', 'logs'])
+        self.assertFalse(hasattr(self.manager.nodes['10.0.0.1'], 'mapcmds'))
+        self.assertEqual(phases['10.0.0.2'], ['put', 'cmds', 'files', 'logs'])
+        self.assertEqual(self.manager.nodes['10.0.0.2'].mapcmds,
+                         {'cmd': '10.0.0.2'})
+
+
+class LogsAdmittedTest(unittest.TestCase):
+    def setUp(self):
+        self.node = node(logs=[{'path': '/var/log/a', 'priority': 1},
+                               {'path': '/var/log/b'}])
+        index = self.node.log_index
+        index.append('/var/log/a', 10)
+        index.append('/var/log/b', 20)
+        index.select(0, [0])
+        index.select(1, [1])
+        self.archived = []
+
+        def co_archive(**args):
+            self.archived.append(args)
+            yield 'archive'
+            raise tools.Return('done')
+        self.node.co_archive = co_archive
+
+    def tearDown(self):
+        tools.budget.start(None)
+
+    def test_admitted(self):
+        result = self.node.logs_admitted('archive', {'timeout': 5})
+        self.assertEqual(result, 'done')
+        self.assertEqual(self.archived, [{'timeout': 5}])
+        self.assertEqual(self.node.log_index.count, 2)
+
+    def test_budget(self):
+        # the budget is checked when the node gets to its logs, not when
+        # the logs items were made
+        tools.budget.start(100)
+        tools.budget.end = time.time() - 1
+        result = self.node.logs_admitted('archive', {'timeout': 5})
+        self.assertEqual(result, 'done')
+        self.assertEqual(self.node.log_index.count, 1)
+        self.assertEqual(self.archived, [{'timeout': 5}])
+        self.node.logs[0]['priority'] = 0
+        del self.node.logs[0]['skipped']
+        result = self.node.logs_admitted('archive', {'timeout': 5})
+        self.assertEqual(result, None)
+        self.assertEqual(len(self.archived), 1)
+        self.assertEqual(self.node.log_index.count, 0)
+
+
+class SshMastersTest(unittest.TestCase):
+    def setUp(self):
+        signal.alarm(60)
+        self.dir = tempfile.mkdtemp()
+        self.manager = nodes.NodeManager.__new__(nodes.NodeManager)
+        self.manager.maxthreads = 4
+        self.manager.logger = logging.getLogger('test')
+        self.manager.pid = os.getpid()
+        self.manager.throttle = None
+        self.manager.ssh_control_dir = tools.ssh_control_dir()
+        self.batches = []
+        self.run_batch = tools.run_batch
+        tools.run_batch = lambda items, maxthreads: self.batches.append(
+            sorted([i.args['control_path'] for i in items]))
+
+    def tearDown(self):
+        signal.alarm(0)
+        tools.run_batch = self.run_batch
+        if self.manager.ssh_control_dir:
+            shutil.rmtree(self.manager.ssh_control_dir)
+        shutil.rmtree(self.dir)
+
+    def test_close(self):
+        control_dir = self.manager.ssh_control_dir
+        for name in ['a', 'b']:
+            open(os.path.join(control_dir, name), 'w').close()
+        self.manager.close_ssh_masters()
+        self.assertEqual(self.batches, [[os.path.join(control_dir, 'a'),
+                                         os.path.join(control_dir, 'b')]])
+        self.assertFalse(os.path.exists(control_dir))
+        self.assertEqual(self.manager.ssh_control_dir, None)
+        # again at exit, nothing is left to close
+        self.manager.cleanup()
+        self.assertEqual(len(self.batches), 1)
+
+    def test_cleanup(self):
+        control_dir = self.manager.ssh_control_dir
+        # forked workers exit with the masters still in use
+        self.manager.pid = -1
+        self.manager.cleanup()
+        self.assertTrue(os.path.isdir(control_dir))
+        self.manager.pid = os.getpid()
+        self.manager.cleanup()
+        self.assertEqual(self.batches, [[]])
+        self.assertFalse(os.path.exists(control_dir))
+
+    def test_failed_run(self):
+        # a run failing after NodeManager started leaves nothing behind
+        script = '\n'.join([
+            'import os, sys',
+            'from timmy import conf, nodes',
+            'c = conf.init_default_conf()',
+            "c.update({'ssh_multiplex': True, 'shell_mode': True,",
+            "          'outdir': %r})" % os.path.join(self.dir, 'out'),
+            'manager = nodes.NodeManager.__new__(nodes.NodeManager)',
+            'manager.base_init(c)',
+            'print(manager.ssh_control_dir)',
+            'if not os.fork():',
+            '    sys.exit(0)',
+            'os.wait()',
+            'print(os.path.isdir(manager.ssh_control_dir))',
+            "raise Exception('failed')"])
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        outs, errs, code = tools.launch_cmd(
+            'cd %s && %s -c %s' % (tools.quote(root), sys.executable,
+                                   tools.quote(script)), 30)
+        self.assertEqual(code, 1, errs)
+        self.assertTrue('Exception: failed' in errs)
+        control_dir, exists = outs.split()
+        # the forked child did not remove it from under its parent
+        self.assertEqual(exists, 'True')
+        self.assertFalse(os.path.exists(control_dir))
+
+
+class LogsSplitTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.journal = tools.Journal(os.path.join(self.dir, 'journal'))
+        self.node = node(logs_split_compressed=True, journal=self.journal,
+                         logs_codec=tools.codecs['gzip'])
+        for path, size in [('/var/log/a.log', 1000), ('/var/log/b.gz', 500),
+                           ('/var/log/c.log.1.XZ', 300)]:
+            self.node.log_index.append(path, size)
+        self.node.log_index.select(0, range(3))
+        self.manager = nodes.NodeManager.__new__(nodes.NodeManager)
+        self.manager.conf = {'archive_dir': self.dir,
+                             'logs_compression_threads': 1}
+        self.manager.logger = logging.getLogger('test')
+        self.manager.journal = self.journal
+        self.manager.nodes = {self.node.ip: self.node}
+        self.archives = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_archives(self):
+        # the compressed files are not compressed again, they count in full
+        gzip = tools.codecs['gzip']
+        plain = tools.codecs['none'].space(800, 1)
+        self.assertTrue(plain >= 800)
+        self.assertEqual(self.node.logs_archives(0.5),
+                         (plain + gzip.space(1000, 0.5),) * 2)
+        self.node.logs_split_compressed = False
+        self.assertEqual(self.node.logs_archives(0.5),
+                         (gzip.space(1800, 0.5),) * 2)
+
+    def test_lists(self):
+        args = self.manager.logs_run_items(60)[self.node.ip].args
+        self.assertEqual(''.join(args['input']), 'var/log/a.log\0')
+        p_cmd, p_outfile, p_input = args['plain']
+        self.assertEqual(''.join(p_input),
+                         'var/log/b.gz\0var/log/c.log.1.XZ\0')
+        self.assertTrue(p_outfile.endswith('-compressed.tar'))
+        self.assertFalse('gzip' in p_cmd or '-z' in p_cmd.split())
+        self.assertTrue(args['outfile'].endswith('.tar.gz'))
+        self.assertNotEqual(args['cmd'], p_cmd)
+        # nothing to split without compression
+        self.node.logs_codec = tools.codecs['none']
+        args = self.manager.logs_run_items(60)[self.node.ip].args
+        self.assertFalse('plain' in args)
+        self.assertEqual(''.join(args['input']), 'var/log/a.log\0'
+                         'var/log/b.gz\0var/log/c.log.1.XZ\0')
+
+    def archive(self, codes):
+        def co_exec_simple_cmd(cmd, outfile=None, **kwargs):
+            self.archives.append(outfile)
+            raise tools.Return(codes.pop(0))
+            yield
+        self.node.co_exec_simple_cmd = co_exec_simple_cmd
+        args = self.manager.logs_run_items(60)[self.node.ip].args
+        self.archives = []
+        self.node.archive_logs(**args)
+        journal = tools.Journal(self.journal.filename, resume=True)
+        return journal.get(self.node.ip, 'get_logs', 'logs')
+
+    def test_failed(self):
+        record = self.archive([0, 1])
+        self.assertEqual(len(self.archives), 2)
+        self.assertEqual((record['ok'], record['code']), (True, 1))
+        # the main archive is still made, the logs are not collected
+        record = self.archive([2, 0])
+        self.assertEqual(len(self.archives), 2)
+        self.assertEqual((record['ok'], record['code']), (False, 2))
+        record = self.archive([0, -15])
+        self.assertEqual((record['ok'], record['code']), (False, -15))
+        self.assertEqual(self.archives[1], record['archive'])
@@ -0,0 +1,158 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import tempfile
+import unittest
+from timmy import throttle
+from timmy import tools
+
+
+class TokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.throttle = throttle.Throttle()
+        self.filename = os.path.join(self.throttle.directory, 'bucket')
+
+    def tearDown(self):
+        self.throttle.close()
+
+    def test_unlimited(self):
+        bucket = throttle.TokenBucket(self.filename)
+        self.assertEqual(bucket.take(10 ** 9), 0)
+        self.throttle.set_rate(0)
+        self.assertEqual(bucket.take(10 ** 9), 0)
+        bucket.close()
+
+    def test_shared_rate(self):
+        self.throttle.set_rate(1000)
+        # two relays taking from the same bucket queue up behind each other
+        first = throttle.TokenBucket(self.filename)
+        second = throttle.TokenBucket(self.filename)
+        self.assertAlmostEqual(first.take(500), 0.5, places=1)
+        self.assertAlmostEqual(second.take(500), 1.0, places=1)
+        time.sleep(1.1)
+        # an idle bucket saves up burst seconds of rate, no more
+        self.assertAlmostEqual(first.take(100), 0, places=2)
+        self.assertAlmostEqual(first.take(100), 0.1, places=1)
+        first.close()
+        second.close()
+
+    def test_close(self):
+        limiter = throttle.Throttle()
+        limiter.close()
+        self.assertFalse(os.path.exists(limiter.directory))
+
+
+class RelayTest(unittest.TestCase):
+    def setUp(self):
+        signal.alarm(60)
+        self.throttle = throttle.Throttle()
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        thread = threading.Thread(target=self.echo)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        signal.alarm(0)
+        self.server.close()
+        self.throttle.close()
+
+    def echo(self):
+        try:
+            conn, address = self.server.accept()
+        except socket.error:
+            return
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            conn.sendall(data)
+        conn.close()
+
+    def relay(self, port):
+        script = throttle.__file__.replace('.pyc', '.py')
+        return subprocess.Popen([sys.executable, script,
+                                 self.throttle.directory, '127.0.0.1',
+                                 str(port)],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+
+    def test_relay(self):
+        self.throttle.set_rate(200000)
+        start = time.time()
+        data = os.urandom(200000)
+        p = self.relay(self.server.getsockname()[1])
+        self.assertEqual(p.communicate(data)[0], data)
+        # both directions count, 400000 bytes at 200000 per second
+        self.assertTrue(time.time() - start > 1.5)
+        rates = self.throttle.rates()
+        self.assertEqual(list(rates), ['127.0.0.1'])
+        self.assertEqual(rates['127.0.0.1'][0], 400000)
+
+    def test_unreachable(self):
+        self.server.close()
+        p = self.relay(1)
+        errs = p.communicate('')[1]
+        self.assertEqual(p.returncode, 255)
+        self.assertTrue('connect to host 127.0.0.1 port 1' in errs)
+
+    def test_ssh_opts(self):
+        # a directory with spaces and quotes, as a temp dir may have
+        tempdir = tempfile.mkdtemp(prefix="timmy test's ")
+        saved, tempfile.tempdir = tempfile.tempdir, tempdir
+        try:
+            limiter = throttle.Throttle()
+        finally:
+            tempfile.tempdir = saved
+        try:
+            limiter.set_rate(0)
+            # ssh_opts are joined into a shell command line, ssh then runs
+            # the ProxyCommand through the shell
+            ssh_opts = ['-oConnectTimeout=2'] + limiter.ssh_opts()
+            outs, errs, code = tools.launch_cmd('ssh -G %s 10.1.2.3' %
+                                                ' '.join(ssh_opts), 10)
+            self.assertEqual(code, 0)
+            cmd = [l for l in outs.splitlines()
+                   if l.startswith('proxycommand ')][0]
+            cmd = cmd.split(None, 1)[1].replace('%h', '127.0.0.1').replace(
+                '%p', str(self.server.getsockname()[1]))
+            p = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE)
+            self.assertEqual(p.communicate('data')[0], 'data')
+            self.assertEqual(limiter.rates()['127.0.0.1'][0], 8)
+            self.assertTrue(tools.ssh_proxy('10.1.2.3', ssh_opts).startswith(
+                'proxycommand '))
+        finally:
+            limiter.close()
+            shutil.rmtree(tempdir)
+
+    def test_ssh_proxy(self):
+        self.assertEqual(tools.ssh_proxy('10.1.2.3',
+                                         ['-oConnectTimeout=2',
+                                          '-o ProxyJump=bastion']),
+                         'proxyjump bastion')
@@ -0,0 +1,929 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import gzip
+import os
+import re
+import shutil
+import signal
+import socket
+import tempfile
+import time
+import unittest
+from StringIO import StringIO
+from timmy import conf
+from timmy import nodes
+from timmy import tools
+
+
+class Sink(object):
+    def __init__(self):
+        self.data = []
+
+    def write(self, data):
+        self.data.append(data)
+
+
+class StreamingTest(unittest.TestCase):
+    '''Input and output far beyond the pipe buffers, a deadlock fails the
+    test by SIGALRM'''
+    def setUp(self):
+        signal.alarm(60)
+
+    def tearDown(self):
+        signal.alarm(0)
+
+    def test_streamed_input_and_output(self):
+        chunks = ['x' * 100000] * 50
+        outs, errs, code = tools.launch_cmd('cat', 30, input=chunks)
+        self.assertEqual(code, 0)
+        self.assertEqual(len(outs), 5000000)
+
+    def test_script_output_into_sink(self):
+        # bash reads the script as it runs it, while its output is waiting
+        # to be read
+        script = ''.join(['printf "%%01000d\\n" %d\n' % i
+                          for i in range(20000)])
+        sink = Sink()
+        outs, errs, code = tools.launch_cmd('bash -s', 30, input=script,
+                                            sink=sink)
+        self.assertEqual(code, 0)
+        self.assertEqual(len(''.join(sink.data)), 20000 * 1001)
+
+
+def command(cmd, timeout, input=None):
+    outs, errs, code = yield tools.Launch(cmd, timeout, input=input)
+    raise tools.Return(code)
+
+
+class AsyncEngineTest(unittest.TestCase):
+    def setUp(self):
+        signal.alarm(60)
+
+    def tearDown(self):
+        signal.alarm(0)
+
+    def test_stalled_input_does_not_block_others(self):
+        # reads a little of its input - the pipe has room but not for a
+        # whole chunk, and then it does not read anymore
+        cmd = 'head -c 5000 >/dev/null; sleep 3'
+        stalled = tools.RunItem(target=None, coroutine=command,
+                                args={'cmd': cmd, 'timeout': 10,
+                                      'input': 'x' * 1000000})
+        quick = tools.RunItem(target=None, coroutine=command,
+                              args={'cmd': 'echo', 'timeout': 10})
+        codes = tools.run_batch_async([stalled, quick], 2)
+        self.assertEqual(codes[1], 0)
+        self.assertTrue(quick.duration < 2)
+
+
+class DeadlineTest(unittest.TestCase):
+    def setUp(self):
+        signal.alarm(60)
+        self.grace = tools.deadlines.kill_grace
+        tools.deadlines.kill_grace = 0.5
+
+    def tearDown(self):
+        signal.alarm(0)
+        tools.deadlines.kill_grace = self.grace
+        tools.deadlines.pop_expired()
+
+    def test_kill_group_after_grace(self):
+        # the background sleep keeps stdout open and, like the shell,
+        # ignores SIGTERM - only SIGKILL of the whole group ends the command
+        start = time.time()
+        outs, errs, code = tools.launch_cmd("trap '' TERM; sleep 30 & wait",
+                                            1)
+        self.assertEqual(code, -signal.SIGKILL)
+        self.assertTrue(time.time() - start < 10)
+        self.assertEqual(len(tools.deadlines.pop_expired()), 1)
+
+
+def log_index(paths):
+    index = tools.LogIndex()
+    numbers = []
+    for path in paths:
+        st = os.stat(path)
+        numbers.append(index.append(path, st.st_size, st.st_mtime,
+                                    st.st_ino))
+    index.select('logs', numbers)
+    return index
+
+
+def write(path, data, mode='w'):
+    with open(path, mode) as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+class LogsDeltaTest(unittest.TestCase):
+    def setUp(self):
+        signal.alarm(60)
+        self.dir = tempfile.mkdtemp()
+        self.logs = os.path.join(self.dir, 'logs')
+        os.mkdir(self.logs)
+
+    def tearDown(self):
+        signal.alarm(0)
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.logs, name)
+
+    def test_ranges(self):
+        for name in ['grown', 'rotated', 'truncated', 'same', 'rewritten']:
+            write(self.path(name), 'x' * 100)
+        state = tools.log_state(log_index([self.path(n) for n in
+                                           os.listdir(self.logs)]))
+        write(self.path('grown'), 'y' * 10, 'a')
+        os.rename(self.path('rotated'), self.path('rotated.1'))
+        write(self.path('rotated.1'), 'y' * 20, 'a')
+        write(self.path('rotated'), 'z' * 5)
+        write(self.path('truncated'), 'x' * 50)
+        state[self.path('rewritten')][2] -= 10
+        write(self.path('new'), 'n')
+        delta = tools.LogsDelta(log_index([self.path(n) for n in
+                                           os.listdir(self.logs)]), state)
+        self.assertEqual(sorted(delta.ranges), sorted([
+            (self.path('grown'), 100, 10, None),
+            (self.path('rotated.1'), 100, 20, self.path('rotated')),
+            (self.path('rotated'), 0, 5, None),
+            (self.path('truncated'), 0, 50, None),
+            (self.path('rewritten'), 0, 100, None),
+            (self.path('new'), 0, 1, None)]))
+        self.assertEqual(list(delta.unchanged), [self.path('same')])
+        self.assertEqual(delta.size, 186)
+
+    def test_script_into_sink(self):
+        # far more output than a pipe holds, not compressible
+        names = ['log%d' % i for i in range(100)]
+        for name in names:
+            write(self.path(name), os.urandom(50000))
+        state = tools.log_state(log_index([self.path(n) for n in names]))
+        for name in names:
+            write(self.path(name), os.urandom(50000), 'a')
+        delta = tools.LogsDelta(log_index([self.path(n) for n in names]),
+                                state)
+        # shrinks after the index was taken, and disappears
+        write(self.path('log0'), 'short')
+        os.remove(self.path('log1'))
+        out = os.path.join(self.dir, 'out')
+        sink = delta.sink(out)
+        outs, errs, code = tools.launch_cmd('bash -s', 30,
+                                            input=delta.script(), sink=sink)
+        self.assertEqual(code, 0)
+        self.assertFalse(sink.broken)
+        self.assertEqual(len(sink.read), 100)
+        self.assertEqual(sink.read[0], 0)
+        self.assertEqual(sink.read[1], 0)
+        for index, (path, offset, size, source) in enumerate(delta.ranges):
+            copy = os.path.join(out, path.lstrip(os.sep))
+            if index > 1:
+                self.assertEqual(read(copy), read(path)[offset:])
+        manifest = delta.manifest(sink.read)
+        self.assertEqual(manifest[2], {'path': delta.ranges[2][0],
+                                       'offset': 50000, 'size': 50000,
+                                       'source': None})
+        state = delta.state(sink.read)
+        self.assertEqual(state[self.path('log2')][1], 100000)
+        self.assertEqual(state[self.path('log0')][1], 50000)
+
+
+class RangeSinkTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.paths = [os.path.join(self.dir, 'a'), os.path.join(self.dir, 'b')]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def sink(self, data, chunk=7):
+        buf = StringIO()
+        f = gzip.GzipFile(fileobj=buf, mode='w')
+        f.write(data)
+        f.close()
+        data = buf.getvalue()
+        sink = tools._RangeSink('M', self.paths)
+        for i in range(0, len(data), chunk):
+            sink.write(data[i:i + chunk])
+        return sink
+
+    def test_frames(self):
+        sink = self.sink('M 0 5\nhelloM 0 5\nM 1 4\nab\0\0M 1 2\n')
+        self.assertFalse(sink.broken)
+        self.assertEqual(sink.read, {0: 5, 1: 2})
+        self.assertEqual(read(self.paths[0]), 'hello')
+        self.assertEqual(read(self.paths[1]), 'ab')
+
+    def test_garbage(self):
+        for data in ['M 0 5\nhelloM 1 5\n', 'M 0\n', 'X 0 5\nhello',
+                     'M 2 1\nx', 'M 0 x\n', 'M' * 10000]:
+            sink = self.sink(data)
+            self.assertTrue(sink.broken, data[:20])
+            self.assertEqual(sink.read, {})
+
+    def test_truncated(self):
+        sink = self.sink('M 0 5\nhelloM 0 5\nM 1 4\nab')
+        self.assertFalse(sink.broken)
+        self.assertEqual(sink.read, {0: 5})
+
+    def test_not_gzip(self):
+        sink = tools._RangeSink('M', self.paths)
+        sink.write('M 0 5\nhelloM 0 5\n')
+        self.assertTrue(sink.broken)
+
+
+class PathMatcherTest(unittest.TestCase):
+    paths = ['/var/log/nova/nova-api.log', '/var/log/nova/nova-api.log.1',
+             '/var/log/neutron7/server.log', '/var/log/NOVA/x.log',
+             '/var/log/messages', '/etc/nova/nova.conf', 'var/log/a.log',
+             '/var/log/nova/nova-api.log.2.gz', '/tmp/a+b.log', '']
+
+    def assertSame(self, patterns):
+        matcher = tools.PathMatcher(patterns)
+        for path in self.paths:
+            self.assertEqual(matcher.search(path),
+                             any([re.search(p, path) for p in patterns]),
+                             '%s %s' % (patterns, path))
+
+    def test_literal(self):
+        self.assertSame(['/var/log/nova/', 'messages', r'a\+b', 'nova-api'])
+        self.assertSame(['^/var/log/nova/', '^var/', '^/etc'])
+        self.assertSame(['^/var/log/messages$', r'\.gz$'])
+        self.assertSame([''])
+        self.assertSame([])
+
+    def test_regex(self):
+        self.assertSame([r'/var/log/(nova|neutron)\d*/.*\.log$',
+                         r'^/etc/.*\.conf'])
+        self.assertSame([r'(a)(b)?\1', r'/var/log/(?P<n>nova)/'])
+        self.assertSame(['(?i)/var/log/nova/', r'\.log'])
+        self.assertSame(['[a-z]+-api', '^/var/log/nova/', r'\.\d+$'])
+
+    def test_many_groups(self):
+        patterns = [r'/var/log/(nova|neutron)%d/.*\.log' % i
+                    for i in range(120)]
+        self.assertSame(patterns)
+        self.assertTrue(tools.PathMatcher(patterns).search(
+            '/var/log/neutron119/a.log'))
+
+
+class LogIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = tools.LogIndex()
+        for path, size in [('/a.log', 10), ('/b.log', 20), ('/c.gz', 40)]:
+            self.index.append(path, size)
+
+    def test_select(self):
+        index = self.index
+        index.select('x', [0, 1])
+        index.select('y', [1, 2])
+        self.assertEqual((len(index), index.total), (3, 70))
+        self.assertEqual(index.selected('x'), 2)
+        self.assertEqual(list(index.numbers()), [0, 1, 2])
+        # reselecting replaces the previous selection of the item
+        index.select('x', [0])
+        self.assertEqual((len(index), index.total), (3, 70))
+        index.discard('y')
+        self.assertEqual((len(index), index.total), (1, 10))
+        self.assertEqual(list(index.numbers()), [0])
+        index.discard('y')
+        index.discard('x')
+        self.assertEqual((len(index), index.total), (0, 0))
+        self.assertEqual(index.selected('x'), 0)
+
+    def test_size(self):
+        self.index.select('x', [0, 1, 2])
+        self.assertEqual(self.index.size(lambda p: p.endswith('.log')), 30)
+        self.index.select('x', [0])
+        self.assertEqual(self.index.size(lambda p: True), 10)
+
+
+class NulListTest(unittest.TestCase):
+    def test_list(self):
+        nul_list = tools.NulList(['/a', '/b/c', '/d'], lstrip='/',
+                                 select=lambda p: p != '/d')
+        self.assertEqual(''.join(nul_list), 'a\0b/c\0')
+        # iterated again when a command is retried
+        self.assertEqual(''.join(nul_list), 'a\0b/c\0')
+        self.assertEqual(list(tools.NulList([])), [])
+
+    def test_chunks(self):
+        items = ['/var/log/%05d.log' % i for i in range(20000)]
+        chunks = list(tools.NulList(items))
+        self.assertTrue(len(chunks) > 1)
+        for chunk in chunks:
+            self.assertTrue(chunk.endswith('\0'))
+            self.assertTrue(len(chunk) < tools.NulList.chunk + 100)
+        self.assertEqual(''.join(chunks).split('\0'), items + [''])
+
+    def test_command_input(self):
+        items = ['/var/log/%05d.log' % i for i in range(20000)]
+        outs, errs, code = tools.launch_cmd('tr "\\0" "\\n"', 30,
+                                            input=tools.NulList(items))
+        self.assertEqual(code, 0)
+        self.assertEqual(outs.splitlines(), items)
+
+
+class CmdBatchTest(unittest.TestCase):
+    def setUp(self):
+        signal.alarm(60)
+        self.dir = tempfile.mkdtemp()
+        self.paths = [os.path.join(self.dir, str(i)) for i in range(3)]
+
+    def tearDown(self):
+        signal.alarm(0)
+        shutil.rmtree(self.dir)
+
+    def sink(self, data, chunk=5):
+        sink = tools._FrameSink('M', self.paths)
+        for i in range(0, len(data), chunk):
+            sink.write(data[i:i + chunk])
+        return sink
+
+    def test_batch(self):
+        batch = tools.CmdBatch(2)
+        batch.add_cmd('echo one; echo err >&2')
+        batch.add_script('echo "$V"\nexit 3', env_vars='V=two')
+        batch.add_cmd('sleep 5')
+        sink = batch.sink(self.paths)
+        outs, errs, code = tools.launch_cmd('bash -s', 30,
+                                            input=batch.script(), sink=sink)
+        self.assertFalse(sink.broken)
+        self.assertEqual(sink.results, {0: (None, 'err\n', 0),
+                                        1: (None, '', 3),
+                                        2: (None, '', 124)})
+        self.assertEqual(read(self.paths[0]), 'one\n')
+        self.assertEqual(read(self.paths[1]), 'two\n')
+        self.assertEqual(read(self.paths[2]), '')
+
+    def test_frames(self):
+        sink = self.sink('M 0 0 3 2\nouterM 1 1 0 0\nM 2 0 2 0\nab')
+        self.assertFalse(sink.broken)
+        self.assertEqual(sink.results, {0: (None, 'er', 0),
+                                        1: (None, '', 1),
+                                        2: (None, '', 0)})
+        self.assertEqual(read(self.paths[0]), 'out')
+        self.assertEqual(read(self.paths[2]), 'ab')
+
+    def test_truncated(self):
+        sink = self.sink('M 0 0 3 2\nouterM 1 0 10 0\nabc')
+        self.assertFalse(sink.broken)
+        self.assertEqual(list(sink.results), [0])
+        self.assertEqual(sink.started, set([0, 1]))
+        sink = self.sink('M 0 0 3 2\nouterM 1 0')
+        self.assertEqual(list(sink.results), [0])
+        self.assertEqual(sink.started, set([0]))
+
+    def test_until(self):
+        write(self.paths[0], 'kept')
+        batch = tools.CmdBatch(2)
+        batch.add_cmd('echo one', until=0)
+        batch.add_script('echo two', until=100)
+        batch.add_cmd('echo three')
+        sink = batch.sink(self.paths)
+        tools.launch_cmd('bash -s', 30, input=batch.script(), sink=sink)
+        self.assertFalse(sink.broken)
+        self.assertEqual(sink.skipped, set([0]))
+        self.assertEqual(sink.launched, set([1, 2]))
+        self.assertEqual(sorted(sink.results), [1, 2])
+        self.assertEqual(read(self.paths[0]), 'kept')
+        self.assertEqual(read(self.paths[1]), 'two\n')
+
+    def test_launched(self):
+        # start lines are still noticed after the output broke
+        sink = self.sink('M 0 start\nM 0 0 1 0\nxgarbage\nM 1 start\nM 1'
+                         ' 0 0 0\nM 2 skip\nM 3 start', chunk=3)
+        self.assertTrue(sink.broken)
+        self.assertEqual(sink.launched, set([0, 1]))
+        self.assertEqual(sink.skipped, set())
+
+    def test_garbage(self):
+        for data in ['M 0 0 x 0\n', 'M 0 0 1\nx', 'X 0 0 0 0\n',
+                     'M 0 start\nM 0 start\n', 'M 5 skip\n', 'M x start\n',
+                     'M 3 0 0 0\n', 'M -1 0 0 0\n', 'M 0 0 -1 0\n',
+                     'M 0 0 0 0\nM 0 0 0 0\n', 'M' * 10000,
+                     'M 0 0 1 0\nxgarbage\n']:
+            sink = self.sink(data)
+            self.assertTrue(sink.broken, data[:20])
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'journal.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_resume(self):
+        journal = tools.Journal(self.filename)
+        journal.record('10.0.0.1', 'run_commands', 'cmd uptime', True,
+                       code=0)
+        journal.record('10.0.0.1', 'run_commands', 'cmd df', False, code=1)
+        journal.record('10.0.0.2', 'run_commands', 'cmd df', True, code=0)
+        journal.record('10.0.0.2', 'run_commands', 'cmd df', False, code=1,
+                       skipped=True)
+        # a line cut short by an interrupted run
+        write(self.filename, '{"node": "10.0.0.1", "ph', 'a')
+        self.assertEqual(tools.Journal(self.filename).records, {})
+        resumed = tools.Journal(self.filename, resume=True)
+        self.assertTrue(resumed.done('10.0.0.1', 'run_commands',
+                                     'cmd uptime'))
+        self.assertFalse(resumed.done('10.0.0.1', 'run_commands', 'cmd df'))
+        # the last record of a unit wins
+        self.assertFalse(resumed.done('10.0.0.2', 'run_commands', 'cmd df'))
+        self.assertFalse(resumed.done('10.0.0.3', 'run_commands', 'cmd df'))
+        self.assertEqual(resumed.get('10.0.0.1', 'run_commands',
+                                     'cmd df')['code'], 1)
+        self.assertEqual([r['node'] for r in journal.skipped()],
+                         ['10.0.0.2'])
+
+
+class AdaptiveLimitTest(unittest.TestCase):
+    def limiter(self, maximum):
+        limiter = tools.AdaptiveLimit(maximum)
+        limiter.load = lambda: 0
+        return limiter
+
+    def test_growth(self):
+        limiter = self.limiter(100)
+        self.assertEqual(limiter.current, tools.AdaptiveLimit.initial)
+        for i in range(6):
+            limiter.update(1.0)
+        # slow start, one per finished item
+        self.assertEqual(limiter.current, 10)
+        limiter.update(1.0, failures=1)
+        self.assertEqual(limiter.current, 5)
+        # then one per "limit" finished items, after the cooldown
+        for i in range(10):
+            limiter.update(1.0)
+        self.assertEqual(limiter.current, 6)
+
+    def test_ceiling(self):
+        limiter = self.limiter(6)
+        for i in range(20):
+            limiter.update(1.0)
+        self.assertEqual(limiter.current, 6)
+        self.assertEqual(self.limiter(0).current, 1)
+
+    def test_congestion(self):
+        limiter = self.limiter(100)
+        for i in range(6):
+            limiter.update(1.0)
+        # latency, once per window of items in flight
+        for i in range(5):
+            limiter.update(10.0)
+        self.assertEqual(limiter.current, 5)
+        limiter = self.limiter(100)
+        limiter.load = lambda: 3.0
+        limiter.update(1.0)
+        self.assertEqual(limiter.current, 2)
+        limiter.update(1.0, failures=2)
+        self.assertEqual(limiter.current, 2)
+        for i in range(4):
+            limiter.update(1.0, failures=1)
+        self.assertEqual(limiter.current, 1)
+
+
+def log_run(filename, name, seconds=0):
+    time.sleep(seconds)
+    write(filename, '%s\n' % name, 'a')
+    return name
+
+
+class RunChainsTest(unittest.TestCase):
+    def setUp(self):
+        signal.alarm(60)
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, 'log')
+
+    def tearDown(self):
+        signal.alarm(0)
+        shutil.rmtree(self.dir)
+
+    def item(self, name, seconds=0, **kwargs):
+        return tools.RunItem(target=log_run, key=name,
+                             args={'filename': self.log, 'name': name,
+                                   'seconds': seconds}, **kwargs)
+
+    def test_order(self):
+        chains = [[self.item('a1', 0.3), self.item('a2')],
+                  [self.item('b1'), self.item('b2'), self.item('b3')],
+                  [], [self.item('c1')]]
+        results = tools.run_chains(chains, 2)
+        self.assertEqual(results, [{0: 'a1', 1: 'a2'},
+                                   {0: 'b1', 1: 'b2', 2: 'b3'}, {},
+                                   {0: 'c1'}])
+        order = read(self.log).split()
+        # chains run side by side, items of a chain in order
+        for first, second in [('a1', 'a2'), ('b1', 'b2'), ('b2', 'b3')]:
+            self.assertTrue(order.index(first) < order.index(second))
+        self.assertTrue(order.index('b3') < order.index('a1'))
+
+    def test_submission_order(self):
+        items = [self.item(name) for name in 'cab']
+        self.assertEqual(tools.run_batch(items, 1), ['c', 'a', 'b'])
+        self.assertEqual(read(self.log).split(), ['c', 'a', 'b'])
+        self.assertTrue(all([i.duration is not None for i in items]))
+
+    def test_phase_limits(self):
+        items = [self.item(str(i), 0.2, phase='x') for i in range(4)]
+        start = time.time()
+        tools.run_chains([[i] for i in items], 4, phase_limits={'x': 1})
+        self.assertTrue(time.time() - start >= 0.8)
+
+
+class LongestFirstTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'durations.json')
+        self.manager = nodes.NodeManager.__new__(nodes.NodeManager)
+        self.manager.nodes = {}
+        self.manager.durations = tools.DurationHistory(self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_history(self):
+        durations = self.manager.durations
+        durations.record('get_logs', 'n1', 10)
+        durations.record('get_logs', 'n1', 20)
+        durations.save()
+        durations = tools.DurationHistory(self.filename)
+        self.assertEqual(durations.expected('get_logs', 'n1'), 15)
+        self.assertEqual(durations.expected('get_logs', 'n2'), None)
+        write(self.filename, '{')
+        self.assertEqual(tools.DurationHistory(self.filename).data, {})
+        # disabled by default, nothing is kept between runs
+        durations = tools.DurationHistory(conf.init_default_conf()[
+            'duration_history'])
+        durations.record('get_logs', 'n1', 10)
+        durations.save()
+        self.assertEqual(tools.DurationHistory('').data, {})
+
+    def test_longest_first(self):
+        for key, seconds in [('n1', 5), ('n2', 50), ('n3', 1)]:
+            self.manager.durations.record('exec_cmd', key, seconds)
+        items = [tools.RunItem(target=None, key=key)
+                 for key in ['n1', 'n2', 'n3', 'new']]
+        ordered = self.manager.longest_first(items, 'exec_cmd')
+        # never seen before goes first, it may as well be the slowest
+        self.assertEqual([i.key for i in ordered], ['new', 'n2', 'n1', 'n3'])
+        self.assertEqual(items[0].phase, 'exec_cmd')
+        chains = [[items[2]], [items[0], items[1]]]
+        chains.sort(key=self.manager.expected_chain_duration, reverse=True)
+        self.assertEqual(chains, [[items[0], items[1]], [items[2]]])
+
+
+def slow_once(filename):
+    '''Slow the first time it runs, instant the second'''
+    try:
+        os.close(os.open(filename, os.O_CREAT | os.O_EXCL))
+    except OSError:
+        return 'copy'
+    time.sleep(30)
+    return 'first'
+
+
+class RetryTest(unittest.TestCase):
+    def setUp(self):
+        signal.alarm(60)
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, 'log')
+
+    def tearDown(self):
+        signal.alarm(0)
+        shutil.rmtree(self.dir)
+        tools.deadlines.set_phase(None)
+        tools.retries.configure({})
+
+    def test_retryable(self):
+        policy = tools.RetryPolicy(count=2, backoff=0.5)
+        launch = tools.Launch('true', 10)
+        self.assertTrue(policy.retryable(launch, 255, 0))
+        self.assertTrue(policy.retryable(launch, 255, 1))
+        self.assertFalse(policy.retryable(launch, 255, 2))
+        self.assertFalse(policy.retryable(launch, 1, 0))
+        self.assertEqual([policy.delay(a) for a in range(3)], [0.5, 1, 2])
+        # the output is already consumed
+        self.assertFalse(policy.retryable(tools.Launch('true', 10,
+                                                       sink=Sink()), 255, 0))
+        tools.deadlines.set_phase('x', 0.2)
+        self.assertFalse(policy.retryable(launch, 255, 0))
+        self.assertFalse(tools.RetryPolicy().retryable(launch, 255, 0))
+
+    def test_policies(self):
+        tools.retries.configure({'default': {'count': 1},
+                                 'get_logs': {'count': 3, 'codes': [1]}})
+        item = tools.RunItem(target=None, phase='get_logs')
+        self.assertEqual(tools.retries.policy(item).codes, [1])
+        item = tools.RunItem(target=None, phase='get_files')
+        self.assertEqual(tools.retries.policy(item).count, 1)
+        item.retry = tools.RetryPolicy(count=5)
+        self.assertEqual(tools.retries.policy(item).count, 5)
+        tools.deadlines.set_phase('get_logs')
+        self.assertEqual(tools.retries.policy().count, 3)
+
+    def test_run(self):
+        marker = os.path.join(self.dir, 'failed')
+        launch = tools.Launch('[ -e %s ] && echo ok || { touch %s; exit '
+                              '255; }' % (marker, marker), 10)
+        tools.retries.active = tools.RetryPolicy(count=1, backoff=0.01)
+        try:
+            self.assertEqual(tools.retries.run(launch), ('ok\n', '', 0))
+            os.remove(marker)
+            tools.retries.active = tools.RetryPolicy()
+            outs, errs, code = tools.retries.run(launch)
+            self.assertEqual(code, 255)
+        finally:
+            tools.retries.active = None
+
+    def test_hedge(self):
+        filename = os.path.join(self.dir, 'slow')
+        items = [tools.RunItem(target=slow_once, args={'filename': filename},
+                               idempotent=True)]
+        items += [tools.RunItem(target=log_run,
+                                args={'filename': self.log, 'name': i},
+                                idempotent=True) for i in range(5)]
+        start = time.time()
+        results = tools.run_batch(items, 2, hedge=True)
+        self.assertEqual(results[0], 'copy')
+        self.assertTrue(time.time() - start < 20)
+        self.assertEqual(results[1:], range(5))
+
+
+class FilesCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = tools.FilesCache(os.path.join(self.dir, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_update(self):
+        first = os.path.join(self.dir, 'first')
+        os.makedirs(os.path.join(first, 'etc'))
+        write(os.path.join(first, 'etc', 'a'), 'aaa')
+        write(os.path.join(first, 'b'), 'bb')
+        self.assertEqual(self.cache.link_dest, None)
+        self.assertEqual(self.cache.update(first), (2, 2, 5, 5))
+        # rsync --link-dest hardlinks the unchanged file
+        second = os.path.join(self.dir, 'second')
+        os.makedirs(os.path.join(second, 'etc'))
+        os.link(os.path.join(self.cache.link_dest, 'etc', 'a'),
+                os.path.join(second, 'etc', 'a'))
+        write(os.path.join(second, 'b'), 'changed')
+        self.assertEqual(self.cache.update(second), (1, 2, 7, 10))
+        self.assertEqual(read(os.path.join(self.cache.tree, 'b')),
+                         'changed')
+
+
+class CodecTest(unittest.TestCase):
+    def test_choose(self):
+        def choose(name, available):
+            return tools.choose_codec(name, available).name
+
+        self.assertEqual(choose('xz', ['xz', 'zstd']), 'xz')
+        # falls back down the chain to gzip, assumed to be everywhere
+        self.assertEqual(choose('xz', ['zstd']), 'zstd')
+        self.assertEqual(choose('xz', ['pigz']), 'pigz')
+        self.assertEqual(choose('xz', []), 'gzip')
+        self.assertEqual(choose('gzip', []), 'gzip')
+        self.assertEqual(choose('none', []), 'none')
+        for name in ['auto', 'local']:
+            self.assertEqual(choose(name, ['xz', 'pigz', 'zstd']), 'zstd')
+            self.assertEqual(choose(name, ['xz', 'pigz']), 'pigz')
+            self.assertEqual(choose(name, ['xz']), 'gzip')
+
+    def test_commands(self):
+        zstd = tools.codecs['zstd']
+        self.assertEqual(zstd.command(), 'zstd -T0')
+        self.assertEqual(zstd.command(4), 'zstd -T4')
+        self.assertEqual(tools.codecs['pigz'].command(), 'pigz')
+        self.assertEqual(tools.codecs['gzip'].command(2), 'gzip')
+        self.assertEqual(zstd.tar_option(2),
+                         "--use-compress-program='zstd -T2'")
+        self.assertEqual(tools.codecs['none'].tar_option(), '')
+        self.assertEqual(zstd.filename('logs'), 'logs.tar.zst')
+        self.assertEqual(tools.codecs['none'].filename('logs'), 'logs.tar')
+
+    def test_space(self):
+        gzip_codec = tools.codecs['gzip']
+        self.assertEqual(gzip_codec.space(1000, 2), 2000)
+        self.assertAlmostEqual(gzip_codec.space(1000, 2, sampled=0.1), 110)
+        self.assertAlmostEqual(tools.codecs['xz'].space(1000, 2), 1500)
+        # an uncompressed tar is never smaller than its files
+        self.assertAlmostEqual(tools.codecs['none'].space(1000, 0.5), 1050)
+
+    def test_log_group(self):
+        group = ('/var/log/nova', 'log')
+        for name in ['nova-api.log', 'nova-api.log.1',
+                     'nova-api.log-20160101']:
+            self.assertEqual(tools.log_group('/var/log/nova/' + name), group)
+        self.assertEqual(tools.log_group('/var/log/nova/nova-api.log.2.gz'),
+                         ('/var/log/nova', 'gz'))
+
+
+class RsyncIncludeRulesTest(unittest.TestCase):
+    def test_rules(self):
+        # every parent directory is included, or rsync would not descend
+        self.assertEqual(tools.rsync_include_rules('/etc/nova/'),
+                         '+ /etc\n+ /etc/nova\n+ /etc/nova/**\n')
+        self.assertEqual(tools.rsync_include_rules('/etc//ssh/sshd_config'),
+                         '+ /etc\n+ /etc/ssh\n+ /etc/ssh/sshd_config\n'
+                         '+ /etc/ssh/sshd_config/**\n')
+        self.assertEqual(tools.rsync_include_rules('/etc/a/../hosts'),
+                         '+ /etc\n+ /etc/hosts\n+ /etc/hosts/**\n')
+
+    def test_nested(self):
+        # files of several items, one under another, are rules of one list
+        rules = (tools.rsync_include_rules('/var/lib/x') +
+                 tools.rsync_include_rules('/var/lib/x/y/z.conf'))
+        lines = rules.splitlines()
+        self.assertTrue('+ /var/lib/x/**' in lines)
+        self.assertTrue('+ /var/lib/x/y' in lines)
+        self.assertEqual(lines[-1], '+ /var/lib/x/y/z.conf/**')
+
+    @unittest.skipUnless(tools.local_programs(['rsync']), 'needs rsync')
+    def test_rsync(self):
+        src = tempfile.mkdtemp()
+        out = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(src, 'd', 'sub'))
+            for name in ['d/sub/a', 'd/b', 'c', 'e']:
+                write(os.path.join(src, name), name)
+            data = (tools.rsync_include_rules(os.path.join(src, 'd')) +
+                    tools.rsync_include_rules(os.path.join(src, 'c')))
+            outs, errs, code = tools.get_files_rsync('127.0.0.1', data, [],
+                                                     '-a', out, timeout=30)
+            self.assertEqual(code, 0, errs)
+            copied = []
+            for dirpath, dirnames, filenames in os.walk(out):
+                copied += [os.path.relpath(os.path.join(dirpath, f), out)
+                           for f in filenames]
+            root = src.strip(os.sep)
+            self.assertEqual(sorted(copied),
+                             [os.path.join(root, n)
+                              for n in ['c', 'd/b', 'd/sub/a']])
+        finally:
+            shutil.rmtree(src)
+            shutil.rmtree(out)
+
+
+class SshMultiplexTest(unittest.TestCase):
+    def setUp(self):
+        self.dirs = []
+        self.tempdir = tempfile.tempdir
+
+    def tearDown(self):
+        tempfile.tempdir = self.tempdir
+        for d in self.dirs:
+            shutil.rmtree(d, ignore_errors=True)
+
+    def control_dir(self):
+        self.dirs.append(tools.ssh_control_dir())
+        return self.dirs[-1]
+
+    def control_path(self, control_dir):
+        opts = tools.ssh_multiplex_opts(control_dir, 600)
+        self.assertEqual(opts[0], '-oControlMaster=auto')
+        self.assertEqual(opts[2], '-oControlPersist=600')
+        self.assertTrue(opts[1].startswith('-oControlPath='))
+        path = opts[1][len('-oControlPath='):]
+        self.assertEqual(os.path.dirname(path), control_dir)
+        # what ssh binds before renaming it to the expanded path
+        return os.path.join(control_dir, 'x' * 40 + '.' + 'x' * 16)
+
+    def bind(self, path):
+        s = socket.socket(socket.AF_UNIX)
+        try:
+            s.bind(path)
+        finally:
+            s.close()
+            os.remove(path)
+
+    def test_control_path(self):
+        control_dir = self.control_dir()
+        self.assertEqual(os.path.dirname(control_dir), tempfile.gettempdir())
+        self.assertTrue(os.path.basename(control_dir).startswith('timmy_ssh_'))
+        self.bind(self.control_path(control_dir))
+
+    def test_long_tmpdir(self):
+        deep = tempfile.mkdtemp()
+        self.dirs.append(deep)
+        deep = os.path.join(deep, 'x' * 80)
+        os.mkdir(deep)
+        tempfile.tempdir = deep
+        control_dir = self.control_dir()
+        self.assertEqual(os.path.dirname(control_dir), '/tmp')
+        path = self.control_path(control_dir)
+        self.assertTrue(len(path) <= tools.ssh_control_path_max + 17)
+        self.bind(path)
+
+    @unittest.skipUnless(tools.local_programs(['ssh']), 'needs ssh')
+    def test_ssh_expands(self):
+        control_dir = self.control_dir()
+        opts = tools.ssh_multiplex_opts(control_dir, 600)
+        outs, errs, code = tools.launch_cmd(
+            'ssh -G %s 10.0.0.1' % ' '.join(opts), 15)
+        if code != 0:
+            self.skipTest('ssh has no -G')
+        for line in outs.splitlines():
+            if line.startswith('controlpath '):
+                path = line.split(None, 1)[1]
+        self.assertEqual(os.path.dirname(path), control_dir)
+        self.assertEqual(len(os.path.basename(path)),
+                         tools.ssh_control_name_len)
+
+
+class SshNodeTest(unittest.TestCase):
+    env_vars = ['X=1', 'Y="two words"']
+
+    def setUp(self):
+        signal.alarm(60)
+        self.dir = tempfile.mkdtemp(suffix=" it's")
+        # stands for ssh, prints the arguments it was given
+        bindir = os.path.join(self.dir, 'bin')
+        os.mkdir(bindir)
+        write(os.path.join(bindir, 'ssh'), '#!/bin/sh\nprintf "%s\\0" "$@"\n')
+        os.chmod(os.path.join(bindir, 'ssh'), 0o755)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = bindir + os.pathsep + self.path
+
+    def tearDown(self):
+        signal.alarm(0)
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.dir)
+
+    def ssh_args(self, **kwargs):
+        outs, errs, code = tools.ssh_node('10.0.0.1', ssh_opts=['-oA=1'],
+                                          env_vars=self.env_vars, **kwargs)
+        self.assertEqual(code, 0, errs)
+        return outs.split('\0')[:-1]
+
+    def test_remote(self):
+        command = 'printenv Y; echo \'q\'"uote" | tr a-z A-Z'
+        args = self.ssh_args(command=command, prefix='nice -n 1')
+        self.assertEqual(args[:3], ['-T', '-oA=1', '10.0.0.1'])
+        self.assertEqual(args[3:], ['X=1 Y="two words"',
+                                    'nice -n 1 ' + command])
+        # what the remote shell runs
+        remote = 'bash -c %s' % tools.quote(' '.join(args[3:]))
+        outs, errs, code = tools.launch_cmd(remote, 15)
+        self.assertEqual(outs, 'two words\nQUOTE\n')
+        self.assertEqual(self.ssh_args(command='uptime')[3:],
+                         ['X=1 Y="two words"', ' uptime'])
+
+    def test_remote_files(self):
+        script = os.path.join(self.dir, 's')
+        write(script, 'echo "$X"\n')
+        args = self.ssh_args(filename=script, prefix='nice -n 1')
+        self.assertEqual(args[3:], ['X=1 Y="two words"',
+                                    'nice -n 1 bash -s'])
+        args = self.ssh_args(filename=script)
+        self.assertEqual(args[3:], ['X=1 Y="two words"', ' bash -s'])
+        output = os.path.join(self.dir, 'out')
+        tools.ssh_node('10.0.0.1', command='cat', inputfile=script,
+                       outputfile=output)
+        self.assertEqual(read(output).split('\0')[-2], ' cat')
+
+    def test_local(self):
+        command = 'echo "$X" "$Y" \'q\'"uote"'
+        outs, errs, code = tools.ssh_node('127.0.0.1', command=command,
+                                          env_vars=self.env_vars,
+                                          prefix='nice -n 1')
+        self.assertEqual((outs, code), ('1 two words quote\n', 0))
+        outs, errs, code = tools.ssh_node('127.0.0.1', command='cat',
+                                          input='a\0b')
+        self.assertEqual(outs, 'a\0b')
+        script = os.path.join(self.dir, 's')
+        write(script, 'echo "$Y"\ncat\n')
+        outs, errs, code = tools.ssh_node('127.0.0.1', filename=script,
+                                          env_vars=self.env_vars)
+        self.assertEqual(outs, 'two words\n')
+        output = os.path.join(self.dir, 'out')
+        outs, errs, code = tools.ssh_node('127.0.0.1', command='tac',
+                                          inputfile=script, input='x',
+                                          outputfile=output)
+        self.assertEqual((outs, code), ('', 0))
+        self.assertEqual(read(output), 'cat\necho "$Y"\n')
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Bandwidth limiter shared by all transfers of a run.
+
+Every ssh connection to a node - commands, logs, rsync, scp, the agent -
+goes through a relay which ssh starts as its ProxyCommand:
+
+    python throttle.py <directory> <host> <port>
+
+The relays meter the bytes they pass, in both directions, against one
+token bucket kept in <directory>/bucket under flock. The rate is thus
+shared by whichever transfers are active at the moment, an idle or
+finished one does not hold any part of it. Each relay also keeps
+<directory>/stats-<pid> with the bytes it passed and when, which
+Throttle.rates() sums up per host.
+
+This is a Python process per ssh connection, passing every chunk under
+the lock, so it costs CPU on the collector as long as the limit is on -
+logs_speed_limit is off by default. ssh uses the first value it is given
+for an option, so the relay can not be combined with a ProxyCommand or
+ProxyJump of ssh_opts or of ~/.ssh/config, NodeManager refuses to start
+then.
+
+ssh runs this file as a script, it must only use the standard library.
+"""
+
+from pipes import quote
+
+import fcntl
+import os
+import select
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+CHUNK = 65536
+CONNECT_TIMEOUT = 30
+
+
+class TokenBucket(object):
+    '''Rate shared by processes through a file holding "<rate> <tokens>
+    <time>", rate in bytes per second, 0 meaning unlimited. Tokens may go
+    negative - whoever took them then waits until the debt is paid, so
+    concurrent takers queue up behind each other. burst is how many
+    seconds of rate an idle bucket saves up.'''
+    def __init__(self, filename, burst=0.1):
+        self.burst = burst
+        self.fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+
+    def read(self):
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        try:
+            rate, tokens, stamp = [float(x) for x in
+                                   os.read(self.fd, 128).split()]
+        except ValueError:
+            return 0.0, 0.0, time.time()
+        return rate, tokens, stamp
+
+    def write(self, rate, tokens, stamp):
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        os.ftruncate(self.fd, 0)
+        os.write(self.fd, ('%f %f %f\n' % (rate, tokens, stamp)).encode())
+
+    def set_rate(self, rate):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            self.write(rate, 0.0, time.time())
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def take(self, size):
+        '''Takes size bytes, returns seconds to wait before passing them'''
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            rate, tokens, stamp = self.read()
+            if rate <= 0:
+                return 0
+            now = time.time()
+            tokens = min(rate * self.burst, tokens + (now - stamp) * rate)
+            tokens -= size
+            self.write(rate, tokens, now)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return max(0, -tokens / rate)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Stats(object):
+    '''Bytes passed by a relay, saved at most once a second'''
+    def __init__(self, directory, host):
+        self.filename = os.path.join(directory, 'stats-%d' % os.getpid())
+        self.host = host
+        self.bytes = 0
+        self.first = None
+        self.last = None
+        self.saved = 0
+
+    def add(self, size):
+        now = time.time()
+        if self.first is None:
+            self.first = now
+        self.last = now
+        self.bytes += size
+        if now - self.saved >= 1:
+            self.save()
+
+    def save(self):
+        if self.first is None:
+            return
+        self.saved = time.time()
+        with open(self.filename, 'w') as f:
+            f.write('%s %d %f %f\n' % (self.host, self.bytes, self.first,
+                                       self.last))
+
+
+def write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def relay(directory, host, port):
+    '''Passes data between stdin/stdout and host:port at the shared rate'''
+    try:
+        sock = socket.create_connection((host, int(port)), CONNECT_TIMEOUT)
+    except (socket.error, socket.timeout) as e:
+        sys.stderr.write('ssh: connect to host %s port %s: %s\n' %
+                         (host, port, e))
+        return 255
+    sock.settimeout(None)
+    bucket = TokenBucket(os.path.join(directory, 'bucket'))
+    stats = Stats(directory, host)
+    sock_fd = sock.fileno()
+    stdin = sys.stdin.fileno()
+    stdout = sys.stdout.fileno()
+    # source: destination
+    pairs = {stdin: sock_fd, sock_fd: stdout}
+    try:
+        while pairs:
+            r, w, x = select.select(list(pairs), [], [])
+            for fd in r:
+                data = os.read(fd, CHUNK)
+                if not data:
+                    if pairs.pop(fd) == sock_fd:
+                        sock.shutdown(socket.SHUT_WR)
+                    else:
+                        os.close(stdout)
+                    continue
+                wait = bucket.take(len(data))
+                if wait:
+                    time.sleep(wait)
+                write_all(pairs[fd], data)
+                stats.add(len(data))
+    finally:
+        stats.save()
+        bucket.close()
+        sock.close()
+
+
+class Throttle(object):
+    '''Bandwidth limiter of a run, see the module docstring. ssh_opts()
+    routes ssh connections through it, set_rate() sets the total rate.'''
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(prefix='timmy_throttle_')
+        self.bucket = TokenBucket(os.path.join(self.directory, 'bucket'))
+
+    def ssh_opts(self):
+        script = os.path.abspath(__file__)
+        if script.endswith(('.pyc', '.pyo')):
+            script = script[:-1]
+        # ssh runs the command through the shell, as ssh_opts are run
+        cmd = '%s %%h %%p' % ' '.join([quote(sys.executable), quote(script),
+                                      quote(self.directory)])
+        return [quote('-oProxyCommand=%s' % cmd)]
+
+    def set_rate(self, rate):
+        '''Sets the rate of all transfers together, in bytes per second'''
+        self.bucket.set_rate(rate)
+
+    def rates(self):
+        '''Returns {host: (bytes, seconds)} of transfers so far, seconds
+        from the first to the last byte passed to or from the host'''
+        hosts = {}
+        for name in os.listdir(self.directory):
+            if not name.startswith('stats-'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    host, size, first, last = f.read().split()
+            except (IOError, ValueError):
+                continue
+            size, first, last = int(size), float(first), float(last)
+            if host in hosts:
+                h_size, h_first, h_last = hosts[host]
+                size += h_size
+                first = min(first, h_first)
+                last = max(last, h_last)
+            hosts[host] = (size, first, last)
+        return dict([(h, (s[0], s[2] - s[1])) for h, s in hosts.items()])
+
+    def close(self):
+        self.bucket.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(relay(*sys.argv[1:4]))
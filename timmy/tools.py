@@ -19,34 +19,36 @@
 tools module
 """
 
+from array import array
 from flock import FLock
 from pipes import quote
-from tempfile import gettempdir
+from tempfile import gettempdir, mkdtemp
 from timmy.env import project_name
-import Queue
+import atexit
+import cPickle as pickle
+import errno
+import fcntl
+import heapq
 import json
 import logging
 import multiprocessing as mp
 import os
+import re
+import resource
+import select
+import shutil
 import signal
 import subprocess
 import sys
 import threading
+import time
 import traceback
+import types
+import uuid
 import yaml
+import zlib
 
 logger = logging.getLogger(project_name)
-slowpipe = '''
-import sys
-import time
-while 1:
-    a = sys.stdin.read(int(1250*%s))
-    if a:
-        sys.stdout.write(a)
-        time.sleep(0.01)
-    else:
-        break
-'''
 
 
 def print_and_exit(code):
@@ -94,6 +96,7 @@ def main_handle_sig(sig, frame):
                 os.kill(int(pid), sig)
             except OSError:
                 pass
+    deadlines.kill_all(sig)
     print_and_exit(sig)
 
 
@@ -105,9 +108,32 @@ def sub_handle_sig(sig, frame):
         os.killpg(os.getpid(), sig)
     except OSError:
         pass
+    deadlines.kill_all(sig)
     print_and_exit(sig)
 
 
+def cancel_worker(sig, frame):
+    '''Handler of a worker cancelled by WorkerPool.cancel, its commands
+    lead their own process groups which the pool cannot see'''
+    deadlines.kill_all(signal.SIGKILL)
+    os._exit(1)
+
+
+def start_session():
+    '''preexec_fn of commands - a command leads its own process group,
+    so that deadlines can kill whatever it has started'''
+    os.setsid()
+
+
+def kill_group(pid, sig):
+    '''Sends sig to the process group led by pid, False if it is gone'''
+    try:
+        os.killpg(pid, sig)
+        return True
+    except OSError:
+        return False
+
+
 def setup_handle_sig(subprocess=False):
     if os.getpid() != os.getpgrp():
         os.setpgrp()
@@ -129,116 +155,785 @@ def run_with_lock(f):
     return wrapper
 
 
+class DeadlineManager(object):
+    '''Kills subprocesses which outlive their deadline.
+
+    All commands launched by a process share one deadline heap served by a
+    single thread, instead of a threading.Timer per command. A command's
+    deadline is its own timeout or the deadline of the current phase,
+    whichever comes first. Commands which hit their deadline are collected
+    in "expired" as dicts with label, phase, timeout, by_phase (the phase
+    deadline came first) and "late" - seconds between the deadline and the
+    moment the command actually finished.
+
+    A command gets SIGTERM at its deadline, sent to its whole process group,
+    and SIGKILL if it is still running kill_grace seconds later.'''
+    kill_grace = 5
+
+    def __init__(self):
+        self.phase = None
+        # absolute deadlines of phases which run side by side, see
+        # start_phases
+        self.phase_deadlines = {}
+        self.expired = []
+        # commands which exited 255 - ssh could not connect or lost the
+        # connection, used by AdaptiveLimit
+        self.failures = 0
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.cond = threading.Condition()
+        self.heap = []
+        self.thread = None
+        self.stopping = False
+
+    def stop(self):
+        '''Stops the watch thread, called at exit - a daemon thread still
+        waiting at interpreter shutdown makes Python 2 print an error'''
+        if self.pid != os.getpid() or not self.thread:
+            return
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        self.thread.join()
+
+    def set_phase(self, name, timeout=None):
+        '''Sets a deadline for all commands launched until the next call,
+        a phase without timeout gets its deadline from start_phases, if
+        any, or only names the phase in the report'''
+        if timeout:
+            deadline = time.time() + timeout
+        else:
+            deadline = self.phase_deadlines.get(name)
+        self.phase = (name, deadline) if name else None
+
+    def start_phases(self, timeouts):
+        '''Starts the clock for several phases at once, {name: timeout}'''
+        now = time.time()
+        self.phase_deadlines = dict((name, now + timeout)
+                                    for name, timeout in timeouts.items()
+                                    if timeout)
+
+    def add(self, pid, timeout, label):
+        if self.pid != os.getpid():
+            # forked - the lock and the thread belong to the parent
+            self.reset()
+        now = time.time()
+        entry = {'pid': pid, 'label': label, 'timeout': timeout,
+                 'start': now, 'deadline': now + timeout, 'phase': None,
+                 'killed': False, 'done': False, 'by_phase': False}
+        if self.phase:
+            entry['phase'] = self.phase[0]
+            if self.phase[1] is not None and self.phase[1] < now + timeout:
+                entry['deadline'] = self.phase[1]
+                entry['by_phase'] = True
+        with self.cond:
+            heapq.heappush(self.heap, (entry['deadline'], pid, entry))
+            if not self.thread:
+                self.thread = threading.Thread(target=self.watch)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+        return entry
+
+    def done(self, entry, code=None):
+        '''Marks the command finished, code 124 means that the timeout
+        wrapper around the command fired first'''
+        with self.cond:
+            entry['done'] = True
+        if code == 255:
+            self.failures += 1
+        if entry['killed'] or code == 124:
+            late = max(0, time.time() - entry['deadline'])
+            self.record(entry['label'], entry['timeout'], late,
+                        phase=entry['phase'], by_phase=entry['by_phase'])
+
+    def record(self, label, timeout, late=0, phase=None, by_phase=False):
+        '''Adds a command to the report, also used for commands whose
+        deadline was enforced remotely'''
+        if phase is None and self.phase:
+            phase = self.phase[0]
+        self.expired.append({'label': label, 'phase': phase,
+                             'timeout': timeout, 'by_phase': by_phase,
+                             'late': round(late, 3)})
+
+    def watch(self):
+        with self.cond:
+            while not self.stopping:
+                now = time.time()
+                while self.heap and (self.heap[0][2]['done'] or
+                                     self.heap[0][0] <= now):
+                    deadline, pid, entry = heapq.heappop(self.heap)
+                    if entry['done']:
+                        continue
+                    if entry['killed']:
+                        if kill_group(pid, signal.SIGKILL):
+                            logger.error('pid %d ignored SIGTERM, sent '
+                                         'SIGKILL' % pid)
+                    elif kill_group(pid, signal.SIGTERM):
+                        entry['killed'] = True
+                        logger.error('pid %d killed by timeout' % pid)
+                        heapq.heappush(self.heap,
+                                       (now + self.kill_grace, pid, entry))
+                timeout = self.heap[0][0] - now if self.heap else None
+                self.cond.wait(timeout)
+
+    def kill_all(self, sig):
+        '''Signals all running commands, used by signal handlers - without
+        the lock, which the interrupted thread may hold'''
+        for deadline, pid, entry in list(self.heap):
+            if not entry['done']:
+                kill_group(pid, sig)
+
+    def pop_expired(self):
+        expired, self.expired = self.expired, []
+        return expired
+
+    def pop_failures(self):
+        failures, self.failures = self.failures, 0
+        return failures
+
+
+class AdaptiveLimit(object):
+    '''AIMD concurrency limit for run_batch and AsyncEngine.
+
+    The limit starts low and grows by one per finished item (slow start)
+    until the first sign of congestion, then by one per "limit" finished
+    items. Congestion - ssh failures (exit code 255), local load average
+    above max_load per CPU, or item latency growing beyond latency_factor
+    times the best seen so far - halves the limit, at most once per window
+    of items which were in flight at the time. maxthreads is the ceiling.'''
+    initial = 4
+    latency_factor = 2.0
+
+    def __init__(self, maximum, max_load=2.0, logger=None):
+        self.logger = logger or logging.getLogger(project_name)
+        self.maximum = max(1, maximum)
+        self.limit = float(min(self.initial, self.maximum))
+        self.max_load = max_load
+        self.slow_start = True
+        self.latency = None
+        self.best_latency = None
+        self.cooldown = 0
+        self.started = time.time()
+        self.curve = [(0.0, self.current)]
+        try:
+            self.cpus = mp.cpu_count()
+        except NotImplementedError:
+            self.cpus = 1
+
+    @property
+    def current(self):
+        return int(self.limit)
+
+    def load(self):
+        try:
+            return os.getloadavg()[0] / self.cpus
+        except OSError:
+            return 0
+
+    def update(self, latency, failures=0):
+        '''Called for every finished item with its run time and the
+        amount of ssh failures it ran into'''
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * latency
+        if self.best_latency is None or self.latency < self.best_latency:
+            self.best_latency = self.latency
+        congestion = None
+        if failures:
+            congestion = '%d ssh failures' % failures
+        elif self.load() > self.max_load:
+            congestion = 'load %.2f per cpu' % self.load()
+        elif self.latency > self.best_latency * self.latency_factor:
+            congestion = 'latency %.1fs, best %.1fs' % (self.latency,
+                                                        self.best_latency)
+        previous = self.current
+        if self.cooldown:
+            self.cooldown -= 1
+        if congestion:
+            if not self.cooldown:
+                self.limit = max(1.0, self.limit / 2)
+                self.slow_start = False
+                self.cooldown = previous
+                self.logger.debug('adaptive limit: %s, %d -> %d' %
+                                  (congestion, previous, self.current))
+        elif self.slow_start:
+            self.limit += 1
+        else:
+            self.limit += 1 / self.limit
+        self.limit = min(self.limit, float(self.maximum))
+        if self.current != previous:
+            self.curve.append((time.time() - self.started, self.current))
+
+    def log_curve(self, name=None):
+        # one point per tenth of a second is plenty for reading the log
+        points = []
+        for point in ['%.1fs: %d' % p for p in self.curve]:
+            if points and points[-1].split(':')[0] == point.split(':')[0]:
+                points[-1] = point
+            else:
+                points.append(point)
+        curve = ', '.join(points)
+        self.logger.info('adaptive concurrency%s, max %d: %s' %
+                         (' of %s' % name if name else '', self.maximum,
+                          curve))
+
+
+deadlines = DeadlineManager()
+atexit.register(deadlines.stop)
+
+
+class RetryPolicy(object):
+    '''How a command which failed with one of "codes" is launched again:
+    up to "count" more times, after backoff, 2 * backoff, 4 * backoff...
+    seconds. Commands streaming into a sink are not retried, their output
+    is already consumed, and neither are commands once the phase deadline
+    has passed.'''
+    def __init__(self, count=0, backoff=1.0, codes=None):
+        self.count = count
+        self.backoff = backoff
+        self.codes = codes if codes is not None else [255]
+
+    def retryable(self, launch, code, attempt):
+        if attempt >= self.count or code not in self.codes:
+            return False
+        if launch.sink is not None:
+            return False
+        phase = deadlines.phase
+        return not (phase and phase[1] is not None and
+                    phase[1] <= time.time() + self.delay(attempt))
+
+    def delay(self, attempt):
+        return self.backoff * 2 ** attempt
+
+    def log_retry(self, launch, code, attempt):
+        logger.warning('%s: exit code %s, retrying in %.1fs (%d of %d)' %
+                       (launch.label or launch.cmd, code,
+                        self.delay(attempt), attempt + 1, self.count))
+
+
+class Retries(object):
+    '''Retry policies per task type - the phase an item belongs to, see
+    RunItem.phase. "default" applies to phases without their own policy.
+    Commands launched outside of a RunItem get the policy of the current
+    phase.'''
+    def __init__(self):
+        self.policies = {}
+        # policy of the item being run by this worker process
+        self.active = None
+
+    def configure(self, policies):
+        self.policies = dict((name, RetryPolicy(**policy))
+                             for name, policy in policies.items())
+
+    def policy(self, item=None):
+        if item is not None and item.retry is not None:
+            return item.retry
+        if item is not None and item.phase:
+            phase = item.phase
+        else:
+            phase = (deadlines.phase or [None])[0]
+        return (self.policies.get(phase) or self.policies.get('default') or
+                RetryPolicy())
+
+    def run(self, launch):
+        '''Runs launch with the active policy, see RetryPolicy'''
+        policy = self.active or self.policy()
+        attempt = 0
+        while True:
+            outs, errs, code = launch.run()
+            if not policy.retryable(launch, code, attempt):
+                return outs, errs, code
+            policy.log_retry(launch, code, attempt)
+            time.sleep(policy.delay(attempt))
+            attempt += 1
+
+
+retries = Retries()
+
+
+class TimeBudget(object):
+    '''Run time budget shared by all phases, see time_budget. Work is
+    admitted by priority as the budget runs out: everything while more
+    than half of it is left, priority 0 (the default) and above until it
+    is spent, only priority 1 and above after that.'''
+    def __init__(self):
+        self.total = None
+        self.end = None
+
+    def start(self, seconds):
+        if seconds:
+            self.total = seconds
+            self.end = time.time() + seconds
+        else:
+            self.total = self.end = None
+
+    def left(self):
+        '''Seconds left, None without a budget'''
+        if self.end is None:
+            return None
+        return self.end - time.time()
+
+    def tight(self):
+        return self.end is not None and self.left() <= self.total / 2.0
+
+    def admits(self, priority):
+        if not self.tight():
+            return True
+        if self.left() > 0:
+            return priority >= 0
+        return priority >= 1
+
+    def admitted_for(self, priority):
+        '''Seconds work of priority is still admitted for, None if it
+        always is'''
+        if self.end is None or priority >= 1:
+            return None
+        left = self.left()
+        if priority < 0:
+            left -= self.total / 2.0
+        return max(0, left)
+
+
+budget = TimeBudget()
+
+
+class DurationHistory(object):
+    '''Per-task, per-node durations from previous runs, kept in a JSON file
+    as {task: {node key: seconds}}. Each new duration is averaged with the
+    stored one, so a single outlier does not dominate.'''
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = {}
+        if filename and os.path.exists(filename):
+            try:
+                with open(filename, 'r') as f:
+                    self.data = json.load(f)
+            except (IOError, ValueError):
+                logger.warning('could not load duration history from %s' %
+                               filename)
+
+    def expected(self, task, key):
+        return self.data.get(task, {}).get(str(key))
+
+    def record(self, task, key, duration):
+        durations = self.data.setdefault(task, {})
+        previous = durations.get(str(key))
+        if previous is not None:
+            duration = (previous + duration) / 2.0
+        durations[str(key)] = round(duration, 3)
+
+    def save(self):
+        if not self.filename:
+            return
+        tmp = '%s.%d' % (self.filename, os.getpid())
+        try:
+            directory = os.path.dirname(self.filename)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(tmp, 'w') as f:
+                json.dump(self.data, f)
+            os.rename(tmp, self.filename)
+        except (IOError, OSError):
+            logger.warning('could not save duration history to %s' %
+                           self.filename)
+
+
+class Journal(object):
+    '''Append-only record of finished units of work, one JSON object per
+    line with node, phase, unit, ok and any result metadata. Every line is
+    written with a single O_APPEND write, so workers can share the file.
+    With resume=True the records of previous runs are loaded and done()
+    tells which units can be skipped - the last record of a unit wins.'''
+    def __init__(self, filename, resume=False):
+        self.filename = filename
+        # rounded like the time of records, see skipped()
+        self.started = round(time.time(), 3)
+        self.records = {}
+        if resume and os.path.exists(filename):
+            with open(filename, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        key = (record['node'], record['phase'],
+                               record['unit'])
+                    except (ValueError, KeyError, TypeError):
+                        # a line cut short by an interrupted run
+                        continue
+                    self.records[key] = record
+            logger.info('journal: %d units recorded in %s' %
+                        (len(self.records), filename))
+
+    def get(self, node, phase, unit):
+        return self.records.get((str(node), phase, unit))
+
+    def done(self, node, phase, unit):
+        record = self.get(node, phase, unit)
+        return bool(record and record['ok'])
+
+    def skipped(self):
+        '''Records of this run with "skipped" set, in order'''
+        result = []
+        try:
+            with open(self.filename, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if (record.get('skipped') and
+                            record.get('time', 0) >= self.started):
+                        result.append(record)
+        except IOError:
+            pass
+        return result
+
+    def record(self, node, phase, unit, ok, **meta):
+        meta.update({'node': str(node), 'phase': phase, 'unit': unit,
+                     'ok': bool(ok), 'time': round(time.time(), 3)})
+        line = json.dumps(meta) + '\n'
+        try:
+            fd = os.open(self.filename,
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logger.warning('journal: could not write to %s: %s' %
+                           (self.filename, e.strerror))
+
+
 class RunItem():
-    def __init__(self, target, args=None, key=None, logger=None):
+    def __init__(self, target, args=None, key=None, logger=None,
+                 coroutine=None, phase=None, retry=None, idempotent=False):
         self.target = target
         self.args = args
         self.key = key
-        self.process = None
-        self.queue = None
+        # used by run_chains for per-phase limits and deadlines
+        self.phase = phase
+        # RetryPolicy of the item's commands, default is the phase policy
+        self.retry = retry
+        # safe to run twice at once - run_chains may hedge it if hedge is set
+        self.idempotent = idempotent
+        # seconds it took to run, set once it finished
+        self.duration = None
+        # generator-based equivalent of target, used by AsyncEngine
+        self.coroutine = coroutine
         self.logger = logger or logging.getLogger(project_name)
 
 
-class SemaphoreProcess(mp.Process):
-    def __init__(self, semaphore, target, args=None, queue=None, logger=None):
-        mp.Process.__init__(self)
+class WorkerPool(object):
+    '''Prefork pool of long-lived workers executing RunItems.
+
+    Workers are forked once per pool, each with its own pipe: item indexes
+    go down the pipe and pickled results come back. The scheduler waits on
+    all pipes at once with poll(), so it wakes up the moment any worker
+    finishes an item or dies (EOF on its pipe). Since workers are forked
+    after the item list is built, targets (usually bound Node methods) are
+    inherited as-is and do not need to be picklable.'''
+    def __init__(self, items, size, logger=None):
         self.logger = logger or logging.getLogger(project_name)
-        self.semaphore = semaphore
-        self.target = target
-        if not args:
-            args = {}
-        self.args = args
-        self.queue = queue
+        self.items = items
+        self.size = max(1, min(size, len(items)))
+        # workers are spawned on demand, up to size
+        self.workers = []
+        self.conns = []
+        # index of the item each worker is busy with, None = idle
+        self.current = []
+        self.slots = {}
+        self.poller = select.poll()
 
-    def run(self):
+    def spawn(self, slot=None):
+        if slot is None:
+            slot = len(self.workers)
+            self.workers.append(None)
+            self.conns.append(None)
+            self.current.append(None)
+        conn, worker_conn = mp.Pipe()
+        worker = mp.Process(target=self.work, args=(worker_conn,))
+        worker.start()
+        # the worker must hold the only copy of its end to make EOF work
+        worker_conn.close()
+        self.workers[slot] = worker
+        self.conns[slot] = conn
+        self.current[slot] = None
+        self.slots[conn.fileno()] = slot
+        self.poller.register(conn.fileno(), select.POLLIN)
+        self.logger.debug('started worker, pid: %s, slot: %s' %
+                          (worker.pid, slot))
+
+    def work(self, conn):
         setup_handle_sig(subprocess=True)
-        fin_msg = 'finished subprocess, pid: %s'
-        sem_msg = 'semaphore released by subprocess, pid: %s'
-        try:
-            result = self.target(**self.args)
-            if self.queue:
-                self.queue.put_nowait(result)
-        except Exception as error:
-            if self.queue:
-                self.queue.put_nowait(error)
-                self.queue.put_nowait(traceback.format_exc())
-        finally:
-            self.logger.debug(fin_msg % self.pid)
-            self.semaphore.release()
-            self.logger.debug(sem_msg % self.pid)
+        signal.signal(signal.SIGUSR2, cancel_worker)
+        while True:
+            try:
+                index = conn.recv()
+            except EOFError:
+                break
+            if index is None:
+                break
+            item = self.items[index]
+            if item.phase and item.phase != (deadlines.phase or [None])[0]:
+                # items of several phases share the pool, see run_chains
+                deadlines.set_phase(item.phase)
+            retries.active = retries.policy(item)
+            try:
+                result = item.target(**(item.args or {}))
+                payload = pickle.dumps((index, result, None,
+                                        deadlines.pop_expired(),
+                                        deadlines.pop_failures()), 2)
+            except Exception as error:
+                error_tb = traceback.format_exc()
+                try:
+                    payload = pickle.dumps((index, error, error_tb, [], 0),
+                                           2)
+                except Exception:
+                    payload = pickle.dumps((index, Exception(str(error)),
+                                            error_tb, [], 0), 2)
+            conn.send_bytes(payload)
+        self.logger.debug('worker exiting, pid: %s' % os.getpid())
 
+    def submit(self, index):
+        if None not in self.current:
+            self.spawn()
+        slot = self.current.index(None)
+        self.current[slot] = index
+        self.conns[slot].send(index)
 
-def run_batch(item_list, maxthreads, dict_result=False):
-    exc_msg = 'exception in subprocess, pid: %s, details:'
-    rem_msg = 'removing reference to finished subprocess, pid: %s'
-    emp_msg = 'subprocess did not return results, pid: %s'
+    def wait(self, timeout=None):
+        '''Blocks until at least one worker finishes or dies. Returns a
+        list of (index, result, traceback, expired commands, ssh failures)
+        of finished items and a list of indexes of items lost with dead
+        workers.'''
+        finished = []
+        lost = []
+        ms = None if timeout is None else timeout * 1000
+        for fd, event in self.poller.poll(ms):
+            slot = self.slots[fd]
+            try:
+                finished.append(pickle.loads(self.conns[slot].recv_bytes()))
+                self.current[slot] = None
+            except (EOFError, IOError):
+                if self.current[slot] is not None:
+                    lost.append(self.current[slot])
+                self.respawn(slot)
+        return finished, lost
 
-    def cleanup(launched):
-        logger.info('cleaning up running subprocesses')
-        for proc in launched.values():
-            logger.debug('terminating subprocess, pid: %s' % proc.pid)
-            proc.terminate()
-            proc.join()
+    def respawn(self, slot):
+        worker = self.workers[slot]
+        worker.join()
+        self.logger.warning('worker died, pid: %s, exit code: %s' %
+                            (worker.pid, worker.exitcode))
+        self.replace(slot)
 
-    def get_result(proc, key, results):
-        try:
-            results[key] = proc.queue.get(block=False)
-        except Queue.Empty:
-            if not proc.is_alive():
-                logger.warning(emp_msg % proc.pid)
-
-    def collect_results(l, join=False):
-        results = {}
-        remove_procs = []
-        for key, proc in l.items():
-            if not proc.is_alive() or join:
-                logger.debug('joining subprocess, pid: %s' % proc.pid)
-                while proc.is_alive():
-                    get_result(proc, key, results)
-                    proc.join(timeout=1)
-                if key not in results:
-                    get_result(proc, key, results)
-                if key in results and isinstance(results[key], Exception):
-                    exc_text = proc.queue.get()
-                    logger.critical(exc_msg % proc.pid)
-                    for line in exc_text.splitlines():
-                        logger.critical('____%s' % line)
-                    cleanup(l)
-                    print_and_exit(109)
-                remove_procs.append(key)
-        for key in remove_procs:
-            logger.debug(rem_msg % key)
-            l.pop(key)
-        return results
+    def cancel(self, index):
+        '''Kills the workers busy with item index, along with their
+        commands, and replaces them. Returns how many were killed.'''
+        slots = [s for s, i in enumerate(self.current) if i == index]
+        for slot in slots:
+            worker = self.workers[slot]
+            # the worker kills its commands first, see cancel_worker
+            try:
+                os.kill(worker.pid, signal.SIGUSR2)
+            except OSError:
+                pass
+            worker.join(DeadlineManager.kill_grace)
+            # workers lead their own process group, see work()
+            kill_group(worker.pid, signal.SIGKILL)
+            worker.join()
+            self.logger.debug('cancelled item %s, worker pid: %s' %
+                              (index, worker.pid))
+            self.replace(slot)
+        return len(slots)
 
-    semaphore = mp.BoundedSemaphore(maxthreads)
-    launched = {}
-    results = {}
-    if not dict_result:
-        key = 0
-    for run_item in item_list:
-        results.update(collect_results(launched))
-        semaphore.acquire(block=True)
-        p = SemaphoreProcess(target=run_item.target,
-                             semaphore=semaphore,
-                             args=run_item.args,
-                             queue=mp.Queue())
-        p.start()
-        if dict_result:
-            launched[run_item.key] = p
-            logger.debug('started subprocess, pid: %s, func: %s, key: %s' %
-                         (p.pid, run_item.target, run_item.key))
-        else:
-            launched[key] = p
-            key += 1
-            logger.debug('started subprocess, pid:%s, func:%s, key:%s' %
-                         (p.pid, run_item.target, key))
+    def replace(self, slot):
+        self.poller.unregister(self.conns[slot].fileno())
+        self.slots.pop(self.conns[slot].fileno())
+        self.conns[slot].close()
+        self.spawn(slot)
+
+    def stop(self):
+        for conn in self.conns:
+            conn.send(None)
+        for worker in self.workers:
+            worker.join()
+        for conn in self.conns:
+            conn.close()
+
+    def terminate(self):
+        self.logger.info('cleaning up running subprocesses')
+        for worker in self.workers:
+            if worker.is_alive():
+                self.logger.debug('terminating subprocess, pid: %s' %
+                                  worker.pid)
+                worker.terminate()
+            worker.join()
 
-    results.update(collect_results(launched, True))
+
+def run_batch(item_list, maxthreads, dict_result=False, limiter=None,
+              hedge=False):
+    '''Runs items on a WorkerPool of up to maxthreads workers. If limiter
+    (see AdaptiveLimit) is given, it decides how many of them are used.
+    See run_chains for hedge.'''
+    chains = run_chains([[item] for item in item_list], maxthreads,
+                        limiter=limiter, hedge=hedge)
+    results = dict((i, chain[0]) for i, chain in enumerate(chains) if chain)
     if dict_result:
-        return results
+        return dict((item_list[i].key, results[i]) for i in sorted(results))
     else:
-        return results.values()
+        return [results[i] for i in sorted(results)]
+
+
+def run_chains(chains, maxthreads, phase_limits=None, limiter=None,
+               hedge=False):
+    '''Runs lists of RunItems on a WorkerPool of up to maxthreads workers.
+
+    Items of a chain run one after another, in order, while different
+    chains proceed independently, so a slow chain does not hold back the
+    others. At most phase_limits[item.phase] items of the same phase run
+    at once. If limiter (see AdaptiveLimit) is given, it decides how many
+    workers are used. Returns a {position in chain: result} dict per
+    chain, items lost with a dead worker have no result.
+
+    If hedge is set, an idempotent item still running after the 95th
+    percentile of durations of its finished peers (at least
+    hedge_min_peers of them, same phase) gets a second copy on a free
+    worker. Whichever copy finishes first provides the result, the other
+    one's result is dropped.'''
+    exc_msg = 'exception in subprocess, func: %s, key: %s, details:'
+    emp_msg = 'subprocess did not return results, func: %s, key: %s'
+    hedge_min_peers = 5
+
+    phase_limits = phase_limits or {}
+    items = []
+    # chain and position in it of every item
+    owners = []
+    for c, chain in enumerate(chains):
+        for position, item in enumerate(chain):
+            items.append(item)
+            owners.append((c, position))
+    results = [{} for chain in chains]
+    if not items:
+        return results
+    first = [0] * len(chains)
+    for c in range(1, len(chains)):
+        first[c] = first[c - 1] + len(chains[c - 1])
+    positions = [0] * len(chains)
+    ready = [c for c, chain in enumerate(chains) if chain]
+    phases = {}
+    started = {}
+    pool = WorkerPool(items, maxthreads)
+    in_flight = 0
+    # hedging - running copies of items, finished ones, peer durations
+    copies = {}
+    done = set()
+    durations = {}
+
+    def item_done(index):
+        done.add(index)
+        c, position = owners[index]
+        positions[c] += 1
+        if positions[c] < len(chains[c]):
+            ready.append(c)
+
+    def copy_done(index):
+        copies[index] -= 1
+        phases[items[index].phase] -= 1
+        return index in done
+
+    def hedge_after(phase):
+        peers = sorted(durations.get(phase, []))
+        if len(peers) < hedge_min_peers:
+            return None
+        return peers[min(len(peers) - 1, int(len(peers) * 0.95))]
+
+    while ready or in_flight:
+        limit = min(pool.size, limiter.current if limiter else pool.size)
+        waiting = []
+        for c in ready:
+            index = first[c] + positions[c]
+            run_item = items[index]
+            phase_limit = phase_limits.get(run_item.phase)
+            if (in_flight >= limit or (phase_limit and
+                                       phases.get(run_item.phase, 0) >=
+                                       phase_limit)):
+                waiting.append(c)
+                continue
+            logger.debug('submitting item, func: %s, key: %s' %
+                         (run_item.target, run_item.key))
+            pool.submit(index)
+            started[index] = time.time()
+            copies[index] = 1
+            phases[run_item.phase] = phases.get(run_item.phase, 0) + 1
+            in_flight += 1
+        ready[:] = waiting
+        wait = None
+        if hedge:
+            now = time.time()
+            candidates = [i for i, n in copies.items()
+                          if n == 1 and i not in done and
+                          items[i].idempotent]
+            for index in candidates:
+                after = hedge_after(items[index].phase)
+                if after is None or in_flight >= limit:
+                    continue
+                if now - started[index] > after:
+                    run_item = items[index]
+                    logger.info('hedging item, func: %s, key: %s, running '
+                                '%.1fs, p95 of peers %.1fs' %
+                                (run_item.target, run_item.key,
+                                 now - started[index], after))
+                    pool.submit(index)
+                    copies[index] = 2
+                    phases[run_item.phase] += 1
+                    in_flight += 1
+                else:
+                    wait = 0.5
+        finished, lost = pool.wait(wait)
+        for index in lost:
+            in_flight -= 1
+            if copy_done(index) or copies[index]:
+                # the other copy finished or is still running
+                continue
+            run_item = items[index]
+            logger.warning(emp_msg % (run_item.target, run_item.key))
+            item_done(index)
+            if limiter:
+                limiter.update(time.time() - started[index], failures=1)
+        for index, result, error_tb, expired, failures in finished:
+            deadlines.expired.extend(expired)
+            in_flight -= 1
+            if copy_done(index):
+                logger.debug('dropping result of a hedged copy, key: %s' %
+                             items[index].key)
+                continue
+            if copies[index]:
+                # the other copy of a hedged item is not needed any more
+                cancelled = pool.cancel(index)
+                copies[index] -= cancelled
+                phases[items[index].phase] -= cancelled
+                in_flight -= cancelled
+            if limiter:
+                limiter.update(time.time() - started[index], failures)
+            run_item = items[index]
+            if error_tb:
+                logger.critical(exc_msg % (run_item.target, run_item.key))
+                for line in error_tb.splitlines():
+                    logger.critical('____%s' % line)
+                pool.terminate()
+                print_and_exit(109)
+            c, position = owners[index]
+            results[c][position] = result
+            run_item.duration = time.time() - started[index]
+            durations.setdefault(run_item.phase, []).append(
+                run_item.duration)
+            item_done(index)
+    pool.stop()
+    return results
 
 
 def load_json_file(filename):
@@ -290,85 +985,924 @@ def mdir(directory):
             print_and_exit(110)
 
 
-def launch_cmd(cmd, timeout, input=None, ok_codes=None):
-    def _timeout_terminate(pid):
-        try:
-            os.kill(pid, 15)
-            logger.error("launch_cmd: pid %d killed by timeout" % pid)
-        except OSError:
-            pass
+def launch_cmd(cmd, timeout, input=None, ok_codes=None, sink=None,
+               errs_limit=None, label=None):
+    '''Runs cmd, returns (stdout, stderr, exit code).
 
+    If sink is given, stdout is passed to sink.write() in chunks as it
+    arrives and '' is returned instead. If errs_limit is given, only that
+    many bytes of stderr are kept. Either way the command is streamed
+    through a bounded buffer instead of communicate(). The command is
+    killed by deadlines, label names it in the report of expired ones.'''
     logger.debug('cmd: %s' % cmd)
-    p = subprocess.Popen(cmd,
-                         shell=True,
-                         stdin=subprocess.PIPE,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE, close_fds=True)
-    timeout_killer = None
+    streaming = (sink is not None or errs_limit is not None or
+                 not isinstance(input, (basestring, type(None))))
+    if streaming:
+        proc = _Proc(Launch(cmd, timeout, input=input, ok_codes=ok_codes,
+                            sink=sink, errs_limit=errs_limit, label=label))
+        p = proc.p
+    else:
+        p = subprocess.Popen(cmd,
+                             shell=True,
+                             stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, close_fds=True,
+                             preexec_fn=start_session)
+    deadline = deadlines.add(p.pid, timeout, label or cmd)
     outs = None
     errs = None
     try:
-        timeout_killer = threading.Timer(timeout, _timeout_terminate, [p.pid])
-        timeout_killer.start()
+        if streaming:
+            proc.communicate()
+            return proc.result()
         outs, errs = p.communicate(input=input)
     finally:
-        if timeout_killer:
-            timeout_killer.cancel()
-        if logger.isEnabledFor(logging.DEBUG):
-            # p_out = unicode(outs, 'utf-8', 'replace')
-            p_err = unicode(errs, 'utf-8', 'replace').rstrip('\n')
-            p_inp = unicode(input, 'utf-8', 'replace') if input else None
-            logger.debug(('___command: %s\n'
-                          '_______pid: %s\n'
-                          '_exit_code: %s\n'
-                          '_____stdin: %s\n'
-                          '____stderr: %s') % (cmd, p.pid, p.returncode, p_inp,
-                                               p_err))
+        deadlines.done(deadline, p.returncode)
+        if not streaming:
+            log_cmd_result(cmd, p.pid, p.returncode, input, errs)
     return outs, errs, p.returncode
 
 
+def log_cmd_result(cmd, pid, code, input, errs):
+    if logger.isEnabledFor(logging.DEBUG):
+        # p_out = unicode(outs, 'utf-8', 'replace')
+        p_err = unicode(errs, 'utf-8', 'replace').rstrip('\n')
+        if isinstance(input, basestring):
+            p_inp = unicode(input, 'utf-8', 'replace') if input else None
+        else:
+            p_inp = repr(input)
+        logger.debug(('___command: %s\n'
+                      '_______pid: %s\n'
+                      '_exit_code: %s\n'
+                      '_____stdin: %s\n'
+                      '____stderr: %s') % (cmd, pid, code, p_inp, p_err))
+
+
+class Launch(object):
+    '''A command yielded by a node coroutine. It is launched by whoever
+    drives the coroutine - launch_cmd via run_sync, or AsyncEngine - and
+    (outs, errs, code) is sent back into the coroutine.'''
+    def __init__(self, cmd, timeout, input=None, ok_codes=None, sink=None,
+                 errs_limit=None, label=None):
+        self.cmd = cmd
+        self.label = label
+        self.timeout = timeout
+        self.input = input
+        self.ok_codes = ok_codes
+        self.sink = sink
+        self.errs_limit = errs_limit
+
+    def run(self):
+        return launch_cmd(self.cmd, self.timeout, input=self.input,
+                          ok_codes=self.ok_codes, sink=self.sink,
+                          errs_limit=self.errs_limit, label=self.label)
+
+
+class Return(Exception):
+    '''Raised by a node coroutine to return a value, since Python 2
+    generators can not use "return value".'''
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+
+def run_sync(coroutine):
+    '''Drives a node coroutine in the current process, see Launch'''
+    stack = [coroutine]
+    value = None
+    while stack:
+        try:
+            step = stack[-1].send(value)
+        except Return as r:
+            stack.pop()
+            value = r.value
+            continue
+        except StopIteration:
+            stack.pop()
+            value = None
+            continue
+        if isinstance(step, Launch):
+            value = retries.run(step)
+        elif isinstance(step, types.GeneratorType):
+            # sub-coroutine, its result is sent to the caller
+            stack.append(step)
+            value = None
+        else:
+            value = step
+    return value
+
+
+def input_chunks(input):
+    '''Iterator over the chunks of a command's input - a string, or an
+    iterable of strings like NulList'''
+    if isinstance(input, basestring):
+        return iter([input])
+    return iter(input or [])
+
+
+class NulList(object):
+    '''Input of a command reading a NUL-separated list, like tar
+    --null --files-from -. The list is produced from items as it is
+    written, in chunks of about "chunk" bytes, and can be iterated again
+    when the command is retried. Only items for which select returns True
+    are listed, if it is given, and lstrip is stripped from every item.'''
+    chunk = 65536
+
+    def __init__(self, items, lstrip=None, select=None):
+        self.items = items
+        self.lstrip = lstrip
+        self.select = select
+
+    def __iter__(self):
+        parts = []
+        size = 0
+        for item in self.items:
+            if self.select and not self.select(item):
+                continue
+            if self.lstrip:
+                item = item.lstrip(self.lstrip)
+            parts.append(item)
+            size += len(item) + 1
+            if size >= self.chunk:
+                parts.append('')
+                yield '\0'.join(parts)
+                parts = []
+                size = 0
+        if parts:
+            parts.append('')
+            yield '\0'.join(parts)
+
+    def __repr__(self):
+        return '<NUL-separated list of %s>' % type(self.items).__name__
+
+
+class _Proc(object):
+    '''Subprocess with non-blocking, bounded-buffer I/O, used by
+    AsyncEngine and by launch_cmd in streaming mode'''
+    chunk = 65536
+
+    def __init__(self, launch, task=None):
+        logger.debug('cmd: %s' % launch.cmd)
+        self.launch = launch
+        self.task = task
+        self.p = subprocess.Popen(launch.cmd,
+                                  shell=True,
+                                  stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE, close_fds=True,
+                                  preexec_fn=start_session)
+        self.input = input_chunks(launch.input)
+        self.pending = ''
+        self.pending_offset = 0
+        self.out = launch.sink if launch.sink is not None else []
+        self.err = []
+        self.err_size = 0
+        self.err_dropped = 0
+        self.streams = {self.p.stdout.fileno(): self.out,
+                        self.p.stderr.fileno(): self.err}
+        self.stdin_fd = None
+        if launch.input:
+            self.stdin_fd = self.p.stdin.fileno()
+            # a write must not wait for the child to read - it may be
+            # waiting itself for its output to be read
+            flags = fcntl.fcntl(self.stdin_fd, fcntl.F_GETFL)
+            fcntl.fcntl(self.stdin_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        else:
+            self.p.stdin.close()
+
+    def write(self):
+        '''Writes the next chunk of input, returns True when done'''
+        while self.pending_offset >= len(self.pending):
+            self.pending = next(self.input, None)
+            self.pending_offset = 0
+            if self.pending is None:
+                self.p.stdin.close()
+                return True
+        data = buffer(self.pending, self.pending_offset, self.chunk)
+        try:
+            self.pending_offset += os.write(self.p.stdin.fileno(), data)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                # the pipe is full, wait for the next POLLOUT
+                return False
+            # child closed stdin early, same as communicate() does
+            self.p.stdin.close()
+            return True
+
+    def read(self, fd):
+        '''Reads available output, returns True on EOF'''
+        data = os.read(fd, self.chunk)
+        if not data:
+            self.streams.pop(fd)
+            return True
+        stream = self.streams[fd]
+        if stream is self.launch.sink:
+            stream.write(data)
+        elif stream is self.err and self.launch.errs_limit is not None:
+            keep = max(0, self.launch.errs_limit - self.err_size)
+            if keep < len(data):
+                self.err_dropped += len(data) - keep
+                data = data[:keep]
+            if data:
+                self.err.append(data)
+                self.err_size += len(data)
+        else:
+            stream.append(data)
+
+    def communicate(self):
+        '''Blocks until the process exits, pumping its pipes'''
+        poller = select.poll()
+        fds = list(self.streams)
+        for fd in fds:
+            poller.register(fd, select.POLLIN | select.POLLPRI)
+        if self.stdin_fd is not None:
+            poller.register(self.stdin_fd, select.POLLOUT)
+        while self.streams or not self.p.stdin.closed:
+            for fd, event in poller.poll():
+                if fd == self.stdin_fd:
+                    if event & (select.POLLERR | select.POLLHUP):
+                        self.p.stdin.close()
+                        done = True
+                    else:
+                        done = self.write()
+                else:
+                    done = self.read(fd)
+                if done:
+                    poller.unregister(fd)
+        self.p.stdout.close()
+        self.p.stderr.close()
+        self.p.wait()
+
+    def result(self):
+        errs = ''.join(self.err)
+        if self.err_dropped:
+            errs += '\n[%d more bytes of stderr dropped]\n' % self.err_dropped
+        log_cmd_result(self.launch.cmd, self.p.pid, self.p.returncode,
+                       self.launch.input, errs)
+        if self.launch.sink is not None:
+            return '', errs, self.p.returncode
+        return ''.join(self.out), errs, self.p.returncode
+
+
+class AsyncEngine(object):
+    '''Drives node coroutines (see RunItem.coroutine) from one process.
+
+    Commands yielded by the coroutines are started as subprocesses and
+    their pipes are multiplexed with poll(); timeouts are enforced by
+    deadlines like for any other command. At most "limit" coroutines are
+    in progress at any time, or as many as limiter allows.'''
+    def __init__(self, limit, logger=None, limiter=None):
+        self.logger = logger or logging.getLogger(project_name)
+        self.limit = max(1, limit)
+        self.limiter = limiter
+        self.poller = select.poll()
+        self.fds = {}
+        self.reaping = []
+        # (time, launch, task) of commands to launch again, see Retries
+        self.delayed = []
+        self.raise_nofile_limit()
+
+    def raise_nofile_limit(self):
+        # each command in flight holds 3 pipes in this process
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or soft < hard:
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            except (ValueError, resource.error):
+                pass
+
+    def run(self, item_list, dict_result=False):
+        exc_msg = 'exception in coroutine, func: %s, key: %s, details:'
+        self.results = {}
+        pending = list(reversed(range(len(item_list))))
+        running = 0
+        while pending or running:
+            failed = []
+            limit = self.limit
+            if self.limiter:
+                limit = min(limit, self.limiter.current)
+            while pending and running < limit:
+                index = pending.pop()
+                run_item = item_list[index]
+                task = {'index': index, 'stack': [], 'start': time.time(),
+                        'item': run_item}
+                running += 1
+                try:
+                    args = run_item.args or {}
+                    task['stack'].append(run_item.coroutine(**args))
+                    self.advance(task, None)
+                except Exception:
+                    failed.append((task, traceback.format_exc()))
+            if running and not failed:
+                failed = self.wait()
+            for task, error_tb in failed:
+                run_item = item_list[task['index']]
+                self.logger.critical(exc_msg % (run_item.coroutine,
+                                                run_item.key))
+                for line in error_tb.splitlines():
+                    self.logger.critical('____%s' % line)
+                self.terminate()
+                print_and_exit(109)
+            running = len(item_list) - len(pending) - len(self.results)
+        results = self.results
+        if dict_result:
+            return dict((item_list[i].key, results[i])
+                        for i in sorted(results))
+        else:
+            return [results[i] for i in sorted(results)]
+
+    def advance(self, task, value):
+        '''Runs task until it yields a command or finishes'''
+        stack = task['stack']
+        while stack:
+            try:
+                step = stack[-1].send(value)
+            except Return as r:
+                stack.pop()
+                value = r.value
+                continue
+            except StopIteration:
+                stack.pop()
+                value = None
+                continue
+            if isinstance(step, Launch):
+                self.start(step, task)
+                return
+            elif isinstance(step, types.GeneratorType):
+                stack.append(step)
+                value = None
+            else:
+                value = step
+        self.results[task['index']] = value
+        task['item'].duration = time.time() - task['start']
+        if self.limiter:
+            self.limiter.update(task['item'].duration,
+                                deadlines.pop_failures())
+
+    def start(self, launch, task):
+        proc = _Proc(launch, task)
+        task['proc'] = proc
+        for fd in proc.streams:
+            self.fds[fd] = proc
+            self.poller.register(fd, select.POLLIN | select.POLLPRI)
+        if proc.stdin_fd is not None:
+            self.fds[proc.stdin_fd] = proc
+            self.poller.register(proc.stdin_fd, select.POLLOUT)
+        proc.deadline = deadlines.add(proc.p.pid, launch.timeout,
+                                      launch.label or launch.cmd)
+
+    def wait(self):
+        '''Waits for I/O and timeouts, advances tasks whose commands
+        finished. Returns a list of (task, traceback) for tasks which
+        raised an exception.'''
+        failed = []
+        timeout = 1.0
+        if self.reaping:
+            timeout = min(timeout, 0.05)
+        if self.delayed:
+            now = time.time()
+            due = [d for d in self.delayed if d[0] <= now]
+            self.delayed = [d for d in self.delayed if d[0] > now]
+            for when, launch, task in due:
+                self.start(launch, task)
+            if self.delayed:
+                timeout = min(timeout,
+                              min([d[0] for d in self.delayed]) - now)
+        for fd, event in self.poller.poll(timeout * 1000):
+            proc = self.fds[fd]
+            if fd == proc.stdin_fd:
+                if event & (select.POLLERR | select.POLLHUP):
+                    # child closed stdin without reading all input
+                    proc.p.stdin.close()
+                    done = True
+                else:
+                    done = proc.write()
+            else:
+                done = proc.read(fd)
+            if done:
+                self.poller.unregister(fd)
+                self.fds.pop(fd)
+                if not proc.streams and proc.p.stdin.closed:
+                    self.reaping.append(proc)
+        still_reaping = []
+        for proc in self.reaping:
+            if proc.p.poll() is None:
+                still_reaping.append(proc)
+                continue
+            proc.p.stdout.close()
+            proc.p.stderr.close()
+            deadlines.done(proc.deadline, proc.p.returncode)
+            task = proc.task
+            task.pop('proc')
+            policy = retries.policy(task['item'])
+            attempt = task.get('attempt', 0)
+            if policy.retryable(proc.launch, proc.p.returncode, attempt):
+                policy.log_retry(proc.launch, proc.p.returncode, attempt)
+                task['attempt'] = attempt + 1
+                self.delayed.append((time.time() + policy.delay(attempt),
+                                     proc.launch, task))
+                continue
+            task['attempt'] = 0
+            try:
+                self.advance(task, proc.result())
+            except Exception:
+                failed.append((task, traceback.format_exc()))
+        self.reaping = still_reaping
+        return failed
+
+    def terminate(self):
+        for proc in set(self.fds.values()) | set(self.reaping):
+            kill_group(proc.p.pid, signal.SIGTERM)
+
+
+def run_batch_async(item_list, maxthreads, dict_result=False, limiter=None):
+    '''Same as run_batch but drives RunItem.coroutine of each item from
+    the current process, see AsyncEngine'''
+    engine = AsyncEngine(maxthreads, limiter=limiter)
+    return engine.run(item_list, dict_result=dict_result)
+
+
 def ssh_node(ip, command='', ssh_opts=None, env_vars=None, timeout=15,
              filename=None, inputfile=None, outputfile=None,
-             ok_codes=None, input=None, prefix=None):
+             ok_codes=None, input=None, prefix=None, defer=False, sink=None,
+             errs_limit=None):
     if not ssh_opts:
         ssh_opts = ''
     if not env_vars:
         env_vars = ''
+    if not prefix:
+        prefix = ''
     if type(ssh_opts) is list:
         ssh_opts = ' '.join(ssh_opts)
     if type(env_vars) is list:
         env_vars = ' '.join(env_vars)
     if (ip in ['localhost', '127.0.0.1']) or ip.startswith('127.'):
         logger.debug("skip ssh")
-        bstr = "%s timeout '%s' bash -c " % (
+        bstr = "exec env %s timeout '%s' bash -c " % (
                env_vars, timeout)
     else:
-        bstr = "timeout '%s' ssh -T %s '%s' '%s' " % (
-               timeout, ssh_opts, ip, env_vars)
+        # ssh joins its arguments into the remote command line, env_vars
+        # and the command get there as they were given
+        bstr = "exec timeout '%s' ssh -T %s '%s' %s " % (
+               timeout, ssh_opts, ip, quote(env_vars))
     if filename is None:
         cmd = '%s %s' % (bstr, quote(prefix + ' ' + command))
         if inputfile is not None:
             '''inputfile and stdin will not work together,
             give priority to inputfile'''
             input = None
-            cmd = "%s < '%s'" % (cmd, inputfile)
+            cmd = "%s < %s" % (cmd, quote(inputfile))
     else:
-        cmd = "%s'%s bash -s' < '%s'" % (bstr, prefix, filename)
+        cmd = "%s%s < %s" % (bstr, quote(prefix + ' bash -s'),
+                             quote(filename))
     if outputfile is not None:
-        cmd = "%s > '%s'" % (cmd, outputfile)
+        cmd = "%s > %s" % (cmd, quote(outputfile))
     logger.info("cmd: %s" % cmd)
-    cmd = ("input=\"$(cat | xxd -p)\"; trap 'kill $pid' 15; " +
-           "trap 'kill $pid' 2; echo -n \"$input\" | xxd -r -p | " + cmd +
-           ' &:; pid=$!; wait $!')
-    return launch_cmd(cmd, timeout, input=input,
-                      ok_codes=ok_codes)
+    '''exec replaces the shell with timeout, which reads stdin directly and
+    relays SIGTERM/SIGINT sent to the launched pid to ssh/bash'''
+    label = '%s: %s' % (ip, command if filename is None else filename)
+    launch = Launch(cmd, timeout, input=input, ok_codes=ok_codes, sink=sink,
+                    errs_limit=errs_limit, label=label)
+    return launch if defer else retries.run(launch)
+
+
+class CmdBatch(object):
+    '''Builds one bash script running several commands and scripts, each
+    under its own remote timeout. Every job reports back as a frame - a
+    header line "<marker> <index> <exit code> <stdout size> <stderr size>"
+    followed by its raw stdout and stderr, which lets sink() split the
+    combined output without any escaping. A "<marker> <index> start" line
+    precedes each job, a job given "until" seconds (since the batch
+    started) which have passed is not run and reports "<marker> <index>
+    skip" instead.'''
+    def __init__(self, timeout):
+        self.job_timeout = timeout
+        self.marker = 'TIMMY-FRAME-%s' % uuid.uuid4().hex
+        self.jobs = []
+
+    @property
+    def timeout(self):
+        # all jobs run one after another, plus some slack for the session
+        return self.job_timeout * (len(self.jobs) + 1)
+
+    def add_cmd(self, cmd, until=None):
+        self.jobs.append(("timeout '%s' bash -c '%s'" %
+                          (self.job_timeout, cmd), until))
+
+    def add_script(self, body, env_vars='', until=None):
+        if not body.endswith('\n'):
+            body += '\n'
+        eof = 'TIMMY-EOF-%s' % uuid.uuid4().hex
+        self.jobs.append(("cat > \"$d/s\" <<'%s'\n%s%s\n%s timeout '%s' bash "
+                          "\"$d/s\"" % (eof, body, eof, env_vars or '',
+                                        self.job_timeout), until))
+
+    def script(self):
+        lines = ['d="$(mktemp -d)" || exit 1',
+                 'trap \'rm -rf "$d"\' EXIT',
+                 'timmy_frame() {',
+                 '    printf \'%s %%s %%s %%s %%s\\n\' "$1" "$2" '
+                 '$(wc -c < "$d/o") $(wc -c < "$d/e")' % self.marker,
+                 '    cat "$d/o" "$d/e"',
+                 '}']
+        for index, (job, until) in enumerate(self.jobs):
+            run = ("printf '%s %s start\\n'; %s < /dev/null > \"$d/o\" "
+                   "2> \"$d/e\"; timmy_frame %s $?" %
+                   (self.marker, index, job, index))
+            if until is None:
+                lines.append(run)
+            else:
+                lines.append("if [ $SECONDS -lt %d ]; then %s\nelse printf "
+                             "'%s %s skip\\n'; fi" %
+                             (until, run, self.marker, index))
+        return '\n'.join(lines) + '\n'
+
+    def sink(self, paths, errs_limit=None):
+        '''Returns a launch_cmd sink writing the stdout of job N straight
+        into paths[N]'''
+        return _FrameSink(self.marker, paths, errs_limit)
 
 
-def get_files_rsync(ip, data, ssh_opts, rsync_opts, dpath, timeout=15):
+class _FrameSink(object):
+    '''Demultiplexes CmdBatch output as it arrives. results holds
+    {job index: (None, errs, code)} for jobs which reported back, started
+    holds indexes of jobs whose output file was (at least partly) written,
+    launched and skipped those of the start and skip lines. The sink is
+    broken after anything but a well-formed frame or line, only start lines
+    are looked for in the rest of the output then.'''
+    max_header = 4096
+
+    def __init__(self, marker, paths, errs_limit=None):
+        self.marker = marker
+        self.paths = paths
+        self.errs_limit = errs_limit
+        self.results = {}
+        self.started = set()
+        self.launched = set()
+        self.skipped = set()
+        self.header = ''
+        self.tail = ''
+        self.frame = None
+        self.broken = False
+
+    def write(self, data):
+        while data and not self.broken:
+            if self.frame is None:
+                eol = data.find('\n')
+                if eol == -1:
+                    self.header += data
+                    data = ''
+                    if len(self.header) > self.max_header:
+                        data = self.header
+                        self.fail()
+                    break
+                self.start_frame(self.header + data[:eol])
+                self.header = ''
+                data = data[eol + 1:]
+            elif self.frame['out_left']:
+                chunk = data[:self.frame['out_left']]
+                if self.frame['file']:
+                    self.frame['file'].write(chunk)
+                self.frame['out_left'] -= len(chunk)
+                data = data[len(chunk):]
+            else:
+                chunk = data[:self.frame['err_left']]
+                keep = len(chunk)
+                if self.errs_limit is not None:
+                    keep = max(0, min(keep, self.errs_limit -
+                                      self.frame['err_size']))
+                self.frame['errs'].append(chunk[:keep])
+                self.frame['err_size'] += keep
+                self.frame['err_left'] -= len(chunk)
+                data = data[len(chunk):]
+            if self.frame and not (self.frame['out_left'] or
+                                   self.frame['err_left']):
+                self.end_frame()
+        if self.broken:
+            self.scan(data)
+
+    def scan(self, data):
+        '''Notes the jobs launched after the output broke'''
+        data = self.tail + data
+        for match in re.finditer(r'%s (\d+) start\n' % self.marker, data):
+            self.launched.add(int(match.group(1)))
+        self.tail = data[-(len(self.marker) + 32):]
+
+    def start_frame(self, header):
+        fields = header.split(' ')
+        if (len(fields) == 3 and fields[0] == self.marker and
+                fields[2] in ['start', 'skip']):
+            self.job_line(fields[1], fields[2])
+            return
+        if len(fields) != 5 or fields[0] != self.marker:
+            self.fail()
+            return
+        try:
+            index, code, out_len, err_len = [int(f) for f in fields[1:]]
+        except ValueError:
+            self.fail()
+            return
+        if (not 0 <= index < len(self.paths) or index in self.started or
+                out_len < 0 or err_len < 0):
+            self.fail()
+            return
+        self.frame = {'index': index, 'code': code, 'out_left': out_len,
+                      'err_left': err_len, 'err_size': 0, 'errs': [],
+                      'file': None}
+        self.started.add(index)
+        try:
+            self.frame['file'] = open(self.paths[index], 'w')
+        except IOError:
+            logger.error("can't write to file %s" % self.paths[index])
+        if not (out_len or err_len):
+            self.end_frame()
+
+    def job_line(self, index, state):
+        try:
+            index = int(index)
+        except ValueError:
+            self.fail()
+            return
+        if (not 0 <= index < len(self.paths) or index in self.launched or
+                index in self.skipped):
+            self.fail()
+            return
+        (self.launched if state == 'start' else self.skipped).add(index)
+
+    def end_frame(self):
+        frame = self.frame
+        if frame['file']:
+            frame['file'].close()
+        self.results[frame['index']] = (None, ''.join(frame['errs']),
+                                        frame['code'])
+        self.frame = None
+
+    def fail(self):
+        logger.warning('unexpected data in batch output, ignoring the rest')
+        if self.frame and self.frame['file']:
+            self.frame['file'].close()
+        self.frame = None
+        self.broken = True
+
+
+class AgentError(Exception):
+    pass
+
+
+class AgentSession(object):
+    '''Long-lived session with timmy/agent.py on a node. The source of the
+    agent is passed on the command line of the interpreter, nothing is
+    written on the node; all requests of the process then share one ssh
+    session instead of a new ssh connection per command. See agent.py for
+    the protocol.'''
+    grace = 10
+
+    def __init__(self, ip, ssh_opts=None, timeout=15):
+        self.ip = ip
+        if type(ssh_opts) is list:
+            ssh_opts = ' '.join(ssh_opts)
+        self.ssh_opts = ssh_opts or ''
+        self.timeout = timeout
+        self.proc = None
+        self.buf = ''
+        self.version = None
+
+    @staticmethod
+    def source():
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'agent.py')
+        with open(path, 'rb') as f:
+            return f.read()
+
+    @property
+    def is_local(self):
+        return self.ip in ['localhost', '127.0.0.1'] or self.ip.startswith(
+            '127.')
+
+    def start(self):
+        '''Starts the agent, returns False if the node can not run it. The
+        source goes in with -c - a copy of the agent in a shared directory
+        like /tmp could be replaced by another user before it runs.'''
+        run = ('for p in python3 python python2; do "$p" -c "" 2>/dev/null '
+               '&& exec "$p" -u -c %s; done; exit 127' % quote(self.source()))
+        if self.is_local:
+            cmd = 'exec bash -c %s' % quote(run)
+        else:
+            cmd = "exec ssh -T %s '%s' %s" % (self.ssh_opts, self.ip,
+                                              quote(run))
+        logger.info('%s: starting agent, ssh options: %s' % (self.ip,
+                                                             self.ssh_opts))
+        with open(os.devnull, 'w') as devnull:
+            self.proc = subprocess.Popen(cmd, shell=True,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=devnull, close_fds=True,
+                                         preexec_fn=start_session)
+        try:
+            hello, body = self.recv(time.time() + self.timeout)
+            self.version = hello['version']
+        except (AgentError, ValueError, KeyError) as e:
+            logger.warning('%s: agent did not start: %s' % (self.ip, e))
+            self.close()
+            return False
+        return True
+
+    def fill(self, deadline):
+        fd = self.proc.stdout.fileno()
+        wait = deadline - time.time() if deadline else None
+        if wait is not None and wait <= 0:
+            raise AgentError('timed out')
+        if select.select([fd], [], [], wait)[0]:
+            data = os.read(fd, 65536)
+            if not data:
+                raise AgentError('session closed')
+            self.buf += data
+
+    def recv_bytes(self, size, deadline):
+        while len(self.buf) < size:
+            self.fill(deadline)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def recv(self, deadline=None):
+        while '\n' not in self.buf:
+            if len(self.buf) > 64:
+                raise AgentError('bad frame header')
+            self.fill(deadline)
+        header, self.buf = self.buf.split('\n', 1)
+        meta_len, body_len = [int(x) for x in header.split()]
+        meta = json.loads(self.recv_bytes(meta_len, deadline))
+        return meta, self.recv_bytes(body_len, deadline)
+
+    def send(self, meta, body=''):
+        '''Sends a frame, body is a string or an iterable of strings like
+        NulList, which is iterated twice - to count and to send it'''
+        meta = json.dumps(meta)
+        size = sum([len(chunk) for chunk in input_chunks(body)])
+        self.proc.stdin.write('%d %d\n%s' % (len(meta), size, meta))
+        for chunk in input_chunks(body):
+            self.proc.stdin.write(chunk)
+        self.proc.stdin.flush()
+
+    def call(self, method, meta, timeout, input=None, sink=None,
+             errs_limit=None, label=None):
+        '''Sends one request, returns (stdout, stderr, exit code) like
+        launch_cmd. Stdout is passed to sink.write() if sink is given. The
+        agent enforces the timeout, the session is killed by deadlines if
+        the reply is late or the phase deadline passes.'''
+        if not self.alive:
+            return '', '%s: agent session is closed' % str(self.ip), 255
+        request = dict(meta, method=method, timeout=timeout,
+                       errs_limit=errs_limit)
+        entry = deadlines.add(self.proc.pid, timeout + self.grace,
+                              label or method)
+        outs = []
+        errs = ''
+        code = None
+        try:
+            self.send(request, input or '')
+            while True:
+                reply, data = self.recv()
+                if reply['type'] == 'out':
+                    if sink is not None:
+                        sink.write(data)
+                    else:
+                        outs.append(data)
+                    continue
+                code = reply['code']
+                errs = data
+                if reply.get('dropped'):
+                    errs += ('\n[%d more bytes of stderr dropped]\n' %
+                             reply['dropped'])
+                break
+        except (AgentError, IOError, OSError, ValueError, KeyError) as e:
+            self.close()
+            code = 124 if entry['killed'] else 255
+            errs = '%s: agent session failed: %s' % (str(self.ip), e)
+            logger.warning(errs)
+        finally:
+            deadlines.done(entry, code)
+        return ''.join(outs), errs, code
+
+    @property
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def close(self):
+        if self.proc is None:
+            return
+        if self.proc.poll() is None:
+            try:
+                self.send({'method': 'exit'})
+                self.proc.stdin.close()
+            except (IOError, OSError):
+                pass
+            timer = threading.Timer(self.grace, self.kill)
+            timer.start()
+            self.proc.wait()
+            timer.cancel()
+        self.proc.stdout.close()
+
+    def kill(self):
+        try:
+            self.proc.kill()
+        except OSError:
+            pass
+
+
+class AgentCall(Launch):
+    '''A request to a node agent, yielded by node coroutines in place of
+    a Launch and driven by run_sync the same way. AsyncEngine does not
+    support it.'''
+    def __init__(self, session, method, meta, timeout, input=None,
+                 outputfile=None, errs_limit=None, label=None, sink=None):
+        Launch.__init__(self, None, timeout, input=input, sink=sink,
+                        errs_limit=errs_limit, label=label)
+        self.session = session
+        self.method = method
+        self.meta = meta
+        self.outputfile = outputfile
+
+    def run(self):
+        if self.outputfile is None:
+            return self.session.call(self.method, self.meta, self.timeout,
+                                     input=self.input, sink=self.sink,
+                                     errs_limit=self.errs_limit,
+                                     label=self.label)
+        try:
+            sink = open(self.outputfile, 'wb')
+        except IOError as e:
+            return '', str(e), 1
+        with sink:
+            outs, errs, code = self.session.call(self.method, self.meta,
+                                                 self.timeout,
+                                                 input=self.input, sink=sink,
+                                                 errs_limit=self.errs_limit,
+                                                 label=self.label)
+        return '', errs, code
+
+
+# sun_path of a unix socket holds 104 bytes on BSD, 108 on Linux, and ssh
+# first binds the socket to ControlPath plus a 17 character suffix
+ssh_control_path_max = 104 - 17
+# %C, the hash of the local host, node, port and user, is 40 characters
+ssh_control_name = '%C'
+ssh_control_name_len = 40
+
+
+def ssh_control_dir():
+    '''Makes the directory for the control sockets of ssh_multiplex_opts -
+    in /tmp if the temporary directory is too deep for the socket paths'''
+    base = gettempdir()
+    dirname = os.path.join(base, 'timmy_ssh_XXXXXX')
+    if len(dirname) + 1 + ssh_control_name_len > ssh_control_path_max:
+        base = '/tmp'
+    return mkdtemp(prefix='timmy_ssh_', dir=base)
+
+
+def ssh_multiplex_opts(control_dir, persist):
+    '''ssh options which make all connections to the same node share one
+    master connection, with its control socket kept in control_dir'''
+    control_path = os.path.join(control_dir, ssh_control_name)
+    return ['-oControlMaster=auto', '-oControlPath=%s' % control_path,
+            '-oControlPersist=%s' % persist]
+
+
+def ssh_proxy(ip, ssh_opts, timeout=15):
+    '''The ProxyCommand or ProxyJump ssh would use to reach ip with ssh_opts
+    and the ssh config files, None if there is none'''
+    if type(ssh_opts) is list:
+        ssh_opts = ' '.join(ssh_opts)
+    outs, errs, code = launch_cmd("ssh -G %s '%s' 2>/dev/null" %
+                                  (ssh_opts, ip), timeout)
+    if code != 0:
+        # ssh before 6.8 has no -G, only ssh_opts can be checked
+        match = re.search(r'-o\s*(proxy(command|jump)\S*)', ssh_opts, re.I)
+        return match.group(1) if match else None
+    for line in outs.splitlines():
+        option = line.split(None, 1)
+        if (len(option) == 2 and option[0] in ['proxycommand', 'proxyjump']
+                and option[1] != 'none'):
+            return ' '.join(option)
+    return None
+
+
+def ssh_master_exit(control_path, timeout=15):
+    cmd = ("timeout '%s' ssh -oControlPath='%s' -O exit timmy" %
+           (timeout, control_path))
+    return launch_cmd(cmd, timeout)
+
+
+def get_files_rsync(ip, data, ssh_opts, rsync_opts, dpath, timeout=15,
+                    defer=False, link_dest=None):
     if type(ssh_opts) is list:
         ssh_opts = ' '.join(ssh_opts)
     if type(rsync_opts) is list:
         rsync_opts = ' '.join(rsync_opts)
+    if link_dest:
+        '''files unchanged since the copy in link_dest are hardlinked from
+        there instead of being transferred'''
+        rsync_opts += " --link-dest='%s'" % os.path.abspath(link_dest)
     if (ip in ['localhost', '127.0.0.1']) or ip.startswith('127.'):
         logger.info("skip ssh rsync")
         cmd = ("timeout '%s' rsync %s --include-from=- / '%s' --exclude='*'" %
@@ -380,10 +1914,461 @@ def get_files_rsync(ip, data, ssh_opts, rsync_opts, dpath, timeout=15):
     logger.debug("command:%s\ndata:\n%s" % (cmd, data))
     if data == '':
         return cmd, '', 127
-    return launch_cmd(cmd, timeout, input=data)
+    launch = Launch(cmd, timeout, input=data)
+    return launch if defer else retries.run(launch)
+
+
+def rsync_include_rules(path):
+    '''rsync filter rules (filelists format) selecting path and, if it is
+    a directory, everything below it'''
+    path = os.path.normpath(path).strip(os.path.sep)
+    parts = path.split(os.path.sep)
+    rules = ['+ /%s' % os.path.sep.join(parts[:i + 1])
+             for i in range(len(parts))]
+    rules.append('+ /%s/**' % path)
+    return '\n'.join(rules) + '\n'
+
 
+class PathMatcher(object):
+    '''Matches strings against a list of regular expressions the way
+    any(re.search(p, string) for p in patterns) does, compiled once.
 
-def get_file_scp(ip, file, ddir, ssh_opts, timeout=600, recursive=False):
+    Patterns without special characters (plain or re.escape'd paths) go
+    to a trie, so matching costs about the string length no matter how
+    many of them there are, the rest are joined into as few regexes as the
+    limit of groups per regex (100 in python 2.7) allows.'''
+    special = '.^$*+?{}[]|()'
+    max_groups = 99
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns or [])
+        self.trie = {}
+        self.anchored = {}
+        self.always = False
+        regexes = []
+        separate = []
+        for pattern in self.patterns:
+            literal = self.literal(pattern)
+            if literal is None:
+                # group numbers and flags would not survive joining
+                if re.search(r'\(\?|\\\d', pattern):
+                    separate.append(pattern)
+                else:
+                    regexes.append(pattern)
+                continue
+            trie = self.trie
+            if literal.startswith('^'):
+                trie = self.anchored
+                literal = literal[1:]
+            if not literal:
+                self.always = True
+            for char in literal:
+                trie = trie.setdefault(char, {})
+            trie[None] = True
+        joined = []
+        chunk = []
+        groups = 0
+        for regex in regexes:
+            count = re.compile(regex).groups
+            if chunk and groups + count > self.max_groups:
+                joined.append('|'.join(chunk))
+                chunk = []
+                groups = 0
+            chunk.append('(?:%s)' % regex)
+            groups += count
+        if chunk:
+            joined.append('|'.join(chunk))
+        self.regexes = [re.compile(r) for r in joined + separate]
+
+    @classmethod
+    def literal(cls, pattern):
+        '''Returns the string pattern matches literally, prefixed with ^ if
+        it is anchored, or None if pattern is not a plain string'''
+        chars = []
+        if pattern.startswith('^'):
+            chars.append('^')
+            pattern = pattern[1:]
+        escaped = False
+        for char in pattern:
+            if escaped:
+                if char.isalnum():
+                    return None
+                chars.append(char)
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char in cls.special:
+                return None
+            else:
+                chars.append(char)
+        if escaped:
+            return None
+        return ''.join(chars)
+
+    @staticmethod
+    def walk(trie, string, start):
+        for char in string[start:]:
+            trie = trie.get(char)
+            if trie is None:
+                return False
+            if None in trie:
+                return True
+        return False
+
+    def search(self, string):
+        if self.always:
+            return True
+        if self.anchored and self.walk(self.anchored, string, 0):
+            return True
+        if self.trie:
+            for i, char in enumerate(string):
+                if char in self.trie and self.walk(self.trie, string, i):
+                    return True
+        return any([r.search(string) for r in self.regexes])
+
+
+class LogIndex(object):
+    '''Log files of a node. Every file found is stored once - paths in a
+    list, sizes, mtimes and inodes in arrays, each logs item keeps an array
+    of the numbers of the files it selected. Total size and count of the
+    files selected by any item are maintained as items are added and
+    discarded.'''
+    def __init__(self):
+        self.paths = []
+        self.sizes = array('l')
+        self.mtimes = array('d')
+        self.inodes = array('L')
+        # number of items selecting each file
+        self.refs = array('H')
+        self.items = {}
+        self.total = 0
+        self.count = 0
+
+    def append(self, path, size, mtime=0, inode=0):
+        '''Stores a file, returns its number'''
+        self.paths.append(path)
+        self.sizes.append(size)
+        self.mtimes.append(mtime)
+        self.inodes.append(inode)
+        self.refs.append(0)
+        return len(self.paths) - 1
+
+    def select(self, item, numbers):
+        '''Sets the files selected by item'''
+        self.discard(item)
+        numbers = array('l', numbers)
+        for n in numbers:
+            if not self.refs[n]:
+                self.total += self.sizes[n]
+                self.count += 1
+            self.refs[n] += 1
+        self.items[item] = numbers
+
+    def discard(self, item):
+        for n in self.items.pop(item, []):
+            self.refs[n] -= 1
+            if not self.refs[n]:
+                self.total -= self.sizes[n]
+                self.count -= 1
+
+    def selected(self, item):
+        return len(self.items.get(item, []))
+
+    def size(self, select):
+        '''Total size of the files selected by any item and by select'''
+        return sum([self.sizes[n] for n, path in enumerate(self.paths)
+                    if self.refs[n] and select(path)])
+
+    def groups(self, key, select=None):
+        '''Groups the files selected by any item (and by select, if given)
+        by key(path), returns {group: (total size, number of the largest
+        file)}'''
+        groups = {}
+        for n, path in enumerate(self.paths):
+            if not self.refs[n] or (select and not select(path)):
+                continue
+            group = key(path)
+            size, largest = groups.get(group, (0, n))
+            if self.sizes[n] > self.sizes[largest]:
+                largest = n
+            groups[group] = (size + self.sizes[n], largest)
+        return groups
+
+    def __len__(self):
+        return self.count
+
+    def numbers(self):
+        '''Numbers of the files selected by any item'''
+        for n, refs in enumerate(self.refs):
+            if refs:
+                yield n
+
+    def __iter__(self):
+        '''Paths of the files selected by any item'''
+        for n in self.numbers():
+            yield self.paths[n]
+
+
+class LogsState(object):
+    '''Log files of a node as of the last archive collected from it -
+    {path: [inode, size, mtime]} of every file in it, see LogsDelta.'''
+    def __init__(self, filename):
+        self.filename = filename
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save(self, state):
+        mdir(os.path.dirname(self.filename))
+        with open(self.filename + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.rename(self.filename + '.tmp', self.filename)
+
+
+def log_state(index):
+    '''LogsState of the files selected in a LogIndex'''
+    return dict((index.paths[n], [index.inodes[n], index.sizes[n],
+                                  index.mtimes[n]])
+                for n in index.numbers())
+
+
+class LogsDelta(object):
+    '''What changed in the log files of a node since the previous archive,
+    given its LogsState. A file which only grew - same inode, larger size -
+    is fetched from its previous size on. So is one renamed within its
+    directory, e.g. nova-api.log rotated to nova-api.log.1 - found by the
+    inode, the range then applies to a copy of the previous path. New,
+    replaced, truncated and rewritten files are fetched whole.
+
+    ranges holds (path, offset, size, previous path or None) of everything
+    to fetch. script() sends the ranges, gzipped, as frames - a header line
+    "<marker> <index> <size>", size bytes (zero padded if the file shrank
+    meanwhile) and a line "<marker> <index> <bytes read>". sink() writes
+    them into a tree.'''
+    def __init__(self, index, previous):
+        self.marker = 'TIMMY-RANGE-%s' % uuid.uuid4().hex
+        self.ranges = []
+        self.unchanged = {}
+        inodes = dict(((os.path.dirname(path), entry[0]), path)
+                      for path, entry in previous.items())
+        for n in index.numbers():
+            path = index.paths[n]
+            inode = index.inodes[n]
+            size = index.sizes[n]
+            source = path
+            old = previous.get(path)
+            if old is None or old[0] != inode:
+                source = inodes.get((os.path.dirname(path), inode))
+                old = previous.get(source)
+            if old is None or size < old[1]:
+                self.ranges.append((path, 0, size, None))
+            elif source != path or size > old[1]:
+                self.ranges.append((path, old[1], size - old[1],
+                                    None if source == path else source))
+            elif index.mtimes[n] != old[2]:
+                # rewritten in place
+                self.ranges.append((path, 0, size, None))
+            else:
+                self.unchanged[path] = [inode, size, index.mtimes[n]]
+        self.index = index
+
+    @property
+    def size(self):
+        return sum([r[2] for r in self.ranges])
+
+    def script(self):
+        '''The ranges are one brace group, which bash reads whole before it
+        runs it - the input is consumed before any output is produced'''
+        lines = ['timmy_range() {',
+                 '    printf \'%s %%s %%s\\n\' "$1" "$3"' % self.marker,
+                 '    n=$(tail -c +$(($2 + 1)) "$4" 2>/dev/null | '
+                 'head -c "$3" | tee /dev/fd/3 | wc -c)',
+                 '    head -c $(($3 - n)) /dev/zero',
+                 '    printf \'%s %%s %%s\\n\' "$1" "$n"' % self.marker,
+                 '} 3>&1',
+                 '{']
+        for index, (path, offset, size, source) in enumerate(self.ranges):
+            lines.append('timmy_range %d %d %d %s' % (index, offset, size,
+                                                      quote(path)))
+        lines.append('} | gzip -c')
+        return '\n'.join(lines) + '\n'
+
+    def sink(self, directory):
+        '''Returns a launch_cmd sink writing range N into directory/path'''
+        return _RangeSink(self.marker, [os.path.join(directory,
+                                                     r[0].lstrip(os.sep))
+                                        for r in self.ranges])
+
+    def state(self, read):
+        '''LogsState once ranges were fetched, read is {range index: bytes
+        read} - files which could not be read are left out, to be fetched
+        whole next time'''
+        state = dict(self.unchanged)
+        numbers = dict((self.index.paths[n], n)
+                       for n in self.index.numbers())
+        for index, (path, offset, size, source) in enumerate(self.ranges):
+            if index in read:
+                n = numbers[path]
+                state[path] = [self.index.inodes[n], offset + read[index],
+                               self.index.mtimes[n]]
+        return state
+
+    def manifest(self, read):
+        '''Describes the ranges fetched, for timmy/logs_merge.py'''
+        return [{'path': path, 'offset': offset, 'size': read[index],
+                 'source': source}
+                for index, (path, offset, size, source)
+                in enumerate(self.ranges) if index in read]
+
+
+class _RangeSink(object):
+    '''Writes LogsDelta frames into files as they arrive. read holds {range
+    index: bytes read} of the ranges which were written completely.'''
+    max_header = 4096
+
+    def __init__(self, marker, paths):
+        self.marker = marker
+        self.paths = paths
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.read = {}
+        self.header = ''
+        self.index = None
+        self.left = 0
+        self.file = None
+        self.broken = False
+
+    def write(self, data):
+        try:
+            data = self.decompressor.decompress(data)
+        except zlib.error:
+            return self.fail()
+        while data and not self.broken:
+            if self.index is not None and self.left:
+                chunk = data[:self.left]
+                if self.file:
+                    self.file.write(chunk)
+                self.left -= len(chunk)
+                data = data[len(chunk):]
+                continue
+            eol = data.find('\n')
+            if eol == -1:
+                self.header += data
+                if len(self.header) > self.max_header:
+                    self.fail()
+                return
+            line = self.header + data[:eol]
+            self.header = ''
+            data = data[eol + 1:]
+            self.line(line)
+
+    def line(self, line):
+        fields = line.split(' ')
+        try:
+            index, size = int(fields[1]), int(fields[2])
+        except (IndexError, ValueError):
+            return self.fail()
+        if (len(fields) != 3 or fields[0] != self.marker or
+                not 0 <= index < len(self.paths)):
+            return self.fail()
+        if self.index is None:
+            self.start(index, size)
+        elif index == self.index:
+            self.end(size)
+        else:
+            self.fail()
+
+    def start(self, index, size):
+        self.index = index
+        self.left = size
+        path = self.paths[index]
+        try:
+            mdir(os.path.dirname(path))
+            self.file = open(path, 'wb')
+        except (IOError, OSError) as e:
+            logger.error("can't write to file %s: %s" % (path, e))
+
+    def end(self, read):
+        if self.file:
+            # drop the padding of a file which shrank meanwhile
+            self.file.truncate(read)
+            self.file.close()
+            self.read[self.index] = read
+        self.file = None
+        self.index = None
+
+    def fail(self):
+        logger.warning('unexpected data in logs ranges, ignoring the rest')
+        if self.file:
+            self.file.close()
+        self.file = None
+        self.index = None
+        self.broken = True
+
+
+class FilesCache(object):
+    '''Copy of the files collected from a node in the previous run, used
+    as rsync --link-dest so that unchanged files are hardlinked instead of
+    transferred. rsync tells unchanged files by its quick check - same size
+    and mtime. The copy itself consists of hardlinks to the last output
+    tree, so it must be on the same filesystem as outdir.'''
+    def __init__(self, directory):
+        self.directory = directory
+        self.tree = os.path.join(directory, 'tree')
+
+    @property
+    def link_dest(self):
+        return self.tree if os.path.isdir(self.tree) else None
+
+    def update(self, ddir):
+        '''Replaces the copy with ddir, returns (changed files, files,
+        changed bytes, bytes) - files which were not hardlinked from the
+        previous copy were transferred.'''
+        stats = [0, 0, 0, 0]
+        for root, dirs, files in os.walk(ddir):
+            for name in files:
+                path = os.path.join(root, name)
+                rel = os.path.relpath(path, ddir)
+                st = os.lstat(path)
+                if not os.path.isfile(path) or os.path.islink(path):
+                    continue
+                try:
+                    cached = os.lstat(os.path.join(self.tree, rel))
+                    reused = cached.st_ino == st.st_ino
+                except OSError:
+                    reused = False
+                stats[1] += 1
+                stats[3] += st.st_size
+                if not reused:
+                    stats[0] += 1
+                    stats[2] += st.st_size
+        new_tree = '%s.new' % self.tree
+        try:
+            shutil.rmtree(new_tree, ignore_errors=True)
+            link_tree(ddir, new_tree)
+            shutil.rmtree(self.tree, ignore_errors=True)
+            os.rename(new_tree, self.tree)
+        except (IOError, OSError) as e:
+            logger.warning('could not update files cache %s: %s' %
+                           (self.directory, e))
+        return tuple(stats)
+
+
+def link_tree(src, dst):
+    '''Recreates src as dst with every file hardlinked'''
+    for root, dirs, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for name in files:
+            os.link(os.path.join(root, name), os.path.join(target, name))
+
+
+def get_file_scp(ip, file, ddir, ssh_opts, timeout=600, recursive=False,
+                 defer=False):
     if type(ssh_opts) is list:
         ssh_opts = ' '.join(ssh_opts)
     dest = os.path.split(os.path.normpath(file).lstrip(os.path.sep))[0]
@@ -392,16 +2377,147 @@ def get_file_scp(ip, file, ddir, ssh_opts, timeout=600, recursive=False):
     r = '-r ' if recursive else ''
     cmd = ("timeout '%s' scp %s -p -q %s'%s':'%s' '%s'" %
            (timeout, ssh_opts, r, ip, file, ddir))
-    return launch_cmd(cmd, timeout)
+    launch = Launch(cmd, timeout)
+    return launch if defer else retries.run(launch)
 
 
-def put_file_scp(ip, file, dest, ssh_opts, timeout=600, recursive=True):
+def put_file_scp(ip, file, dest, ssh_opts, timeout=600, recursive=True,
+                 defer=False):
     if type(ssh_opts) is list:
         ssh_opts = ' '.join(ssh_opts)
     r = '-r ' if recursive else ''
     cmd = ("timeout '%s' scp %s -p -q %s'%s' '%s':'%s'" %
            (timeout, ssh_opts, r, file, ip, dest))
-    return launch_cmd(cmd, timeout)
+    launch = Launch(cmd, timeout)
+    return launch if defer else retries.run(launch)
+
+
+class Codec(object):
+    '''Compression of log archives.
+
+    program is what tar compresses with (--use-compress-program). threads
+    is its option setting the number of threads, if it can use several,
+    all_threads the option making it use all CPUs, which 0 threads means.
+    ratio is the expected archive size relative to gzip, the free space
+    check applies it to logs_size_coefficient when logs were not sampled.'''
+    # uncompressed tar is slightly larger than the files in it
+    tar_overhead = 1.05
+    # sampled ratios come from the start of files, allow for the rest
+    sample_margin = 1.1
+
+    def __init__(self, name, program=None, extension=None, threads=None,
+                 all_threads='', ratio=1.0, fallback=None, compress=None):
+        self.name = name
+        self.program = program
+        self.extension = extension
+        self.threads = threads
+        self.all_threads = all_threads
+        self.ratio = ratio
+        self.fallback = fallback
+        self.compress = compress
+
+    def command(self, threads=0):
+        if self.threads is None:
+            return self.program
+        option = self.threads % threads if threads else self.all_threads
+        return ('%s %s' % (self.program, option)).strip()
+
+    def tar_option(self, threads=0):
+        if not self.program:
+            return ''
+        return "--use-compress-program='%s'" % self.command(threads)
+
+    def filename(self, base):
+        if not self.extension:
+            return '%s.tar' % base
+        return '%s.tar.%s' % (base, self.extension)
+
+    def compress_cmd(self, filename, threads=0):
+        '''Local command compressing filename into filename.<extension>'''
+        return "%s %s '%s'" % (self.command(threads), self.compress,
+                               filename)
+
+    def sample_cmd(self, path, size):
+        '''Command printing "<size>\\t<compressed size>" of the first size
+        bytes of path'''
+        head = "head -c %d '%s'" % (size, path)
+        return ("printf '%%s\\t' $(%s | wc -c); %s | %s -c | wc -c" %
+                (head, head, self.command(1)))
+
+    def space(self, size, coefficient, sampled=None):
+        '''Expected size of an archive of size bytes of files. sampled is
+        the compression ratio measured on the files, see log_group.'''
+        if not self.program:
+            return size * max(coefficient, self.tar_overhead)
+        if sampled is not None:
+            return size * sampled * self.sample_margin
+        return size * coefficient * self.ratio
+
+
+codecs = {'gzip': Codec('gzip', 'gzip', 'gz', compress='-f'),
+          'pigz': Codec('pigz', 'pigz', 'gz', threads='-p %d',
+                        fallback='gzip', compress='-f'),
+          'zstd': Codec('zstd', 'zstd', 'zst', threads='-T%d',
+                        all_threads='-T0', ratio=0.9, fallback='pigz',
+                        compress='-q -f --rm'),
+          'xz': Codec('xz', 'xz', 'xz', threads='-T%d', all_threads='-T0',
+                      ratio=0.75, fallback='zstd', compress='-f'),
+          'none': Codec('none')}
+'''Preference of logs_compression "auto" and "local"'''
+codecs_auto = ['zstd', 'pigz', 'gzip']
+'''Extensions of files which are compressed already'''
+compressed_extensions = ('.gz', '.tgz', '.bz2', '.tbz2', '.xz', '.txz',
+                         '.zst', '.lz4', '.lzma', '.lzo', '.z', '.zip', '.7z')
+
+
+def is_compressed(path):
+    return path.lower().endswith(compressed_extensions)
+
+
+def is_compressible(path):
+    return not is_compressed(path)
+
+
+def log_group(path):
+    '''Files expected to compress alike - of the same directory and kind,
+    rotations included: nova-api.log, nova-api.log.1 and
+    nova-api.log-20160101 are all "log", while nova-api.log.2.gz is "gz".'''
+    directory, name = os.path.split(path)
+    name = name.lower()
+    if not is_compressed(name):
+        name = re.sub(r'([._-]\d+)+$', '', name)
+    return (directory, name.rsplit('.', 1)[-1])
+
+
+def choose_codec(name, available):
+    '''Returns the Codec to use for name given the programs available. An
+    unavailable codec falls back to the next one down to gzip, which is
+    assumed to be everywhere.'''
+    if name in ['auto', 'local']:
+        candidates = codecs_auto
+    else:
+        candidates = []
+        while name:
+            candidates.append(name)
+            name = codecs[name].fallback
+    for name in candidates:
+        codec = codecs[name]
+        if not codec.program or codec.program == 'gzip':
+            return codec
+        if codec.program in available:
+            return codec
+    return codecs['gzip']
+
+
+def local_programs(names):
+    '''The ones of names which are found in local PATH'''
+    found = []
+    for name in names:
+        for path in os.environ.get('PATH', '').split(os.pathsep):
+            if os.access(os.path.join(path, name), os.X_OK):
+                found.append(name)
+                break
+    return found
 
 
 def free_space(destdir, timeout):